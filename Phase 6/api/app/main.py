@@ -1,15 +1,57 @@
+import asyncio
+import logging
 import uvicorn
+from contextlib import asynccontextmanager
 from fastapi import FastAPI, APIRouter
-from fastapi.responses import RedirectResponse
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import RedirectResponse, Response
 from fastapi.middleware.cors import CORSMiddleware
 from http import HTTPStatus
+from prometheus_client import CONTENT_TYPE_LATEST
+from typing import Optional
 
+from .price_predictors import MODELS, load_models, sync_active_version
+from .price_predictors.settings import MODEL_WATCH_INTERVAL_SECONDS, TRAINING_DATA_STORAGE
+from .price_predictors.columnar_store import import_training_datasets
+from .price_predictors.metrics import render_metrics
 from .price_predictors.router import PredictorRouter
 
 
+logger = logging.getLogger(__name__)
+
 ALLOWED_ORIGINS = ['*'] # Everything for now
 
-app = FastAPI()
+async def watch_active_version(loading: Optional[asyncio.Task]):
+    # Follow the model version activated by other worker processes (retrains, rollbacks)
+    if loading is not None:
+        await loading
+    while True:
+        await asyncio.sleep(MODEL_WATCH_INTERVAL_SECONDS)
+        try:
+            await run_in_threadpool(sync_active_version)
+        except Exception:
+            logger.exception("Could not switch to the active model version")
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # The inserts go to the columnar store, it has to hold the CSV datasets before the first one.
+    # With gunicorn the master process already did it.
+    if TRAINING_DATA_STORAGE == "columnar":
+        await run_in_threadpool(import_training_datasets)
+    # Load the models in the background so the server (and /api/v1/predict/ready) is up right away.
+    # With gunicorn they were already loaded by the master process before forking this worker.
+    loading = None if MODELS.ready else asyncio.create_task(run_in_threadpool(load_models))
+    tasks = [loading] if loading is not None else []
+    if MODEL_WATCH_INTERVAL_SECONDS:
+        tasks.append(asyncio.create_task(watch_active_version(loading)))
+    yield
+    for task in tasks:
+        if not task.done():
+            task.cancel()
+
+
+app = FastAPI(lifespan=lifespan)
 
 
 # Add middlewares
@@ -30,6 +72,12 @@ api_root = APIRouter(prefix="/api/v1")
 api_root.include_router(PredictorRouter, prefix="/predict")
 
 
+# Prometheus scrape target
+@api_root.get("/metrics", include_in_schema=False)
+async def get_metrics():
+    return Response(await run_in_threadpool(render_metrics), media_type=CONTENT_TYPE_LATEST)
+
+
 # include the root router
 app.include_router(api_root)
 
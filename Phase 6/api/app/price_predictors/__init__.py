@@ -1,33 +1,366 @@
 import os; os.environ.setdefault('TF_ENABLE_ONEDNN_OPTS', '0')
 import json
-import joblib
-import xgboost as xgb
-import tensorflow as tf
-from sklearn.linear_model import LinearRegression
-from sklearn.preprocessing import StandardScaler
+import time
+import logging
+import threading
+import numpy as np
+from pathlib import Path
+from types import SimpleNamespace
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Optional, Tuple
 
 from .settings import *
+from .data_types import ModelLoadState
+from .metrics import MODEL_LOAD_SECONDS
+from .mlp_serving import NumpyMLP, build_mlp_predictor
+from .xgb_serving import FlatTreeEnsemble, FLAT_EVALUATOR_AVAILABLE, build_xgb_predictor
+from .registry import MODEL_REGISTRY, ARTIFACT_FILES
+from .comparables import ComparablesIndex, read_comparables
+from .explanations import Explainer, read_background
+from .serving_export import ensure_serving_export, load_serving_export
 
 
-# Check for model files existence
-for file in REQUIRED_FILES:
-    if not file.exists():
-        raise RuntimeError(f"Required file {file} not found. Please check your trained_models directory.")
-
-# Load models and assets
-try:
-    if "FEATURE_COLUMNS_PATH" not in globals():
-        # Load feature names and order
-        with open(FEATURE_COLUMNS_PATH, 'r') as f:
-            FEATURE_COLUMNS = json.load(f)
-    
-    XGB_MODEL = xgb.XGBRegressor()
-    # Load models
-    XGB_MODEL.load_model(XGB_MODEL_PATH)
-    LR_MODEL: LinearRegression = joblib.load(LR_MODEL_PATH)
-    MLP_MODEL = tf.keras.models.load_model(MLP_MODEL_PATH)
-    
-    STANDARD_SCALER: StandardScaler = joblib.load(SCALER_PATH)
-
-except Exception as e:
-    raise RuntimeError(f"Error loading models: {str(e)}")
+logger = logging.getLogger(__name__)
+
+
+class ModelBundle:
+    """
+    Models trained together (scaler, LR, XGBoost, MLP) and everything derived from them for serving.
+
+    A bundle is never modified after it has been created. Requests take a reference to the active
+    bundle once and use it until they are done, so a swap never mixes models of different versions.
+    `comparables` is the comparable vehicles index of the version, None if it has none. The explainer
+    of /explain is derived from the models on first use and kept with the bundle.
+    """
+
+    def __init__(self, version: str, scaler, lr_model, xgb_model, mlp_model,
+                 mlp_predictor: Optional[Callable[[np.ndarray], np.ndarray]] = None,
+                 xgb_predictor: Optional[Callable[[np.ndarray], np.ndarray]] = None,
+                 metadata: Optional[Dict] = None,
+                 artifact_keys: Tuple = (),
+                 comparables: Optional[ComparablesIndex] = None):
+        self.version = version
+        self.metadata = metadata or {}
+        # (artifact name, sha256) of the files the bundle was loaded from
+        self.artifact_keys = artifact_keys
+
+        self.scaler = scaler
+        self.lr_model = lr_model
+        self.xgb_model = xgb_model
+        self.mlp_model = mlp_model
+        self.comparables = comparables
+
+        # Plain arrays used instead of StandardScaler.transform and LinearRegression.predict on the request path
+        self.scaler_mean = np.asarray(scaler.mean_, dtype=np.float32)
+        self.scaler_scale = np.asarray(scaler.scale_, dtype=np.float32)
+        self.lr_coef = np.asarray(lr_model.coef_, dtype=np.float64).reshape(-1)
+        self.lr_intercept = float(np.ravel(lr_model.intercept_)[0])
+        # Callables scoring scaled rows, see MLP_SERVING_MODE and XGB_SERVING_MODE in settings.py
+        self.mlp_predictor = mlp_predictor or build_mlp_predictor(mlp_model, MLP_SERVING_MODE, MLP_PARITY_ATOL)
+        self.xgb_predictor = xgb_predictor or build_xgb_model_predictor(xgb_model)
+
+        self._explainer: Optional[Explainer] = None
+        self._explainer_lock = threading.Lock()
+
+    @property
+    def explainer(self) -> Explainer:
+        with self._explainer_lock:
+            if self._explainer is None:
+                self._explainer = Explainer(self, self._read_explanation_background(), self._xgb_booster())
+            return self._explainer
+
+    def _read_explanation_background(self) -> Optional[np.ndarray]:
+        artifact = self.metadata.get("artifacts", {}).get("explanation_background")
+        if artifact is None:
+            return None
+        return read_background(MODEL_REGISTRY.version_dir(self.version) / artifact["file"])
+
+    def _xgb_booster(self):
+        if self.xgb_model is not None:
+            return self.xgb_model.get_booster()
+        # served from the flat arrays of the serving export, the booster is only read for explanations
+        return read_xgboost(MODEL_REGISTRY.version_dir(self.version) / ARTIFACT_FILES["xgboost"]).get_booster()
+
+
+def build_xgb_model_predictor(xgb_model):
+    return build_xgb_predictor(xgb_model, XGB_SERVING_MODE, XGB_SERVING_THREADS, XGB_SMALL_BATCH_ROWS, XGB_PARITY_ATOL)
+
+
+def read_scaler(path: Path):
+    import joblib
+    return joblib.load(path)
+
+def read_linear_regression(path: Path):
+    import joblib
+    return joblib.load(path)
+
+def read_xgboost(path: Path):
+    import xgboost as xgb
+    xgb_model = xgb.XGBRegressor()
+    xgb_model.load_model(path)
+    return xgb_model
+
+def read_xgboost_for_serving(path: Path):
+    # The predictor is cached together with the model since building it runs a parity check
+    xgb_model = read_xgboost(path)
+    return xgb_model, build_xgb_model_predictor(xgb_model)
+
+def read_mlp(path: Path):
+    import tensorflow as tf
+    mlp_model = tf.keras.models.load_model(path)
+    # The predictor is cached together with the model since building it runs a parity check
+    return mlp_model, build_mlp_predictor(mlp_model, MLP_SERVING_MODE, MLP_PARITY_ATOL)
+
+
+# Model name -> reader of its artifact file
+MODEL_READERS = {
+    "scaler": read_scaler,
+    "linear_regression": read_linear_regression,
+    "xgboost": read_xgboost_for_serving,
+    "mlp": read_mlp,
+}
+
+
+class ServingModels:
+    """
+    Holds the active ModelBundle used to serve predictions.
+
+    Swapping versions is a single reference assignment. Artifacts are cached by content hash so
+    activating a version only loads the models that actually changed, and each model is loaded
+    on its own thread with its load state tracked for the readiness endpoint.
+    With SHARED_MODEL_MEMORY the bundle is built from the memory-mapped serving export instead.
+    """
+
+    MODEL_NAMES = tuple(MODEL_READERS)
+
+    def __init__(self):
+        self.active: Optional[ModelBundle] = None
+        self.previous: Optional[ModelBundle] = None
+        self.load_states = {name: ModelLoadState(status="pending") for name in self.MODEL_NAMES}
+        self._artifacts: Dict[Tuple[str, str], object] = {}
+        self._lock = threading.Lock()
+
+    @property
+    def ready(self) -> bool:
+        return self.active is not None
+
+    @property
+    def version(self) -> Optional[str]:
+        active = self.active
+        return active.version if active is not None else None
+
+    def not_ready_reason(self) -> str:
+        return ", ".join(
+            f"{name} is {state.status}" + (f" ({state.error})" if state.error else "")
+            for name, state in self.load_states.items() if state.status != "ready"
+        ) or "no model version is active"
+
+    def activate(self, bundle: ModelBundle):
+        """Atomically make `bundle` the one used by new requests"""
+        with self._lock:
+            if self.active is not None and self.active is not bundle:
+                self.previous = self.active
+            self.active = bundle
+            # Only keep the artifacts of the active and previous bundles (for fast rollbacks) around
+            keep = set(bundle.artifact_keys) | set(self.previous.artifact_keys if self.previous else ())
+            self._artifacts = {key: value for key, value in self._artifacts.items() if key in keep}
+
+    def _load_artifact(self, name: str, path: Path, sha256: str):
+        key = (name, sha256)
+        cached = self._artifacts.get(key)
+        if cached is not None:
+            self.load_states[name] = ModelLoadState(status="ready", load_seconds=0.0, reused=True)
+            return cached
+
+        self.load_states[name] = ModelLoadState(status="loading")
+        start = time.perf_counter()
+        try:
+            if not path.exists():
+                raise RuntimeError(f"Required file {path} not found. Please check your trained_models directory.")
+            artifact = MODEL_READERS[name](path)
+        except Exception as e:
+            logger.exception("Error loading %s model", name)
+            self.load_states[name] = ModelLoadState(status="failed", error=str(e), load_seconds=time.perf_counter() - start)
+            raise
+        load_seconds = time.perf_counter() - start
+        self.load_states[name] = ModelLoadState(status="ready", load_seconds=load_seconds)
+        MODEL_LOAD_SECONDS.labels(name).observe(load_seconds)
+        with self._lock:
+            self._artifacts[key] = artifact
+        return artifact
+
+    def _load_comparables(self, metadata: Dict, version_dir: Path) -> Tuple[Optional[ComparablesIndex], Tuple]:
+        """
+        The memory-mapped comparables index of a version and its artifact key, (None, ()) if the version
+        has none. An index that can not be read is logged and left out, predictions do not depend on it.
+        """
+        artifact = metadata["artifacts"].get("comparables")
+        if artifact is None or not COMPARABLES_ENABLED:
+            return None, ()
+        key = ("comparables", artifact["sha256"])
+        comparables = self._artifacts.get(key)
+        if comparables is None:
+            try:
+                comparables = read_comparables(version_dir / artifact["file"])
+            except Exception:
+                logger.exception("Error loading the comparables index of version %s", metadata["version"])
+                return None, ()
+            with self._lock:
+                self._artifacts[key] = comparables
+        return comparables, (key,)
+
+    def load_bundle(self, version: str) -> ModelBundle:
+        """Load a registry version, models are loaded in parallel and unchanged ones are reused"""
+        if SHARED_MODEL_MEMORY:
+            return self._load_shared_bundle(version)
+        metadata = MODEL_REGISTRY.get_metadata(version)
+        version_dir = MODEL_REGISTRY.version_dir(version)
+        hashes = {name: artifact["sha256"] for name, artifact in metadata["artifacts"].items()}
+
+        with ThreadPoolExecutor(max_workers=len(MODEL_READERS), thread_name_prefix="model-loader") as pool:
+            futures = {
+                name: pool.submit(self._load_artifact, name, version_dir / ARTIFACT_FILES[name], hashes[name])
+                for name in MODEL_READERS
+            }
+        errors = {name: future.exception() for name, future in futures.items() if future.exception() is not None}
+        if errors:
+            raise RuntimeError(f"Error loading models of version {version}: " + ", ".join(f"{name}: {e}" for name, e in errors.items()))
+
+        mlp_model, mlp_predictor = futures["mlp"].result()
+        xgb_model, xgb_predictor = futures["xgboost"].result()
+        comparables, comparables_key = self._load_comparables(metadata, version_dir)
+        return ModelBundle(
+            version,
+            scaler=futures["scaler"].result(),
+            lr_model=futures["linear_regression"].result(),
+            xgb_model=xgb_model,
+            mlp_model=mlp_model,
+            mlp_predictor=mlp_predictor,
+            xgb_predictor=xgb_predictor,
+            metadata=metadata,
+            artifact_keys=tuple((name, hashes[name]) for name in MODEL_READERS) + comparables_key,
+            comparables=comparables,
+        )
+
+    def _load_shared_bundle(self, version: str) -> ModelBundle:
+        """
+        Bundle scoring with arrays memory-mapped from the serving export of a version, so the
+        weights are shared by every worker process. Models missing from the export are loaded
+        from their artifact as usual (one copy per worker).
+        """
+        metadata = MODEL_REGISTRY.get_metadata(version)
+        version_dir = MODEL_REGISTRY.version_dir(version)
+        for name in self.MODEL_NAMES:
+            self.load_states[name] = ModelLoadState(status="loading")
+        start = time.perf_counter()
+        try:
+            ensure_serving_export(version)
+            manifest, arrays = load_serving_export(version)
+
+            if manifest["mlp_activations"] is not None:
+                mlp_model = None
+                mlp_predictor = NumpyMLP([
+                    (arrays[f"mlp_{i}_kernel"], arrays[f"mlp_{i}_bias"], activation)
+                    for i, activation in enumerate(manifest["mlp_activations"])
+                ]).predict
+            else:
+                mlp_model, mlp_predictor = read_mlp(version_dir / ARTIFACT_FILES["mlp"])
+
+            if manifest["xgb_base_score"] is not None and FLAT_EVALUATOR_AVAILABLE:
+                # Every batch size: a worker scores on a single thread, the workers are the parallelism
+                xgb_model = None
+                xgb_predictor = FlatTreeEnsemble(
+                    **{name: arrays[f"xgb_{name}"] for name in FlatTreeEnsemble.ARRAYS},
+                    base_score=manifest["xgb_base_score"],
+                ).predict
+            else:
+                xgb_model, xgb_predictor = read_xgboost_for_serving(version_dir / ARTIFACT_FILES["xgboost"])
+
+            # memory-mapped as well, the workers share the pages of the index file
+            comparables, comparables_key = self._load_comparables(metadata, version_dir)
+            bundle = ModelBundle(
+                version,
+                scaler=SimpleNamespace(mean_=arrays["scaler_mean"], scale_=arrays["scaler_scale"]),
+                lr_model=SimpleNamespace(coef_=arrays["lr_coef"], intercept_=arrays["lr_intercept"]),
+                xgb_model=xgb_model,
+                mlp_model=mlp_model,
+                mlp_predictor=mlp_predictor,
+                xgb_predictor=xgb_predictor,
+                metadata=metadata,
+                artifact_keys=comparables_key,
+                comparables=comparables,
+            )
+            # Compile and page in everything now, in the master process before the workers are forked
+            warmup = np.zeros((1, len(bundle.scaler_mean)), dtype=np.float32)
+            bundle.mlp_predictor(warmup)
+            bundle.xgb_predictor(warmup)
+        except Exception as e:
+            logger.exception("Error loading the serving export of version %s", version)
+            for name in self.MODEL_NAMES:
+                self.load_states[name] = ModelLoadState(status="failed", error=str(e), load_seconds=time.perf_counter() - start)
+            raise
+
+        load_seconds = time.perf_counter() - start
+        for name in self.MODEL_NAMES:
+            self.load_states[name] = ModelLoadState(status="ready", load_seconds=load_seconds)
+            MODEL_LOAD_SECONDS.labels(name).observe(load_seconds)
+        return bundle
+
+
+MODELS = ServingModels()
+# Versions activated by another process that this one failed to load
+_UNLOADABLE_VERSIONS = set()
+
+
+def activate_version(version: str) -> ModelBundle:
+    """Load a registry version (reusing unchanged models), mark it active and start serving it"""
+    bundle = MODELS.load_bundle(version)
+    MODEL_REGISTRY.activate(version)
+    MODELS.activate(bundle)
+    _UNLOADABLE_VERSIONS.discard(version)
+    return bundle
+
+
+def rollback_version() -> ModelBundle:
+    """Go back to the version that was active before the current one"""
+    previous = MODEL_REGISTRY.previous_version()
+    if previous is None:
+        raise ValueError("There is no previous model version to roll back to")
+    bundle = MODELS.load_bundle(previous)
+    MODEL_REGISTRY.rollback(expected_version=previous)
+    MODELS.activate(bundle)
+    return bundle
+
+
+def sync_active_version() -> bool:
+    """
+    Serve the version marked active in the registry if it is not the one being served, e.g. after
+    another worker process activated a retrained version or rolled back. Returns whether it changed.
+    """
+    version = MODEL_REGISTRY.active_version()
+    if version is None or version == MODELS.version or version in _UNLOADABLE_VERSIONS:
+        return False
+    try:
+        bundle = MODELS.load_bundle(version)
+    except Exception:
+        # Not retried on every poll, it stays unloadable until it is activated again explicitly
+        _UNLOADABLE_VERSIONS.add(version)
+        raise
+    MODELS.activate(bundle)
+    logger.info("Switched to model version %s activated by another process", version)
+    return True
+
+
+def load_models():
+    """Load the active model version, the legacy trained_models/ files are registered on the first start"""
+    start = time.perf_counter()
+    try:
+        version = MODEL_REGISTRY.ensure_active_version()
+        MODELS.activate(MODELS.load_bundle(version))
+    except Exception as e:
+        logger.error("Could not load the models: %s", e)
+        for name, state in MODELS.load_states.items():
+            if state.status in ("pending", "loading"):
+                MODELS.load_states[name] = ModelLoadState(status="failed", error=str(e))
+        return
+    logger.info("Model version %s loaded in %.2fs", version, time.perf_counter() - start)
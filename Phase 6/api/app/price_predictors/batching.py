@@ -0,0 +1,124 @@
+import asyncio
+import numpy as np
+from collections import Counter, deque
+from typing import Any, Callable, Deque, Dict, Tuple
+
+
+PredictionTuple = Tuple[float, float, float]
+
+
+class MicroBatcher:
+    """
+    Coalesces concurrent single-row prediction requests into batched model calls.
+
+    Requests are collected for at most `max_wait_ms` milliseconds (or until `max_batch_size`
+    rows are waiting), stacked into one matrix and scored with a single call of `predict_fn`
+    in a worker thread, so the event loop is never blocked by model inference.
+
+    Each row is submitted with the model bundle it was scaled for. Rows of different bundles
+    (submitted around a model swap) are never mixed in the same `predict_fn` call.
+    """
+
+    def __init__(self,
+                 predict_fn: Callable[[np.ndarray, Any], Tuple[np.ndarray, np.ndarray, np.ndarray]],
+                 max_wait_ms: float,
+                 max_batch_size: int):
+        self._predict_fn = predict_fn
+        self.max_wait = max_wait_ms / 1000
+        self.max_batch_size = max(1, int(max_batch_size))
+
+        self._pending: Deque[Tuple[np.ndarray, Any, asyncio.Future]] = deque()
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._has_pending: asyncio.Event | None = None
+        self._batch_full: asyncio.Event | None = None
+        self._worker: asyncio.Task | None = None
+
+        # Stats
+        self._requests = 0
+        self._batches = 0
+        self._rows = 0
+        self._failed_batches = 0
+        self._largest_batch = 0
+        self._batch_sizes: Counter = Counter()
+
+    def _ensure_worker(self):
+        loop = asyncio.get_running_loop()
+        if self._worker is not None and not self._worker.done() and self._loop is loop:
+            return
+        # First call or the previous event loop is gone (e.g. app restarted in the same process)
+        self._loop = loop
+        self._pending.clear()
+        self._has_pending = asyncio.Event()
+        self._batch_full = asyncio.Event()
+        self._worker = loop.create_task(self._run())
+
+    async def submit(self, scaled_row: np.ndarray, bundle: Any) -> PredictionTuple:
+        """Queue one scaled row of shape (1, n_features) and wait for its (lr, xgb, mlp) predictions by `bundle`"""
+        self._ensure_worker()
+        future = self._loop.create_future()
+        self._pending.append((scaled_row, bundle, future))
+        self._requests += 1
+        self._has_pending.set()
+        if len(self._pending) >= self.max_batch_size:
+            self._batch_full.set()
+        return await future
+
+    async def _run(self):
+        while True:
+            await self._has_pending.wait()
+            # Give other requests a chance to join the batch
+            if len(self._pending) < self.max_batch_size and self.max_wait > 0:
+                try:
+                    await asyncio.wait_for(self._batch_full.wait(), timeout=self.max_wait)
+                except asyncio.TimeoutError:
+                    pass
+
+            batch = [self._pending.popleft() for _ in range(min(len(self._pending), self.max_batch_size))]
+            if len(self._pending) < self.max_batch_size:
+                self._batch_full.clear()
+            if not self._pending:
+                self._has_pending.clear()
+
+            # Skip requests whose callers have gone away in the meantime
+            batch = [(row, bundle, future) for row, bundle, future in batch if not future.done()]
+            by_bundle: Dict[int, list] = {}
+            for row, bundle, future in batch:
+                by_bundle.setdefault(id(bundle), []).append((row, bundle, future))
+            for bundle_batch in by_bundle.values():
+                await self._process(bundle_batch)
+
+    async def _process(self, batch):
+        scaled_data = np.concatenate([row for row, _, _ in batch], axis=0)
+        bundle = batch[0][1]
+        try:
+            lr_predictions, xgb_predictions, mlp_predictions = await asyncio.to_thread(self._predict_fn, scaled_data, bundle)
+        except Exception as e:
+            self._failed_batches += 1
+            for _, _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        for idx, (_, _, future) in enumerate(batch):
+            if not future.done():
+                future.set_result((float(lr_predictions[idx]), float(xgb_predictions[idx]), float(mlp_predictions[idx])))
+
+        self._batches += 1
+        self._rows += len(batch)
+        self._largest_batch = max(self._largest_batch, len(batch))
+        self._batch_sizes[len(batch)] += 1
+
+    def stats(self) -> Dict:
+        """Queue depth and batch-size statistics"""
+        return {
+            "max_wait_ms": self.max_wait * 1000,
+            "max_batch_size": self.max_batch_size,
+            "queue_depth": len(self._pending),
+            "requests": self._requests,
+            "batches": self._batches,
+            "failed_batches": self._failed_batches,
+            "rows": self._rows,
+            "mean_batch_size": self._rows / self._batches if self._batches else 0.0,
+            "largest_batch": self._largest_batch,
+            "batch_size_counts": dict(sorted(self._batch_sizes.items())),
+        }
@@ -0,0 +1,246 @@
+"""
+Streaming bulk scoring of inventory files (CSV or Parquet).
+
+The file is read `chunk_rows` rows at a time, each chunk is validated, encoded and scaled as a
+matrix and scored with one call per model, and the scored rows are written out before the next
+chunk is read, so memory use does not depend on the size of the file.
+
+Categorical columns accept either label strings (e.g. "Sedan") or integer codes. Rows that fail
+validation are kept in the output with empty predictions and the reason in the `error` column.
+
+Command line, run from `Phase 6/api`:
+    python -m app.price_predictors.bulk_scoring inventory.csv scored.csv
+    python -m app.price_predictors.bulk_scoring inventory.parquet scored.parquet --chunk-rows 100000
+"""
+import sys
+import time
+import logging
+import argparse
+import numpy as np
+import pandas as pd
+from pathlib import Path
+from typing import Callable, Dict, Iterator, Optional
+
+from .data_types import LABEL_TABLES, max_vehicle_year
+from .settings import FEATURE_COLUMNS, BULK_SCORING_CHUNK_ROWS
+
+
+logger = logging.getLogger(__name__)
+
+INVENTORY_FORMATS = ("csv", "parquet")
+PREDICTION_COLUMNS = ["lr_prediction", "xgb_prediction", "mlp_prediction"]
+ERROR_COLUMN = "error"
+
+# Feature columns holding label-encoded values
+ENCODED_COLUMNS = [column for column in FEATURE_COLUMNS if column in LABEL_TABLES]
+
+
+def inventory_format(path: Path, file_format: Optional[str] = None) -> str:
+    file_format = file_format or ("parquet" if Path(path).suffix.lower() in (".parquet", ".pq") else "csv")
+    if file_format not in INVENTORY_FORMATS:
+        raise ValueError(f"Unknown inventory format '{file_format}'. Valid formats are {list(INVENTORY_FORMATS)}")
+    return file_format
+
+
+def _require_pyarrow():
+    try:
+        import pyarrow.parquet
+    except ImportError:
+        raise RuntimeError("Parquet inventory files require pyarrow (pip install pyarrow)") from None
+    return pyarrow.parquet
+
+
+def iter_inventory_chunks(path: Path, file_format: str, chunk_rows: int = BULK_SCORING_CHUNK_ROWS) -> Iterator[pd.DataFrame]:
+    if file_format == "parquet":
+        parquet_file = _require_pyarrow().ParquetFile(path)
+        for batch in parquet_file.iter_batches(batch_size=chunk_rows):
+            yield batch.to_pandas()
+    else:
+        # Everything as strings, the columns are converted (and validated) by encode_chunk
+        yield from pd.read_csv(path, chunksize=chunk_rows, dtype=str, keep_default_na=False, na_values=[""])
+
+
+def inventory_columns(path: Path, file_format: str):
+    if file_format == "parquet":
+        return _require_pyarrow().ParquetFile(path).schema_arrow.names
+    return list(pd.read_csv(path, nrows=0).columns)
+
+
+def _check_columns(columns):
+    missing = [column for column in FEATURE_COLUMNS if column not in columns]
+    if missing:
+        raise ValueError(f"Inventory file is missing the columns {missing}")
+
+
+def check_inventory(path: Path, file_format: Optional[str] = None):
+    """Raise a ValueError if the file can not be scored, before any output is produced"""
+    _check_columns(inventory_columns(path, inventory_format(path, file_format)))
+
+
+class _CodeEncoder:
+    """Label or integer code -> integer code of one column. The distinct values seen are cached, so a chunk is encoded with a single map."""
+
+    def __init__(self, column: str):
+        self.column = column
+        self.table = LABEL_TABLES[column]
+        self.codes: Dict[object, float] = {}
+
+    def _encode(self, value) -> float:
+        if isinstance(value, (bool, np.bool_)):
+            value = int(value)
+        text = str(value).strip()
+        try:
+            code = int(float(text))
+            return float(code) if code == float(text) and code in self.table.valid_codes else np.nan
+        except ValueError:
+            pass
+        code = self.table.mapping.get(text)
+        return np.nan if code is None else float(code)
+
+    def __call__(self, values: pd.Series) -> np.ndarray:
+        for value in values.dropna().unique():
+            if value not in self.codes:
+                self.codes[value] = self._encode(value)
+        return values.map(self.codes).to_numpy(dtype=np.float64)
+
+
+def encode_chunk(chunk: pd.DataFrame, encoders: Dict[str, _CodeEncoder]):
+    """
+    Feature matrix (FEATURE_COLUMNS order) of a chunk and the validation error of each row
+    ("" for valid rows), with the same rules as CarFeatures.
+    """
+    _check_columns(chunk.columns)
+    features = np.empty((len(chunk), len(FEATURE_COLUMNS)), dtype=np.float64)
+    errors = np.full(len(chunk), "", dtype=object)
+
+    def flag(mask, reason):
+        errors[mask & (errors == "")] = reason
+
+    for i, column in enumerate(FEATURE_COLUMNS):
+        if column in encoders:
+            features[:, i] = encoders[column](chunk[column])
+            flag(np.isnan(features[:, i]) & chunk[column].notna().to_numpy(), f"invalid {column}")
+        else:
+            features[:, i] = pd.to_numeric(chunk[column], errors="coerce").to_numpy(dtype=np.float64)
+        flag(np.isnan(features[:, i]), f"missing or invalid {column}")
+
+    mileage = features[:, FEATURE_COLUMNS.index("mileage")]
+    flag(mileage < 0, "mileage must be a non-negative number")
+    year = features[:, FEATURE_COLUMNS.index("year")]
+    flag((year < 1900) | (year > max_vehicle_year()), "year out of range")
+    return features, errors
+
+
+def iter_scored_chunks(path: Path, bundle, file_format: Optional[str] = None, chunk_rows: int = BULK_SCORING_CHUNK_ROWS,
+                       progress: Optional[Callable[[int, float], None]] = None) -> Iterator[pd.DataFrame]:
+    """
+    Input chunks with the PREDICTION_COLUMNS and ERROR_COLUMN appended, scored by `bundle`.
+    `progress(rows_done, seconds)` is called after each chunk.
+    """
+    from .views import predict_scaled_batch
+
+    encoders = {column: _CodeEncoder(column) for column in ENCODED_COLUMNS}
+    rows_done, start = 0, time.perf_counter()
+    for chunk in iter_inventory_chunks(path, inventory_format(path, file_format), chunk_rows):
+        features, errors = encode_chunk(chunk, encoders)
+        valid = errors == ""
+        predictions = np.full((len(chunk), len(PREDICTION_COLUMNS)), np.nan)
+        if valid.any():
+            scaled = features[valid].astype(np.float32)
+            scaled -= bundle.scaler_mean
+            scaled /= bundle.scaler_scale
+            for i, values in enumerate(predict_scaled_batch(scaled, bundle)):
+                predictions[valid, i] = values
+
+        chunk = chunk.reset_index(drop=True)
+        for i, column in enumerate(PREDICTION_COLUMNS):
+            chunk[column] = predictions[:, i]
+        chunk[ERROR_COLUMN] = errors
+        rows_done += len(chunk)
+        if progress is not None:
+            progress(rows_done, time.perf_counter() - start)
+        yield chunk
+
+
+def log_progress(rows_done: int, seconds: float):
+    logger.info("Inventory scoring: %d rows scored, %.0f rows/s", rows_done, rows_done / seconds if seconds else 0.0)
+
+
+def iter_scored_csv(path: Path, bundle, file_format: Optional[str] = None, chunk_rows: int = BULK_SCORING_CHUNK_ROWS,
+                    progress: Optional[Callable[[int, float], None]] = None) -> Iterator[bytes]:
+    """Scored rows as CSV, one piece per chunk (the first one with the header)"""
+    header = True
+    for chunk in iter_scored_chunks(path, bundle, file_format, chunk_rows, progress):
+        yield chunk.to_csv(index=False, header=header).encode()
+        header = False
+
+
+def score_inventory(input_path: Path, output_path: Path, bundle, input_format: Optional[str] = None,
+                    output_format: Optional[str] = None, chunk_rows: int = BULK_SCORING_CHUNK_ROWS,
+                    progress: Optional[Callable[[int, float], None]] = None) -> Dict:
+    """Score an inventory file into `output_path` (CSV or Parquet), written chunk by chunk"""
+    output_format = inventory_format(output_path, output_format)
+    chunks = iter_scored_chunks(input_path, bundle, input_format, chunk_rows, progress)
+    rows, invalid_rows, start = 0, 0, time.perf_counter()
+
+    if output_format == "parquet":
+        import pyarrow as pa
+        parquet = _require_pyarrow()
+        writer = None
+        try:
+            for chunk in chunks:
+                table = pa.Table.from_pandas(chunk, preserve_index=False)
+                if writer is None:
+                    writer = parquet.ParquetWriter(output_path, table.schema)
+                # Columns inferred from the first chunk, later chunks are cast to them
+                writer.write_table(table.cast(writer.schema))
+                rows += len(chunk)
+                invalid_rows += int((chunk[ERROR_COLUMN] != "").sum())
+        finally:
+            if writer is not None:
+                writer.close()
+    else:
+        with open(output_path, "wb") as f:
+            header = True
+            for chunk in chunks:
+                f.write(chunk.to_csv(index=False, header=header).encode())
+                header = False
+                rows += len(chunk)
+                invalid_rows += int((chunk[ERROR_COLUMN] != "").sum())
+
+    seconds = time.perf_counter() - start
+    return {
+        "rows": rows,
+        "scored_rows": rows - invalid_rows,
+        "invalid_rows": invalid_rows,
+        "seconds": seconds,
+        "rows_per_second": rows / seconds if seconds else 0.0,
+    }
+
+
+def main():
+    from . import MODELS
+    from .registry import MODEL_REGISTRY
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("input", type=Path)
+    parser.add_argument("output", type=Path)
+    parser.add_argument("--input-format", choices=INVENTORY_FORMATS, help="default: from the file extension")
+    parser.add_argument("--output-format", choices=INVENTORY_FORMATS, help="default: from the file extension")
+    parser.add_argument("--chunk-rows", type=int, default=BULK_SCORING_CHUNK_ROWS)
+    parser.add_argument("--version", help="model version to score with (default: the active one)")
+    args = parser.parse_args()
+
+    bundle = MODELS.load_bundle(args.version or MODEL_REGISTRY.ensure_active_version())
+
+    def progress(rows_done, seconds):
+        print(f"\r{rows_done} rows scored, {rows_done / seconds:,.0f} rows/s", end="", file=sys.stderr, flush=True)
+
+    summary = score_inventory(args.input, args.output, bundle, args.input_format, args.output_format, args.chunk_rows, progress)
+    print(file=sys.stderr)
+    print(f"{summary['rows']} rows ({summary['invalid_rows']} invalid) scored with model version {bundle.version} "
+          f"in {summary['seconds']:.1f}s ({summary['rows_per_second']:,.0f} rows/s), written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+import time
+import threading
+from collections import OrderedDict
+from typing import Dict, Hashable, Optional, Tuple
+
+from .data_types import CarFeatures, PricePredictionResult
+from .settings import FEATURE_COLUMNS
+
+
+class PredictionCache:
+    """
+    In-process LRU cache with a time-to-live for price predictions.
+
+    Entries are keyed on the canonicalized FEATURE_COLUMNS values of the request together with the
+    version of the serving models, and the whole cache is dropped as soon as a different model
+    version is seen (i.e. after a retrain swapped the models).
+    """
+
+    def __init__(self, max_size: int, ttl_seconds: float):
+        self.max_size = max(0, int(max_size))
+        self.ttl_seconds = ttl_seconds
+        self._entries: "OrderedDict[Hashable, Tuple[float, PricePredictionResult]]" = OrderedDict()
+        self._model_version = None
+        self._lock = threading.Lock()
+
+        # Stats
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+        self._expirations = 0
+        self._invalidations = 0
+
+    @staticmethod
+    def make_key(car_features: CarFeatures) -> Tuple[float, ...]:
+        # Cast everything to float so 1 and 1.0 (or -0.0 and 0.0) share an entry
+        return tuple(float(getattr(car_features, column)) + 0.0 for column in FEATURE_COLUMNS)
+
+    def _check_version(self, model_version):
+        if model_version != self._model_version:
+            if self._entries:
+                self._invalidations += 1
+            self._entries.clear()
+            self._model_version = model_version
+
+    def get(self, key: Hashable, model_version) -> Optional[PricePredictionResult]:
+        with self._lock:
+            self._check_version(model_version)
+            entry = self._entries.get(key)
+            if entry is None:
+                self._misses += 1
+                return None
+            expires_at, result = entry
+            if expires_at < time.monotonic():
+                del self._entries[key]
+                self._expirations += 1
+                self._misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self._hits += 1
+            return result
+
+    def put(self, key: Hashable, model_version, result: PricePredictionResult):
+        if self.max_size == 0:
+            return
+        with self._lock:
+            # Results computed with models that have been replaced in the meantime are not cached
+            if model_version != self._model_version:
+                return
+            self._entries[key] = (time.monotonic() + self.ttl_seconds, result)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self._evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._invalidations += 1
+
+    def stats(self) -> Dict:
+        """Hit/miss/eviction counters"""
+        lookups = self._hits + self._misses
+        return {
+            "max_size": self.max_size,
+            "ttl_seconds": self.ttl_seconds,
+            "size": len(self._entries),
+            "model_version": self._model_version,
+            "hits": self._hits,
+            "misses": self._misses,
+            "hit_rate": self._hits / lookups if lookups else 0.0,
+            "evictions": self._evictions,
+            "expirations": self._expirations,
+            "invalidations": self._invalidations,
+        }
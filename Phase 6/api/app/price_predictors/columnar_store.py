@@ -0,0 +1,347 @@
+import os
+import json
+import uuid
+import shutil
+import logging
+import threading
+import numpy as np
+import pandas as pd
+from pathlib import Path
+from contextlib import contextmanager
+from typing import Dict, Iterable, Iterator, List, Optional
+
+from .data_types import CarFeaturesWithPrice
+from .ingestion import LockedFile
+from .settings import REQUIRED_COLUMNS, COLUMN_DTYPES, COLUMNAR_STORE_DIR, COLUMNAR_COMPACTION_MIN_SEGMENTS
+from .settings import ORIGINAL_DATASET_FILE_PATH, TRAINING_ROW_INSERTION_FILE_PATH
+
+
+logger = logging.getLogger(__name__)
+
+
+class ColumnarStore:
+    """
+    Columnar training data store made of NumPy `.npy` files.
+
+    Layout of the store directory:
+        manifest.json           current base generation and list of segments (replaced atomically)
+        base-<gen>/<col>.npy    one typed column per file in REQUIRED_COLUMNS order, memory-mapped on read
+        segments/<seq>.npy      small structured arrays with the rows appended since the last compaction
+
+    Appending writes a new segment only, compaction merges the segments into a new base generation.
+    Readers always see a consistent snapshot since the manifest is the single source of truth.
+    """
+
+    def __init__(self, path: Path, columns: List[str] = REQUIRED_COLUMNS, dtypes: Dict[str, str] = COLUMN_DTYPES,
+                 compaction_min_segments: int = 64):
+        self.path = Path(path)
+        self.columns = list(columns)
+        self.dtypes = {column: np.dtype(dtypes[column]) for column in self.columns}
+        self.record_dtype = np.dtype([(column, self.dtypes[column]) for column in self.columns])
+        self.compaction_min_segments = compaction_min_segments
+
+        self._lock = threading.Lock()
+        self._compaction_lock = threading.Lock()
+        self._compaction_thread: Optional[threading.Thread] = None
+
+    # Manifest / locking helpers
+    @property
+    def manifest_path(self) -> Path:
+        return self.path / "manifest.json"
+
+    def exists(self) -> bool:
+        return self.manifest_path.exists()
+
+    def _read_manifest(self) -> Dict:
+        if not self.exists():
+            return {"base": None, "base_rows": 0, "segments": [], "next_segment": 0}
+        with open(self.manifest_path) as f:
+            return json.load(f)
+
+    def _write_manifest(self, manifest: Dict):
+        tmp_path = self.path / f"manifest.json.{uuid.uuid4().hex}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(manifest, f, indent=1)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.manifest_path)
+
+    @contextmanager
+    def _locked(self):
+        """Exclusive lock on the manifest for this process (thread lock) and others (file lock)"""
+        with self._lock:
+            self.path.mkdir(parents=True, exist_ok=True)
+            with open(self.path / "store.lock", "a+b") as f, LockedFile(f):
+                yield
+
+    @contextmanager
+    def _compacting(self):
+        """
+        Exclusive lock for a whole compaction, in this process and others (the API compacts after
+        inserts while a retrain process compacts before reading). It is separate from the manifest
+        lock, so appends and readers are not held up while the new base is written.
+        """
+        with self._compaction_lock:
+            self.path.mkdir(parents=True, exist_ok=True)
+            with open(self.path / "compaction.lock", "a+b") as f, LockedFile(f):
+                yield
+
+    # Writing
+    def _to_records(self, columns: Dict[str, np.ndarray]) -> np.ndarray:
+        n_rows = len(columns[self.columns[0]])
+        records = np.empty(n_rows, dtype=self.record_dtype)
+        for column in self.columns:
+            records[column] = columns[column]
+        return records
+
+    def append_columns(self, columns: Dict[str, np.ndarray]) -> int:
+        """Append rows given as {column: values} as a new segment and return the number of rows written"""
+        records = self._to_records(columns)
+        if len(records) == 0:
+            return 0
+
+        segments_dir = self.path / "segments"
+        with self._locked():
+            segments_dir.mkdir(parents=True, exist_ok=True)
+            manifest = self._read_manifest()
+            segment_name = f"{manifest['next_segment']:012d}.npy"
+            tmp_path = segments_dir / f"{segment_name}.tmp"
+            with open(tmp_path, "wb") as f:
+                np.save(f, records)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, segments_dir / segment_name)
+
+            manifest["segments"].append({"name": segment_name, "rows": len(records)})
+            manifest["next_segment"] += 1
+            self._write_manifest(manifest)
+            n_segments = len(manifest["segments"])
+
+        if n_segments >= self.compaction_min_segments:
+            self.compact_in_background()
+        return len(records)
+
+    def append_rows(self, rows: Iterable[CarFeaturesWithPrice]) -> int:
+        rows = [row.model_dump() for row in rows]
+        return self.append_columns({column: [row[column] for row in rows] for column in self.columns})
+
+    def import_csv(self, file_path: Path, chunksize: int = 500_000) -> int:
+        """
+        Append a CSV file as a new base generation (or segment if the store already has data).
+
+        The file is read in chunks straight into memory-mapped columns, so memory use does not
+        depend on the file size. Rows with missing required values are skipped.
+        """
+        if self.exists() and self._read_manifest()["base"] is not None:
+            total = 0
+            for chunk in self._read_csv_chunks(file_path, chunksize):
+                total += self.append_columns({column: chunk[column].to_numpy() for column in self.columns})
+            return total
+
+        # First pass counts the valid rows so the columns can be preallocated on disk
+        n_rows = sum(len(chunk) for chunk in self._read_csv_chunks(file_path, chunksize))
+        with self._locked():
+            manifest = self._read_manifest()
+            base_name = f"base-{uuid.uuid4().hex[:12]}"
+            base_dir = self.path / base_name
+            base_dir.mkdir(parents=True)
+            outputs = {
+                column: np.lib.format.open_memmap(base_dir / f"{column}.npy", mode="w+", dtype=self.dtypes[column], shape=(n_rows,))
+                for column in self.columns
+            }
+            offset = 0
+            for chunk in self._read_csv_chunks(file_path, chunksize):
+                for column in self.columns:
+                    outputs[column][offset:offset + len(chunk)] = chunk[column].to_numpy()
+                offset += len(chunk)
+            for output in outputs.values():
+                output.flush()
+            del outputs
+
+            manifest.update({"base": base_name, "base_rows": n_rows})
+            self._write_manifest(manifest)
+        return n_rows
+
+    def _read_csv_chunks(self, file_path: Path, chunksize: int) -> Iterator[pd.DataFrame]:
+        header = pd.read_csv(file_path, nrows=0).columns
+        missing_columns = set(self.columns) - set(header)
+        if missing_columns:
+            raise ValueError(f"File: {file_path} is missing {missing_columns} required columns")
+        for chunk in pd.read_csv(file_path, usecols=self.columns, chunksize=chunksize):
+            yield chunk.dropna()
+
+    # Compaction
+    def compact(self) -> int:
+        """
+        Merge the base and every segment into a new base generation, returns the number of merged segments.
+        A compaction started while another one runs waits for it, then merges what is left.
+        """
+        with self._compacting():
+            return self._compact()
+
+    def _compact(self) -> int:
+        manifest = self._read_manifest()
+        segments = manifest["segments"]
+        if not segments:
+            return 0
+
+        # Build the new base outside the manifest lock, new segments can keep coming in meanwhile
+        n_rows = manifest["base_rows"] + sum(segment["rows"] for segment in segments)
+        base_name = f"base-{uuid.uuid4().hex[:12]}"
+        base_dir = self.path / base_name
+        base_dir.mkdir(parents=True)
+        segment_records = [np.load(self.path / "segments" / segment["name"]) for segment in segments]
+        for column in self.columns:
+            output = np.lib.format.open_memmap(base_dir / f"{column}.npy", mode="w+", dtype=self.dtypes[column], shape=(n_rows,))
+            offset = 0
+            if manifest["base"] is not None:
+                base_column = np.load(self.path / manifest["base"] / f"{column}.npy", mmap_mode="r")
+                output[:len(base_column)] = base_column
+                offset = len(base_column)
+            for records in segment_records:
+                output[offset:offset + len(records)] = records[column]
+                offset += len(records)
+            output.flush()
+            del output
+
+        with self._locked():
+            current = self._read_manifest()
+            if current["base"] != manifest["base"]:
+                # A CSV import set the base in the meantime
+                shutil.rmtree(base_dir, ignore_errors=True)
+                return 0
+            merged = {segment["name"] for segment in segments}
+            current.update({
+                "base": base_name,
+                "base_rows": n_rows,
+                "segments": [segment for segment in current["segments"] if segment["name"] not in merged],
+            })
+            self._write_manifest(current)
+
+        # Old files are no longer referenced by the manifest. Readers open every file of their
+        # snapshot under the lock (see _open_snapshot), so the ones still iterating over them
+        # keep working (on POSIX) until they drop their memory maps.
+        if manifest["base"] is not None:
+            shutil.rmtree(self.path / manifest["base"], ignore_errors=True)
+        for name in merged:
+            (self.path / "segments" / name).unlink(missing_ok=True)
+        logger.info("Compacted %d segments into %s (%d rows)", len(merged), base_name, n_rows)
+        return len(merged)
+
+    def compact_in_background(self):
+        """Start a compaction in a daemon thread unless one is already running"""
+        if self._compaction_thread is not None and self._compaction_thread.is_alive():
+            return
+
+        def run():
+            try:
+                self.compact()
+            except Exception:
+                logger.exception("Background compaction of %s failed", self.path)
+
+        self._compaction_thread = threading.Thread(target=run, name="columnar-store-compaction", daemon=True)
+        self._compaction_thread.start()
+
+    # Reading
+    @property
+    def num_rows(self) -> int:
+        manifest = self._read_manifest()
+        return manifest["base_rows"] + sum(segment["rows"] for segment in manifest["segments"])
+
+    def iter_parts(self, columns: Optional[List[str]] = None, start: int = 0, stop: Optional[int] = None) -> Iterator[Dict[str, np.ndarray]]:
+        """
+        Yield the data part by part (the base, then each segment) as {column: values}.
+        Base columns are memory-mapped read-only, so nothing is copied or parsed.
+
+        Rows are kept in insertion order, `start` and `stop` select a row range and
+        the parts outside of it are not read at all.
+        """
+        columns = self.columns if columns is None else list(columns)
+        for part, low, high, n_rows in self._open_snapshot(columns, start, stop):
+            yield part if (low, high) == (0, n_rows) else {column: values[low:high] for column, values in part.items()}
+
+    def _open_snapshot(self, columns: List[str], start: int, stop: Optional[int]) -> List:
+        """
+        Memory-map every file of the current snapshot needed for rows `start` to `stop`.
+
+        This is done under the manifest lock, so a compaction cannot delete the files between
+        reading the manifest and opening them. Once mapped they stay readable after being unlinked.
+        """
+        if not self.exists():
+            return []
+        with self._locked():
+            manifest = self._read_manifest()
+            parts = [(manifest["base"], manifest["base_rows"])] if manifest["base"] is not None else []
+            parts += [(segment["name"], segment["rows"]) for segment in manifest["segments"]]
+
+            opened = []
+            offset = 0
+            for name, n_rows in parts:
+                low = max(start - offset, 0)
+                high = n_rows if stop is None else min(stop - offset, n_rows)
+                offset += n_rows
+                if high <= low:
+                    continue
+                if name == manifest["base"]:
+                    part = {column: np.load(self.path / name / f"{column}.npy", mmap_mode="r") for column in columns}
+                else:
+                    records = np.load(self.path / "segments" / name, mmap_mode="r")
+                    part = {column: records[column] for column in columns}
+                opened.append((part, low, high, n_rows))
+        return opened
+
+    def load_columns(self, columns: Optional[List[str]] = None, start: int = 0, stop: Optional[int] = None) -> Dict[str, np.ndarray]:
+        """
+        Load the requested columns (rows `start` to `stop`) as {column: values}.
+        Zero-copy (memory-mapped) when there are no pending segments, call `compact` first to get there.
+        """
+        columns = self.columns if columns is None else list(columns)
+        parts = list(self.iter_parts(columns, start, stop))
+        if not parts:
+            return {column: np.empty(0, dtype=self.dtypes[column]) for column in columns}
+        if len(parts) == 1:
+            return parts[0]
+        return {column: np.concatenate([part[column] for part in parts]) for column in columns}
+
+
+_TRAINING_STORE: Optional[ColumnarStore] = None
+_TRAINING_STORE_LOCK = threading.Lock()
+
+
+def get_training_store() -> ColumnarStore:
+    """The training data store configured in settings.py (see import_training_datasets for its creation)"""
+    global _TRAINING_STORE
+    with _TRAINING_STORE_LOCK:
+        if _TRAINING_STORE is None:
+            _TRAINING_STORE = ColumnarStore(COLUMNAR_STORE_DIR, compaction_min_segments=COLUMNAR_COMPACTION_MIN_SEGMENTS)
+        return _TRAINING_STORE
+
+
+def import_training_datasets() -> int:
+    """
+    Create the training data store from the existing CSV datasets, unless it already exists.
+    Returns the number of rows imported.
+
+    Run once at startup (the app's lifespan, gunicorn's when_ready) or with
+    `python -m app.price_predictors.columnar_store`, never on a request: importing the
+    original dataset takes a while.
+    """
+    store = get_training_store()
+    if store.exists():
+        return 0
+    # Processes starting together must not import the CSV files twice
+    COLUMNAR_STORE_DIR.parent.mkdir(parents=True, exist_ok=True)
+    with open(COLUMNAR_STORE_DIR.parent / "columnar.lock", "a+b") as f, LockedFile(f):
+        if store.exists():
+            return 0
+        imported = 0
+        for file in (ORIGINAL_DATASET_FILE_PATH, TRAINING_ROW_INSERTION_FILE_PATH):
+            if file.exists():
+                logger.info("Importing %s into the columnar store", file)
+                imported += store.import_csv(file)
+        return imported
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    print(f"{import_training_datasets()} rows imported into {COLUMNAR_STORE_DIR}")
@@ -0,0 +1,121 @@
+"""
+Comparable vehicles: the training rows closest to a car, with their prices (see COMPARABLES_ENABLED in settings.py).
+
+A KD-tree over the training rows scaled like the models see them (StandardScaler on FEATURE_COLUMNS),
+so the distance between two cars is the Euclidean distance of their standardized features. The index
+file holds the scaling it was built with, so it stays valid for the incremental versions that inherit
+it while their own scaler moves on.
+
+The tree arrays are memory-mapped when the index is loaded: loading takes milliseconds whatever the
+number of rows, and the worker processes share a single copy through the page cache. The features of
+the rows found are recovered from the scaled rows of the tree instead of being stored twice.
+"""
+import os
+import numpy as np
+from pathlib import Path
+from typing import Dict, Iterable, List, Tuple
+
+from .data_types import CarFeatures
+from .settings import FEATURE_COLUMNS, COMPARABLES_LEAF_SIZE
+
+
+# Feature columns holding whole numbers (rounded back after unscaling)
+INTEGER_COLUMNS = [column for column in FEATURE_COLUMNS if CarFeatures.model_fields[column].annotation is int]
+
+
+class ComparablesIndex:
+    """KD-tree over the scaled feature rows of the training data and the price of each row"""
+
+    def __init__(self, tree, prices: np.ndarray, scaler_mean: np.ndarray, scaler_scale: np.ndarray):
+        self.tree = tree
+        self.prices = prices
+        self.scaler_mean = np.asarray(scaler_mean, dtype=np.float64)
+        self.scaler_scale = np.asarray(scaler_scale, dtype=np.float64)
+        # the scaled rows, in the order of `prices`
+        self.rows = tree.get_arrays()[0]
+        self._integer_columns = [FEATURE_COLUMNS.index(column) for column in INTEGER_COLUMNS]
+
+    @property
+    def n_rows(self) -> int:
+        return len(self.prices)
+
+    def query(self, features: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        """(distances, row indices) of the `k` nearest rows of each row of `features` (unscaled, FEATURE_COLUMNS order), nearest first"""
+        scaled = (np.asarray(features, dtype=np.float64) - self.scaler_mean) / self.scaler_scale
+        return self.tree.query(scaled, k=min(k, self.n_rows), return_distance=True, sort_results=True)
+
+    def row_features(self, indices: np.ndarray) -> np.ndarray:
+        """Unscaled features of the rows at `indices`"""
+        features = np.asarray(self.rows[np.ravel(indices)]) * self.scaler_scale + self.scaler_mean
+        features[:, self._integer_columns] = np.round(features[:, self._integer_columns])
+        return np.round(features, 6)
+
+    def comparables(self, features: np.ndarray, k: int) -> List[List[Dict]]:
+        """For each row of `features`, its `k` nearest training rows as {"features", "price", "distance"}"""
+        distances, indices = self.query(features, k)
+        row_features = self.row_features(indices).tolist()
+        prices = np.asarray(self.prices[indices.ravel()]).tolist()
+        distances = distances.ravel().tolist()
+        results, i = [], 0
+        for _ in range(len(indices)):
+            neighbours = []
+            for _ in range(indices.shape[1]):
+                values = dict(zip(FEATURE_COLUMNS, row_features[i]))
+                for column in INTEGER_COLUMNS:
+                    values[column] = int(values[column])
+                neighbours.append({"features": values, "price": prices[i], "distance": distances[i]})
+                i += 1
+            results.append(neighbours)
+        return results
+
+    def save(self, path: Path):
+        import joblib
+        joblib.dump({
+            "tree": self.tree,
+            "prices": np.asarray(self.prices),
+            "scaler_mean": self.scaler_mean,
+            "scaler_scale": self.scaler_scale,
+            "feature_columns": FEATURE_COLUMNS,
+        }, path)
+
+
+def read_comparables(path: Path, mmap: bool = True) -> ComparablesIndex:
+    """Load an index saved by ComparablesIndex.save, its arrays memory-mapped read-only unless `mmap` is False"""
+    import joblib
+    saved = joblib.load(path, mmap_mode="r" if mmap else None)
+    if list(saved["feature_columns"]) != FEATURE_COLUMNS:
+        raise ValueError(f"The comparables index {path} was built for the feature columns {list(saved['feature_columns'])}")
+    return ComparablesIndex(saved["tree"], saved["prices"], saved["scaler_mean"], saved["scaler_scale"])
+
+
+def build_comparables_index(chunks: Iterable[Tuple[np.ndarray, np.ndarray]], scaler, path: Path,
+                            leaf_size: int = COMPARABLES_LEAF_SIZE) -> int:
+    """
+    Build the index of the (features, price) chunks, scaled by `scaler`, and save it to `path`.
+    The scaled rows are spooled to a file next to `path` and the tree is built over its memory map,
+    so the rows are never all held in memory at once. Returns the number of rows indexed.
+    """
+    from sklearn.neighbors import KDTree
+
+    path = Path(path)
+    rows_path = path.with_name(path.name + ".rows")
+    mean, scale = np.asarray(scaler.mean_, dtype=np.float64), np.asarray(scaler.scale_, dtype=np.float64)
+    prices, n_rows = [], 0
+    try:
+        with open(rows_path, "wb") as f:
+            for X, y in chunks:
+                f.write(np.ascontiguousarray((np.asarray(X, dtype=np.float64) - mean) / scale).tobytes())
+                prices.append(np.asarray(y, dtype=np.float64).reshape(-1))
+                n_rows += len(X)
+        if n_rows == 0:
+            raise ValueError("No training rows to build the comparables index from")
+
+        rows = np.memmap(rows_path, dtype=np.float64, mode="r", shape=(n_rows, len(FEATURE_COLUMNS)))
+        tree = KDTree(rows, leaf_size=leaf_size)
+        ComparablesIndex(tree, np.concatenate(prices), mean, scale).save(path)
+        # the tree references the memory map, which has to be closed before its file can be removed on Windows
+        del tree, rows
+    finally:
+        if rows_path.exists():
+            os.unlink(rows_path)
+    return n_rows
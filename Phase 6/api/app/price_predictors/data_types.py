@@ -1,8 +1,11 @@
 import json
-from pydantic import BaseModel, Field, field_validator
+import time
+import hashlib
+import numpy as np
+from pydantic import BaseModel, Field, field_validator, model_validator
 from datetime import datetime
-from typing import ClassVar, Dict
-from .settings import FEATURE_LABEL_MAPPINGS_PATH
+from typing import ClassVar, Dict, List, Tuple, Union
+from .settings import FEATURE_LABEL_MAPPINGS_PATH, FEATURE_COLUMNS, SWEEP_MAX_POINTS
 
 # Load the label mappings
 with open(FEATURE_LABEL_MAPPINGS_PATH) as f:
@@ -14,6 +17,73 @@ REVERSE_LABEL_MAPPINGS = {
     for field, mapping in LABEL_MAPPINGS.items()
 }
 
+# /label_mappings body, rendered once, and its ETag
+LABEL_MAPPINGS_JSON = json.dumps(LABEL_MAPPINGS).encode()
+LABEL_MAPPINGS_ETAG = f'"{hashlib.sha256(LABEL_MAPPINGS_JSON).hexdigest()[:32]}"'
+
+
+class LabelTable:
+    """
+    Lookup arrays of one label-encoded field, compiled once when the mappings are loaded, so whole
+    columns of labels or codes are encoded, decoded and validated without a Python loop.
+    """
+
+    def __init__(self, field: str, mapping: Dict[str, int]):
+        self.field = field
+        self.mapping = mapping
+        self.valid_codes = frozenset(mapping.values())
+
+        # Labels sorted for np.searchsorted, with the code of each
+        order = sorted(mapping)
+        self.sorted_labels = np.array(order, dtype=str)
+        self.sorted_codes = np.array([mapping[label] for label in order], dtype=np.int64)
+
+        # Dense arrays indexed by code
+        size = max(self.valid_codes) + 1 if mapping else 0
+        self.code_is_valid = np.zeros(size, dtype=bool)
+        self.code_is_valid[self.sorted_codes] = True
+        self.code_labels = np.full(size, None, dtype=object)
+        self.code_labels[self.sorted_codes] = self.sorted_labels.astype(object)
+
+        # Error messages list the valid values, built once instead of on every invalid value
+        self.valid_codes_text = str(sorted(self.valid_codes))
+        self.valid_labels_text = str(list(mapping.keys()))
+
+    def valid_code_mask(self, codes: np.ndarray) -> np.ndarray:
+        codes = np.asarray(codes)
+        in_range = (codes >= 0) & (codes < len(self.code_is_valid)) & (codes == np.floor(codes))
+        mask = np.zeros(codes.shape, dtype=bool)
+        mask[in_range] = self.code_is_valid[codes[in_range].astype(np.int64)]
+        return mask
+
+    def encode(self, labels) -> np.ndarray:
+        """Codes of an array of labels, -1 for unknown labels"""
+        labels = np.asarray(labels, dtype=str)
+        if len(self.sorted_labels) == 0:
+            return np.full(labels.shape, -1, dtype=np.int64)
+        positions = np.searchsorted(self.sorted_labels, labels).clip(max=len(self.sorted_labels) - 1)
+        return np.where(self.sorted_labels[positions] == labels, self.sorted_codes[positions], -1)
+
+    def decode(self, codes) -> np.ndarray:
+        """Labels of an array of valid codes"""
+        return self.code_labels[np.asarray(codes, dtype=np.int64)]
+
+
+LABEL_TABLES: Dict[str, LabelTable] = {field: LabelTable(field, mapping) for field, mapping in LABEL_MAPPINGS.items()}
+
+
+_year_bound = {"value": 0, "expires_at": 0.0}
+
+
+def max_vehicle_year() -> int:
+    """Latest valid manufacturing year (next year's models are on sale), recomputed when the calendar year changes"""
+    if time.time() >= _year_bound["expires_at"]:
+        current_year = datetime.now().year
+        _year_bound["value"] = current_year + 1
+        _year_bound["expires_at"] = datetime(current_year + 1, 1, 1).timestamp()
+    return _year_bound["value"]
+
+
 class CarFeatures(BaseModel):
     """
     Feature columns for car price prediction model
@@ -47,33 +117,30 @@ class CarFeatures(BaseModel):
 
     @field_validator('year')
     def year_must_be_reasonable(cls, value):
-        current_year = datetime.now().year
-        if not (1900 <= value <= current_year + 1):
-            raise ValueError(f'Year must be between 1900 and {current_year + 1}')
+        max_year = max_vehicle_year()
+        if not (1900 <= value <= max_year):
+            raise ValueError(f'Year must be between 1900 and {max_year}')
         return value
 
     @field_validator('engine_type', 'fuel_type', 'transmission', 'body_type', 'has_incidents', 'wheel_system')
     def validate_encoded_fields(cls, value, info):
-        field_name = info.field_name
-        valid_codes = cls._reverse_label_mappings.get(field_name)
-        if valid_codes is None:
+        table = LABEL_TABLES.get(info.field_name)
+        if table is None or value in table.valid_codes:
             return value  # skip validation if mapping not found
-        if value not in valid_codes:
-            raise ValueError(f"Invalid code '{value}' for field '{field_name}'. Valid codes are {list(valid_codes.keys())}")
-        return value
+        raise ValueError(f"Invalid code '{value}' for field '{info.field_name}'. Valid codes are {table.valid_codes_text}")
 
     @classmethod
     def encode_label(cls, field: str, label: str) -> int:
         """
         Encode a string label to an integer for a given field.
         """
-        mapping = cls._label_mappings.get(field)
-        if mapping is None:
+        table = LABEL_TABLES.get(field)
+        if table is None:
             raise ValueError(f"No encoding found for field '{field}'.")
         try:
-            return mapping[label]
+            return table.mapping[label]
         except KeyError:
-            raise ValueError(f"Invalid label '{label}' for field '{field}'. Valid labels are: {list(mapping.keys())}")
+            raise ValueError(f"Invalid label '{label}' for field '{field}'. Valid labels are: {table.valid_labels_text}")
 
     @classmethod
     def decode_label(cls, field: str, code: int) -> str:
@@ -86,7 +153,7 @@ class CarFeatures(BaseModel):
         try:
             return reverse_mapping[code]
         except KeyError:
-            raise ValueError(f"Invalid code '{code}' for field '{field}'. Valid codes are: {list(reverse_mapping.keys())}")
+            raise ValueError(f"Invalid code '{code}' for field '{field}'. Valid codes are: {LABEL_TABLES[field].valid_codes_text}")
 
     class Config:
         json_schema_extra = {
@@ -110,6 +177,24 @@ class CarFeatures(BaseModel):
         }
 
 
+def invalid_feature_values(field: str, values: np.ndarray) -> Tuple[np.ndarray, str]:
+    """
+    Mask of the values of a whole column of `field` that CarFeatures would reject, and the reason.
+    The same rules as the field validators, one vectorized check per column instead of one call per row.
+    """
+    values = np.asarray(values, dtype=np.float64)
+    table = LABEL_TABLES.get(field)
+    if table is not None:
+        return ~table.valid_code_mask(values), f"Invalid code for field '{field}'. Valid codes are {table.valid_codes_text}"
+    if field == "mileage":
+        return ~(values >= 0), "Mileage must be a non-negative number"
+    if field == "year":
+        max_year = max_vehicle_year()
+        return ~((values >= 1900) & (values <= max_year) & (values == np.floor(values))), f"Year must be a whole number between 1900 and {max_year}"
+    if CarFeatures.model_fields[field].annotation is int:
+        return ~(values == np.floor(values)), f"Field '{field}' must be a whole number"
+    return ~np.isfinite(values), f"Field '{field}' must be a finite number"
+
 from typing import Optional
 
 class CarFeaturesWithPrice(CarFeatures):
@@ -141,6 +226,50 @@ class CarFeaturesWithPrice(CarFeatures):
         }
 
 
+class CarFeatureLabels(BaseModel):
+    """
+    Feature columns with the categorical fields given as labels (see /label_mappings) instead of
+    codes. Used by /price/batch/labels, where the labels and the value ranges are checked for the
+    whole batch at once rather than by a validator call per field and row.
+    """
+    engine_type: str = Field(description="Engine type, e.g. 'I4'.")
+    fuel_type: str = Field(description="Fuel type, e.g. 'Gasoline'.")
+    transmission: str = Field(description="Transmission type, e.g. 'A'.")
+    body_type: str = Field(description="Body type, e.g. 'Sedan'.")
+    has_incidents: str = Field(description="Whether the car has incident records ('True' or 'False').")
+    wheel_system: str = Field(description="Wheel system type, e.g. 'AWD'.")
+    horsepower: float = Field(description="Engine horsepower.")
+    maximum_seating: int = Field(description="Maximum seating capacity.")
+    mileage: float = Field(description="Mileage of the car (non-negative).")
+    torque: float = Field(description="Engine torque.")
+    year: int = Field(description="Manufacturing year of the car.")
+    combined_fuel_economy: float = Field(description="Combined fuel economy (mpg).")
+    legroom: float = Field(description="Legroom in inches.")
+    major_options_count: float = Field(description="Count of major options.")
+    size_of_vehicle: float = Field(description="Size of the vehicle in cubic feet.")
+
+    class Config:
+        json_schema_extra = {
+            "example": {
+                "engine_type": "I4",
+                "fuel_type": "Gasoline",
+                "transmission": "A",
+                "body_type": "SUV / Crossover",
+                "has_incidents": "False",
+                "wheel_system": "AWD",
+                "horsepower": 177.0,
+                "maximum_seating": 5,
+                "mileage": 7.0,
+                "torque": 200.0,
+                "year": 2019,
+                "combined_fuel_economy": 25.0,
+                "legroom": 76.3,
+                "major_options_count": 1.0,
+                "size_of_vehicle": 426.6
+            }
+        }
+
+
 class ModelMetrics(BaseModel):
     """
     Metrics for each model including RMSE, MAE, and R2 score.
@@ -158,11 +287,162 @@ class RetrainedModelsResult(BaseModel):
     linear_regression: ModelMetrics
     xgboost: ModelMetrics
     mlp: ModelMetrics
+    training_seconds: Dict[str, float] = Field(default_factory=dict, description="Time spent fitting (and evaluating) each model.")
 
 
 
+class RetrainJobStatus(BaseModel):
+    """
+    Status of a background retraining job.
+    """
+    job_id: str
+    status: str = Field(description="One of: queued, running, swapping, succeeded, failed.")
+    stage: Optional[str] = Field(default=None, description="Stage the job is currently in.")
+    stage_seconds: Dict[str, float] = Field(default_factory=dict, description="Time spent in each finished stage.")
+    created_at: float = Field(description="Unix timestamp of the job creation.")
+    finished_at: Optional[float] = Field(default=None, description="Unix timestamp of the job completion.")
+    result: Optional[RetrainedModelsResult] = Field(default=None, description="Metrics of the retrained models.")
+    version: Optional[str] = Field(default=None, description="Model version created by the job.")
+    training_mode: Optional[str] = Field(default=None, description="Whether the models were refit from scratch (full) or updated with the new rows (incremental).")
+    error: Optional[str] = None
+
+
+class ModelLoadState(BaseModel):
+    """
+    Load state of a single serving model.
+    """
+    status: str = Field(description="One of: pending, loading, ready, failed.")
+    load_seconds: Optional[float] = Field(default=None, description="Time spent loading the model.")
+    error: Optional[str] = Field(default=None, description="Reason the model failed to load.")
+    reused: bool = Field(default=False, description="Whether the already loaded model was reused since its file did not change.")
+
+
+class ReadinessResult(BaseModel):
+    """
+    Readiness of the prediction API, per model.
+    """
+    ready: bool
+    version: Optional[str] = Field(default=None, description="Model version being served.")
+    models: Dict[str, ModelLoadState]
+
+
+class ModelVersionInfo(BaseModel):
+    """
+    A version of the model registry.
+    """
+    version: str
+    created_at: float = Field(description="Unix timestamp of the version creation.")
+    source: str = Field(description="How the version was created, e.g. retrain or legacy import.")
+    parent_version: Optional[str] = None
+    training_mode: Optional[str] = None
+    active: bool = False
+    metrics: Optional[RetrainedModelsResult] = None
+    hyperparameters: Optional[Dict[str, Dict]] = Field(default=None, description="Hyperparameters the XGBoost and MLP models were trained with.")
+    artifacts: Dict[str, str] = Field(description="sha256 of each artifact file.")
+
+
 # Pydantic model for the output data structure
 class PricePredictionResult(BaseModel):
     lr_prediction: float = Field(description="Predicted price from Linear Regression model. Example: 10.12")
     xgb_prediction: float = Field(description="Predicted price from XGBoost model. Example: 11.09")
     mlp_prediction: float = Field(description="Predicted price from MLP (Neural Network) model. Example: 9.85")
+
+
+class ComparableVehicle(BaseModel):
+    """
+    A training row close to the queried car.
+    """
+    features: Dict[str, Union[int, float]] = Field(description="Feature columns of the row, categorical fields as codes.")
+    price: float = Field(description="Price of the row.")
+    distance: float = Field(description="Euclidean distance to the queried car over the standardized features.")
+
+
+class ComparablesResult(BaseModel):
+    """
+    The training rows closest to a car, nearest first.
+    """
+    comparables: List[ComparableVehicle]
+
+
+class SweepAxis(BaseModel):
+    """
+    Values one feature takes in a sweep: the listed `values`, or `steps` evenly spaced values from
+    `start` to `stop` (rounded for the whole-number fields).
+    """
+    field: str = Field(description="Feature column to vary, e.g. 'mileage'.")
+    values: Optional[List[float]] = Field(default=None, min_length=1, description="Values of the field.")
+    start: Optional[float] = Field(default=None, description="First value of the range.")
+    stop: Optional[float] = Field(default=None, description="Last value of the range.")
+    steps: Optional[int] = Field(default=None, ge=1, le=SWEEP_MAX_POINTS, description="Number of values in the range.")
+
+    @model_validator(mode='after')
+    def check_grid(self):
+        if self.field not in FEATURE_COLUMNS:
+            raise ValueError(f"Unknown field '{self.field}'. Valid fields are {FEATURE_COLUMNS}")
+        if (self.values is None) == (self.steps is None) or (self.steps is not None and (self.start is None or self.stop is None)):
+            raise ValueError("Give either values, or start, stop and steps")
+        return self
+
+    @property
+    def n_values(self) -> int:
+        return len(self.values) if self.values is not None else self.steps
+
+    def grid(self) -> np.ndarray:
+        if self.values is not None:
+            return np.asarray(self.values, dtype=np.float64)
+        grid = np.linspace(self.start, self.stop, self.steps)
+        return np.round(grid) if CarFeatures.model_fields[self.field].annotation is int else grid
+
+
+class PriceSweepRequest(BaseModel):
+    """
+    A car and one or two of its fields swept over grids of values (see /price/sweep).
+    """
+    base: CarFeatures
+    sweeps: List[SweepAxis] = Field(min_length=1, max_length=2, description="One field for price curves, two for price surfaces.")
+
+    @model_validator(mode='after')
+    def check_distinct_fields(self):
+        if len({axis.field for axis in self.sweeps}) != len(self.sweeps):
+            raise ValueError("A field can only be swept once")
+        return self
+
+    class Config:
+        json_schema_extra = {
+            "example": {
+                "base": CarFeatures.model_config["json_schema_extra"]["example"],
+                "sweeps": [
+                    {"field": "mileage", "start": 0, "stop": 200000, "steps": 41},
+                    {"field": "year", "values": [2015, 2017, 2019, 2021]},
+                ],
+            }
+        }
+
+
+class PriceSweepResult(BaseModel):
+    """
+    Predicted prices over a sweep grid. With two fields the predictions are indexed [first field value][second field value].
+    """
+    fields: List[str] = Field(description="Swept fields, in the order of the request.")
+    values: List[List[float]] = Field(description="Grid of each swept field.")
+    lr_prediction: Union[List[float], List[List[float]]] = Field(description="Price curve or surface from the Linear Regression model.")
+    xgb_prediction: Union[List[float], List[List[float]]] = Field(description="Price curve or surface from the XGBoost model.")
+    mlp_prediction: Union[List[float], List[List[float]]] = Field(description="Price curve or surface from the MLP model.")
+
+
+class FeatureContributions(BaseModel):
+    """
+    Explanation of the prediction of one model (see /explain).
+    """
+    prediction: float = Field(description="Predicted price.")
+    base_value: float = Field(description="Price of the average car of the training data.")
+    contributions: Dict[str, float] = Field(description="How much each feature moves the price away from the base value. They add up to prediction - base_value (up to a small integration error for the MLP).")
+
+
+class PriceExplanationResult(BaseModel):
+    """
+    Feature contributions of each model.
+    """
+    lr_explanation: FeatureContributions
+    xgb_explanation: FeatureContributions
+    mlp_explanation: Optional[FeatureContributions] = Field(default=None, description="Missing if the MLP is not a stack of Dense layers.")
@@ -0,0 +1,110 @@
+"""
+Per-prediction explanations (see /explain): how much each feature moves the price of each model away
+from its base value, the price of the "average car" of the training data.
+
+- Linear regression: exact, coef * (x - mean of the background) on the scaled features.
+- XGBoost: TreeSHAP of the booster itself (pred_contribs). Its base value is the expected prediction
+  over the training rows, weighted by the tree cover.
+- MLP: expected gradients, i.e. integrated gradients averaged over the background rows. The gradient is
+  taken at EXPLANATION_MLP_STEPS midpoints of the path from each background row to the explained row,
+  for every row of the request in one NumPy forward and backward pass. The contributions add up to the
+  prediction minus the mean prediction over the background, up to the integration error.
+
+The background is a sample of training rows drawn by retrain and saved with the version. Versions
+without one (e.g. the legacy import) use the training mean, where the scaled features are all zero.
+Everything that does not depend on the explained rows is computed once per bundle, so an explanation
+costs about as much as a prediction.
+"""
+import numpy as np
+from pathlib import Path
+from typing import Dict, List, Optional
+
+from .mlp_serving import NumpyMLP
+from .settings import FEATURE_COLUMNS, EXPLANATION_MLP_STEPS
+
+
+def save_background(rows: np.ndarray, path: Path):
+    np.save(path, np.asarray(rows, dtype=np.float64))
+
+
+def read_background(path: Path) -> np.ndarray:
+    return np.load(path)
+
+
+class Explainer:
+    """Feature contributions of the three models of a bundle"""
+
+    def __init__(self, bundle, background: Optional[np.ndarray], booster):
+        self.scaler_mean = np.asarray(bundle.scaler_mean, dtype=np.float64)
+        self.scaler_scale = np.asarray(bundle.scaler_scale, dtype=np.float64)
+        if background is None or len(background) == 0:
+            background = self.scaler_mean.reshape(1, -1)
+        self.background = ((background - self.scaler_mean) / self.scaler_scale).astype(np.float32)
+
+        self.lr_coef = bundle.lr_coef
+        self.lr_background_mean = self.background.mean(axis=0, dtype=np.float64)
+        self.lr_base_value = float(self.lr_background_mean @ self.lr_coef + bundle.lr_intercept)
+
+        self.booster = booster
+
+        # MLP attributions need the weights, they are left out if the model is not a plain Dense stack
+        self.mlp = mlp_weights(bundle)
+        if self.mlp is not None:
+            self.mlp_base_value = float(self.mlp.predict(self.background).mean(dtype=np.float64))
+        # Midpoints of the path from the background rows to the explained row
+        self.mlp_alphas = ((np.arange(EXPLANATION_MLP_STEPS) + 0.5) / EXPLANATION_MLP_STEPS).astype(np.float32)
+
+    def scale(self, features: np.ndarray) -> np.ndarray:
+        return ((np.asarray(features, dtype=np.float64) - self.scaler_mean) / self.scaler_scale).astype(np.float32)
+
+    def linear_regression(self, scaled: np.ndarray):
+        """(predictions, base value, contributions)"""
+        contributions = (scaled - self.lr_background_mean) * self.lr_coef
+        return contributions.sum(axis=1) + self.lr_base_value, self.lr_base_value, contributions
+
+    def xgboost(self, scaled: np.ndarray):
+        import xgboost as xgb
+        # one column per feature and the bias (the same for every row) last
+        # feature names are given back if the booster was trained on a DataFrame
+        shap_values = self.booster.predict(xgb.DMatrix(scaled, feature_names=self.booster.feature_names), pred_contribs=True)
+        return shap_values.sum(axis=1), float(shap_values[0, -1]), shap_values[:, :-1]
+
+    def mlp_attributions(self, scaled: np.ndarray):
+        n_rows, n_background, n_features = len(scaled), len(self.background), scaled.shape[1]
+        # (row, background row, step, feature): every point of every path, scored as one matrix
+        differences = scaled[:, None, :] - self.background[None, :, :]
+        points = self.background[None, :, None, :] + self.mlp_alphas[None, None, :, None] * differences[:, :, None, :]
+        _, gradients = self.mlp.gradients(points.reshape(-1, n_features))
+        gradients = gradients.reshape(n_rows, n_background, len(self.mlp_alphas), n_features).mean(axis=2)
+        contributions = (gradients * differences).mean(axis=1, dtype=np.float64)
+        return self.mlp.predict(scaled), self.mlp_base_value, contributions
+
+    def explain(self, features: np.ndarray) -> List[Dict[str, Optional[Dict]]]:
+        """For each row of `features` (unscaled, FEATURE_COLUMNS order), the explanation of each model"""
+        scaled = self.scale(features)
+        explained = {"linear_regression": self.linear_regression(scaled), "xgboost": self.xgboost(scaled)}
+        explained["mlp"] = self.mlp_attributions(scaled) if self.mlp is not None else None
+
+        results = [{} for _ in range(len(scaled))]
+        for name, explanation in explained.items():
+            if explanation is None:
+                for result in results:
+                    result[name] = None
+                continue
+            predictions, base_value, contributions = explanation
+            for result, prediction, row in zip(results, np.asarray(predictions).tolist(), np.asarray(contributions).tolist()):
+                result[name] = {"prediction": prediction, "base_value": base_value, "contributions": dict(zip(FEATURE_COLUMNS, row))}
+        return results
+
+
+def mlp_weights(bundle) -> Optional[NumpyMLP]:
+    """The NumPy MLP of the bundle: the serving one when it is served with NumPy, else read from the keras model"""
+    predictor_owner = getattr(bundle.mlp_predictor, "__self__", None)
+    if isinstance(predictor_owner, NumpyMLP):
+        return predictor_owner
+    if bundle.mlp_model is None:
+        return None
+    try:
+        return NumpyMLP.from_keras(bundle.mlp_model)
+    except ValueError:
+        return None
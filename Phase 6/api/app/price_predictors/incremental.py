@@ -0,0 +1,120 @@
+import json
+import numpy as np
+from typing import Dict
+
+
+# Sufficient statistics of a training set, in raw (unscaled) feature space:
+#   n           number of rows
+#   x_mean      mean of each feature
+#   x_comoment  sum over rows of (x - x_mean)(x - x_mean)^T
+#   y_mean      mean of the target
+#   xy_comoment sum over rows of (x - x_mean)(y - y_mean)
+#   y_comoment  sum over rows of (y - y_mean)^2
+# They are enough to rebuild the scaler and the linear regression exactly, and two sets can be
+# merged without the rows they were computed from, so a retrain only has to look at the new rows.
+
+def compute_training_stats(X: np.ndarray, y: np.ndarray) -> Dict:
+    X = np.asarray(X, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64).reshape(-1)
+    x_mean = X.mean(axis=0)
+    y_mean = float(y.mean())
+    X_centered = X - x_mean
+    y_centered = y - y_mean
+    return {
+        "n": int(X.shape[0]),
+        "x_mean": x_mean,
+        "x_comoment": X_centered.T @ X_centered,
+        "y_mean": y_mean,
+        "xy_comoment": X_centered.T @ y_centered,
+        "y_comoment": float(y_centered @ y_centered),
+    }
+
+
+def merge_training_stats(a: Dict, b: Dict) -> Dict:
+    """Statistics of the union of two training sets (pairwise update of Chan et al.)"""
+    n = a["n"] + b["n"]
+    weight = a["n"] * b["n"] / n
+    x_delta = b["x_mean"] - a["x_mean"]
+    y_delta = b["y_mean"] - a["y_mean"]
+    return {
+        "n": n,
+        "x_mean": a["x_mean"] + x_delta * b["n"] / n,
+        "x_comoment": a["x_comoment"] + b["x_comoment"] + np.outer(x_delta, x_delta) * weight,
+        "y_mean": a["y_mean"] + y_delta * b["n"] / n,
+        "xy_comoment": a["xy_comoment"] + b["xy_comoment"] + x_delta * y_delta * weight,
+        "y_comoment": a["y_comoment"] + b["y_comoment"] + y_delta * y_delta * weight,
+    }
+
+
+def training_stats_to_json(stats: Dict) -> Dict:
+    return {key: value.tolist() if isinstance(value, np.ndarray) else value for key, value in stats.items()}
+
+
+def training_stats_from_json(stats: Dict) -> Dict:
+    return {key: np.asarray(value, dtype=np.float64) if isinstance(value, list) else value for key, value in stats.items()}
+
+
+def feature_std(stats: Dict) -> np.ndarray:
+    """Population standard deviation of each feature, as used by StandardScaler"""
+    return np.sqrt(np.diag(stats["x_comoment"]) / stats["n"])
+
+
+def linear_regression_from_stats(stats: Dict):
+    """Least squares coefficients and intercept (raw feature space) from the normal equations"""
+    coef, *_ = np.linalg.lstsq(stats["x_comoment"], stats["xy_comoment"], rcond=None)
+    intercept = stats["y_mean"] - stats["x_mean"] @ coef
+    return coef, float(intercept)
+
+
+def drift_score(reference: Dict, new: Dict) -> float:
+    """
+    Largest shift of a feature (or target) mean between two sets of statistics,
+    in units of the reference standard deviation.
+    """
+    x_std = feature_std(reference)
+    x_std[x_std == 0] = 1.0
+    y_std = np.sqrt(reference["y_comoment"] / reference["n"]) or 1.0
+    x_shift = np.abs(new["x_mean"] - reference["x_mean"]) / x_std
+    y_shift = abs(new["y_mean"] - reference["y_mean"]) / y_std
+    return float(max(x_shift.max(), y_shift))
+
+
+# Models fitted on features scaled with (old_mean, old_scale) are re-expressed for features scaled
+# with (new_mean, new_scale), so they can keep training after the scaler statistics were updated.
+# With u = (x - old_mean) / old_scale and v = (x - new_mean) / new_scale:
+#   u = v * new_scale / old_scale + (new_mean - old_mean) / old_scale
+
+def rescale_xgboost_splits(booster, old_mean, old_scale, new_mean, new_scale):
+    """Move the split thresholds of every tree of `booster` (in place) to the new feature scaling"""
+    old_mean, old_scale = np.asarray(old_mean, dtype=np.float64), np.asarray(old_scale, dtype=np.float64)
+    new_mean, new_scale = np.asarray(new_mean, dtype=np.float64), np.asarray(new_scale, dtype=np.float64)
+    model = json.loads(booster.save_raw(raw_format="json"))
+    for tree in model["learner"]["gradient_booster"]["model"]["trees"]:
+        features = np.asarray(tree["split_indices"])
+        thresholds = np.asarray(tree["split_conditions"], dtype=np.float64)
+        # leaves store their value in split_conditions
+        splits = np.asarray(tree["left_children"]) != -1
+        features = features[splits]
+        moved = (thresholds[splits] * old_scale[features] + old_mean[features] - new_mean[features]) / new_scale[features]
+        # Histogram cut points are data values, rows equal to the threshold go right (the split is x < t).
+        # Lower the threshold by two float32 ulps so rounding does not send them left after rescaling.
+        moved = moved.astype(np.float32)
+        for _ in range(2):
+            moved = np.nextafter(moved, np.float32(-np.inf))
+        thresholds[splits] = moved
+        tree["split_conditions"] = thresholds.tolist()
+    booster.load_model(bytearray(json.dumps(model).encode()))
+    return booster
+
+
+def rescale_mlp_inputs(mlp_model, old_mean, old_scale, new_mean, new_scale):
+    """Fold the change of feature scaling into the first Dense layer of `mlp_model` (in place)"""
+    first_layer = next(layer for layer in mlp_model.layers if layer.get_weights())
+    kernel, bias = first_layer.get_weights()
+    ratio = (np.asarray(new_scale, dtype=np.float64) / np.asarray(old_scale, dtype=np.float64))
+    shift = (np.asarray(new_mean, dtype=np.float64) - np.asarray(old_mean, dtype=np.float64)) / np.asarray(old_scale, dtype=np.float64)
+    first_layer.set_weights([
+        (kernel * ratio[:, None]).astype(kernel.dtype),
+        (bias + shift @ kernel).astype(bias.dtype),
+    ])
+    return mlp_model
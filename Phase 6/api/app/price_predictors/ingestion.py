@@ -0,0 +1,100 @@
+import io
+import os
+import csv
+import threading
+from pathlib import Path
+import numpy as np
+from typing import Dict, Iterable, List, Sequence
+
+try:
+    import fcntl
+except ImportError:  # Windows, only the in-process lock is used
+    fcntl = None
+
+from .data_types import CarFeaturesWithPrice
+from .settings import REQUIRED_COLUMNS
+
+
+# Serializes appends from the threads of this process, the file lock covers other processes
+_APPEND_LOCK = threading.Lock()
+
+
+class LockedFile:
+    """Exclusive advisory lock on an open file (no-op where fcntl is not available)"""
+
+    def __init__(self, f):
+        self.f = f
+
+    def acquire(self, blocking: bool = True) -> bool:
+        """Take the lock, without `blocking` return False right away if another process holds it"""
+        if fcntl is not None:
+            try:
+                fcntl.flock(self.f.fileno(), fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+            except BlockingIOError:
+                return False
+        return True
+
+    def release(self):
+        if fcntl is not None:
+            fcntl.flock(self.f.fileno(), fcntl.LOCK_UN)
+
+    def __enter__(self):
+        self.acquire()
+        return self.f
+
+    def __exit__(self, *exc):
+        self.release()
+
+
+def _read_header(f) -> List[str]:
+    f.seek(0)
+    header_line = f.readline().decode().strip()
+    return header_line.split(",") if header_line else []
+
+
+def append_training_rows(rows: Iterable[CarFeaturesWithPrice], file_path: Path) -> int:
+    """
+    Append rows to a training CSV file without reading or rewriting the existing data.
+
+    Values are written in the column order of the file's existing header (new files get a
+    REQUIRED_COLUMNS header), so this is O(rows appended) regardless of the file size.
+    All rows of one call are written with a single locked append, so concurrent requests,
+    threads or worker processes can not lose or interleave rows.
+    """
+    rows = [row.model_dump() for row in rows]
+    return append_training_columns({column: [row[column] for row in rows] for column in REQUIRED_COLUMNS}, file_path)
+
+
+def append_training_columns(columns: Dict[str, Sequence], file_path: Path) -> int:
+    """append_training_rows for rows given as {column: values}, e.g. the columns of an Arrow body"""
+    # plain Python values, the csv module would write the repr of NumPy scalars
+    columns = {column: values.tolist() if isinstance(values, np.ndarray) else list(values) for column, values in columns.items()}
+    n_rows = len(columns[REQUIRED_COLUMNS[0]])
+    if not n_rows:
+        return 0
+
+    with _APPEND_LOCK, open(file_path, "a+b") as f, LockedFile(f):
+        header = _read_header(f)
+        buffer = io.StringIO()
+        writer = csv.writer(buffer, lineterminator=os.linesep)
+
+        if not header:
+            header = REQUIRED_COLUMNS
+            writer.writerow(header)
+        else:
+            missing_columns = set(REQUIRED_COLUMNS) - set(header)
+            if missing_columns:
+                raise ValueError(f"File: {file_path} is missing {missing_columns} required columns")
+            # Make sure the last existing row is terminated before appending
+            f.seek(-1, os.SEEK_END)
+            if f.read(1) not in (b"\n", b"\r"):
+                buffer.write(os.linesep)
+
+        writer.writerows(zip(*[columns.get(column, [""] * n_rows) for column in header]))
+
+        f.seek(0, os.SEEK_END)
+        f.write(buffer.getvalue().encode())
+        f.flush()
+        os.fsync(f.fileno())
+
+    return n_rows
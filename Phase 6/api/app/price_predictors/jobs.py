@@ -0,0 +1,170 @@
+import os
+import re
+import time
+import uuid
+import logging
+import threading
+import multiprocessing
+from concurrent.futures import Future
+from pathlib import Path
+from typing import Optional, Tuple
+
+from . import activate_version
+from .ingestion import LockedFile
+from .metrics import RETRAIN_SECONDS, RETRAIN_STAGE_SECONDS
+from .data_types import RetrainJobStatus, RetrainedModelsResult
+from .settings import RETRAIN_JOBS_DIR, SHARED_MODEL_MEMORY, TRAINING_DATA_STORAGE, ORIGINAL_DATASET_FILE_PATH, TRAINING_ROW_INSERTION_FILE_PATH
+
+
+logger = logging.getLogger(__name__)
+
+_JOB_ID_PATTERN = re.compile(r"[0-9a-f]{32}")
+
+
+def _status_path(job_id: str) -> Path:
+    return RETRAIN_JOBS_DIR / f"{job_id}.json"
+
+
+def write_job_status(status: RetrainJobStatus):
+    """Write the status file of a job atomically, so readers never see a partial file"""
+    RETRAIN_JOBS_DIR.mkdir(parents=True, exist_ok=True)
+    path = _status_path(status.job_id)
+    tmp_path = path.with_suffix(f".{os.getpid()}.tmp")
+    tmp_path.write_text(status.model_dump_json())
+    os.replace(tmp_path, path)
+
+
+def read_job_status(job_id: str) -> Optional[RetrainJobStatus]:
+    if not _JOB_ID_PATTERN.fullmatch(job_id):
+        return None
+    path = _status_path(job_id)
+    if not path.exists():
+        return None
+    return RetrainJobStatus.model_validate_json(path.read_text())
+
+
+def _run_retrain_job(job_id: str, retrain_kwargs: dict):
+    """
+    Entry point of the retraining process.
+
+    Trains the models and saves them as a new registry version, recording the progress in the
+    job's status file. The API process activates that version once this process exits (see RetrainJobManager).
+    """
+    from .training import retrain
+    from .columnar_store import get_training_store
+    from .serving_export import write_serving_export
+
+    status = read_job_status(job_id)
+    status.status = "running"
+    stage_started = time.time()
+
+    def on_progress(stage):
+        nonlocal stage_started
+        now = time.time()
+        if status.stage is not None:
+            status.stage_seconds[status.stage] = now - stage_started
+        else:
+            # time to start the process and import the training stack
+            status.stage_seconds["starting"] = now - status.created_at
+        status.stage = stage
+        stage_started = now
+        write_job_status(status)
+
+    try:
+        if TRAINING_DATA_STORAGE == "columnar":
+            data = {"data_store": get_training_store()}
+        else:
+            data = {"data_files": [ORIGINAL_DATASET_FILE_PATH, TRAINING_ROW_INSERTION_FILE_PATH]}
+        res = retrain(**data, save_models=True, update_models_in_memory=False, progress_callback=on_progress, **retrain_kwargs)
+        if SHARED_MODEL_MEMORY:
+            # The models are already loaded here, the API processes only map the exported arrays
+            on_progress("exporting")
+            write_serving_export(res["version"])
+        on_progress("swapping")
+        status.status = "swapping"
+        status.result = RetrainedModelsResult(**res["metrics"])
+        status.version = res["version"]
+        status.training_mode = res["training_mode"]
+    except Exception as e:
+        logger.exception("Retrain job %s failed", job_id)
+        status.status = "failed"
+        status.error = f"{type(e).__name__}: {e}"
+        status.finished_at = time.time()
+    write_job_status(status)
+
+
+class RetrainJobManager:
+    """
+    Runs retraining in a separate process so the API keeps serving predictions from the
+    current models, and activates the new model version once the training is done.
+    Only one job runs at a time, across all the worker processes of the API (file lock).
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._current: Optional[Tuple[str, Future]] = None
+
+    @property
+    def running_job_id(self) -> Optional[str]:
+        if self._current is not None and not self._current[1].done():
+            return self._current[0]
+        return None
+
+    def start(self, **retrain_kwargs) -> Tuple[RetrainJobStatus, Future]:
+        """
+        Start a retraining job. Returns its initial status and a future resolved with the
+        final status once the new models are being served (or the job failed).
+        """
+        with self._lock:
+            if self.running_job_id is not None:
+                raise RuntimeError(f"Retrain job {self.running_job_id} is already running")
+            RETRAIN_JOBS_DIR.mkdir(parents=True, exist_ok=True)
+            lock_file = open(RETRAIN_JOBS_DIR / "retrain.lock", "a+b")
+            # Held until the job is over, released by _watch
+            job_lock = LockedFile(lock_file)
+            if not job_lock.acquire(blocking=False):
+                lock_file.close()
+                raise RuntimeError("A retrain job is already running in another worker process")
+
+            job_id = uuid.uuid4().hex
+            status = RetrainJobStatus(job_id=job_id, status="queued", created_at=time.time())
+            write_job_status(status)
+
+            # spawn: the training process should not inherit the threads and model state of the API
+            process = multiprocessing.get_context("spawn").Process(
+                target=_run_retrain_job, args=(job_id, retrain_kwargs), name=f"retrain-{job_id}", daemon=True)
+            process.start()
+
+            future = Future()
+            threading.Thread(target=self._watch, args=(job_id, process, future, job_lock),
+                             name=f"retrain-watch-{job_id}", daemon=True).start()
+            self._current = (job_id, future)
+        return status, future
+
+    def _watch(self, job_id: str, process, future: Future, job_lock: LockedFile):
+        process.join()
+        status = read_job_status(job_id)
+        try:
+            if status.status == "swapping":
+                swap_started = time.time()
+                # Models that did not change (e.g. an MLP that was not retrained) are reused, not reloaded
+                activate_version(status.version)
+                status.stage_seconds["swapping"] = time.time() - swap_started
+                status.stage = None
+                status.status = "succeeded"
+            elif status.status != "failed":
+                status.status = "failed"
+                status.error = f"Retraining process exited with code {process.exitcode}"
+        except Exception as e:
+            logger.exception("Could not swap in the models of retrain job %s", job_id)
+            status.status = "failed"
+            status.error = f"{type(e).__name__}: {e}"
+
+        status.finished_at = time.time()
+        write_job_status(status)
+        RETRAIN_SECONDS.labels(status.status).observe(status.finished_at - status.created_at)
+        for stage, seconds in status.stage_seconds.items():
+            RETRAIN_STAGE_SECONDS.labels(stage).observe(seconds)
+        job_lock.release()
+        job_lock.f.close()
+        future.set_result(status)
@@ -0,0 +1,79 @@
+import os
+from prometheus_client import REGISTRY, CollectorRegistry, Counter, Histogram, generate_latest, multiprocess
+
+from .settings import METRICS_ENABLED
+
+
+# Upper bounds in seconds of the histogram buckets
+LATENCY_BUCKETS = (1e-5, 2.5e-5, 5e-5, 1e-4, 2.5e-4, 5e-4, 1e-3, 2.5e-3, 5e-3, 1e-2, 2.5e-2, 5e-2, 0.1, 0.25, 0.5, 1.0)
+DURATION_BUCKETS = (0.1, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0, 600.0, 1800.0, 3600.0)
+
+
+class _NoMetric:
+    """Stands for every metric (and its labelled values) when METRICS_ENABLED is off"""
+
+    def labels(self, *values):
+        return self
+
+    def inc(self, amount: float = 1.0):
+        pass
+
+    def observe(self, value: float):
+        pass
+
+    def time(self):
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+
+_NO_METRIC = _NoMetric()
+
+
+def _counter(name: str, documentation: str, labelnames=()):
+    return Counter(name, documentation, labelnames) if METRICS_ENABLED else _NO_METRIC
+
+
+def _histogram(name: str, documentation: str, labelnames=(), buckets=LATENCY_BUCKETS):
+    return Histogram(name, documentation, labelnames, buckets=buckets) if METRICS_ENABLED else _NO_METRIC
+
+
+# Prediction requests. The model stages are timed per model call, which is one call per batch
+# for /price/batch and for micro-batched /price requests. Hot paths use the labelled values
+# below instead of looking them up on every call.
+STAGE_SECONDS = _histogram("price_api_stage_seconds", "Time spent in each stage of scoring a request.", ["stage"])
+STAGE_VALIDATION = STAGE_SECONDS.labels("validation")
+STAGE_PREPARATION = STAGE_SECONDS.labels("preparation")
+STAGE_LR = STAGE_SECONDS.labels("lr")
+STAGE_XGB = STAGE_SECONDS.labels("xgb")
+STAGE_MLP = STAGE_SECONDS.labels("mlp")
+STAGE_COMPARABLES = STAGE_SECONDS.labels("comparables")
+STAGE_EXPLANATION = STAGE_SECONDS.labels("explanation")
+
+# Training data and models
+INSERTED_ROWS = _counter("price_api_inserted_rows", "Training rows inserted.")
+INSERT_SECONDS = _histogram("price_api_insert_seconds", "Time to append the training rows of one insert call.")
+MODEL_LOAD_SECONDS = _histogram("price_api_model_load_seconds", "Time to load a model (models reused from memory are not counted).",
+                                ["model"], DURATION_BUCKETS)
+RETRAIN_SECONDS = _histogram("price_api_retrain_seconds", "Duration of retrain jobs, from the request to serving the new models.",
+                             ["status"], DURATION_BUCKETS)
+RETRAIN_STAGE_SECONDS = _histogram("price_api_retrain_stage_seconds", "Time spent in each stage of the retrain jobs.",
+                                   ["stage"], DURATION_BUCKETS)
+
+
+def render_metrics() -> bytes:
+    """
+    Every metric in the Prometheus text exposition format.
+
+    When PROMETHEUS_MULTIPROC_DIR is set (see gunicorn.conf.py) each worker process keeps its
+    values in files of that directory, and the reported values are the sum over all of them.
+    """
+    if "PROMETHEUS_MULTIPROC_DIR" not in os.environ:
+        return generate_latest(REGISTRY)
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    return generate_latest(registry)
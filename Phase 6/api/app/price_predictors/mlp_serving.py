@@ -0,0 +1,138 @@
+import logging
+import numpy as np
+from typing import Callable, List, Tuple
+
+
+logger = logging.getLogger(__name__)
+
+MLP_SERVING_MODES = ("keras", "numpy", "tf_function")
+
+_ACTIVATIONS = {
+    "linear": lambda x: x,
+    "relu": lambda x: np.maximum(x, 0, out=x),
+    "sigmoid": lambda x: 1 / (1 + np.exp(-x)),
+    "tanh": np.tanh,
+}
+
+# Derivative of each activation, from its output
+_ACTIVATION_DERIVATIVES = {
+    "linear": lambda y: np.ones_like(y),
+    "relu": lambda y: (y > 0).astype(y.dtype),
+    "sigmoid": lambda y: y * (1 - y),
+    "tanh": lambda y: 1 - y * y,
+}
+
+
+class NumpyMLP:
+    """
+    Inference-only forward pass of a Sequential stack of Dense layers using plain NumPy matmuls.
+
+    Dropout layers are skipped since they are a no-op at inference time. Computation is done in
+    float32 regardless of the mixed precision policy the keras model was trained with.
+    """
+
+    def __init__(self, layers: List[Tuple[np.ndarray, np.ndarray, str]]):
+        self.layers = layers
+
+    @classmethod
+    def from_keras(cls, model) -> "NumpyMLP":
+        layers = []
+        for layer in model.layers:
+            layer_type = layer.__class__.__name__
+            if layer_type in ("Dropout", "InputLayer"):
+                continue
+            if layer_type != "Dense":
+                raise ValueError(f"Layer '{layer.name}' of type {layer_type} is not supported by the numpy MLP")
+
+            activation = layer.get_config().get("activation", "linear")
+            if activation not in _ACTIVATIONS:
+                raise ValueError(f"Activation '{activation}' of layer '{layer.name}' is not supported by the numpy MLP")
+
+            kernel, bias = layer.get_weights()
+            layers.append((np.ascontiguousarray(kernel, dtype=np.float32), np.asarray(bias, dtype=np.float32), activation))
+
+        if not layers:
+            raise ValueError("MLP model has no Dense layers")
+        return cls(layers)
+
+    def predict(self, scaled_data: np.ndarray) -> np.ndarray:
+        """Predictions of shape (n_rows,)"""
+        output = np.asarray(scaled_data, dtype=np.float32)
+        for kernel, bias, activation in self.layers:
+            output = output @ kernel
+            output += bias
+            output = _ACTIVATIONS[activation](output)
+        return output.reshape(-1)
+
+    def gradients(self, scaled_data: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """Predictions of shape (n_rows,) and their gradients with respect to the input rows, shape (n_rows, n_features)"""
+        output = np.asarray(scaled_data, dtype=np.float32)
+        derivatives = []
+        for kernel, bias, activation in self.layers:
+            output = output @ kernel
+            output += bias
+            output = _ACTIVATIONS[activation](output)
+            derivatives.append(_ACTIVATION_DERIVATIVES[activation](output))
+        # backward pass of the single output through the layers
+        gradient = np.ones_like(output)
+        for (kernel, _, _), derivative in zip(reversed(self.layers), reversed(derivatives)):
+            gradient = (gradient * derivative) @ kernel.T
+        return output.reshape(-1), gradient
+
+
+def _keras_predictor(model) -> Callable[[np.ndarray], np.ndarray]:
+    def predict(scaled_data: np.ndarray) -> np.ndarray:
+        # A single forward pass over the whole batch instead of keras' default 32 rows per step
+        return np.asarray(model.predict(scaled_data, batch_size=len(scaled_data), verbose=0)).reshape(-1)
+    return predict
+
+
+def _tf_function_predictor(model) -> Callable[[np.ndarray], np.ndarray]:
+    import tensorflow as tf
+
+    n_features = model.inputs[0].shape[-1]
+    # Fixed input signature so the graph is traced only once for any batch size
+    forward = tf.function(
+        lambda x: model(x, training=False),
+        input_signature=[tf.TensorSpec(shape=[None, n_features], dtype=tf.float32)],
+    )
+
+    def predict(scaled_data: np.ndarray) -> np.ndarray:
+        return np.asarray(forward(np.asarray(scaled_data, dtype=np.float32)), dtype=np.float32).reshape(-1)
+    return predict
+
+
+def check_parity(model, predictor: Callable[[np.ndarray], np.ndarray], atol: float, n_rows: int = 256, seed: int = 31) -> float:
+    """Compare `predictor` with keras' own predict on random scaled inputs and return the max absolute difference"""
+    n_features = model.inputs[0].shape[-1]
+    probe = np.random.default_rng(seed).standard_normal((n_rows, n_features)).astype(np.float32)
+    expected = np.asarray(model.predict(probe, batch_size=n_rows, verbose=0), dtype=np.float32).reshape(-1)
+    max_diff = float(np.max(np.abs(predictor(probe) - expected)))
+    if max_diff > atol:
+        raise ValueError(f"MLP serving output differs from keras predict by {max_diff:.6f} (tolerance {atol})")
+    return max_diff
+
+
+def build_mlp_predictor(model, mode: str = "numpy", parity_atol: float = 5e-2) -> Callable[[np.ndarray], np.ndarray]:
+    """
+    Create the callable used to score scaled rows with the MLP model.
+
+    `mode` is one of MLP_SERVING_MODES. The numpy and tf_function modes are verified against
+    keras predict on load, and fall back to keras predict if they do not match.
+    """
+    if mode not in MLP_SERVING_MODES:
+        raise ValueError(f"Unknown MLP serving mode '{mode}'. Valid modes are {list(MLP_SERVING_MODES)}")
+    if mode == "keras":
+        return _keras_predictor(model)
+
+    try:
+        if mode == "numpy":
+            predictor = NumpyMLP.from_keras(model).predict
+        else:
+            predictor = _tf_function_predictor(model)
+        max_diff = check_parity(model, predictor, parity_atol)
+        logger.info("MLP serving mode '%s' matches keras predict (max abs diff %.6f)", mode, max_diff)
+        return predictor
+    except Exception as e:
+        logger.warning("Falling back to keras predict for the MLP model: %s", e)
+        return _keras_predictor(model)
@@ -0,0 +1,306 @@
+"""
+Out-of-core full refit (see RETRAIN_OUT_OF_CORE in settings.py).
+
+The training data is never loaded as a whole. Every consumer makes its own pass over the data
+files or the columnar store, `chunk_rows` rows at a time:
+  - the scaler and the linear regression come from the sufficient statistics of the training rows
+    (see incremental.py), computed in one pass and exactly equal to fitting them in memory
+  - XGBoost is fed through a DataIter into an ExtMemQuantileDMatrix, whose quantized pages are
+    cached on disk instead of in memory
+  - the MLP trains from a tf.data pipeline over the same chunks
+  - the metrics are accumulated chunk by chunk over the held out rows
+
+Rows are assigned to the test, validation or training part by a hash of their position in the
+data, so every pass sees the same split without keeping it in memory.
+"""
+import os
+import tempfile
+import numpy as np
+import pandas as pd
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+from sklearn.preprocessing import StandardScaler
+from sklearn.linear_model import LinearRegression
+
+from .incremental import compute_training_stats, merge_training_stats, linear_regression_from_stats
+from .settings import REQUIRED_COLUMNS, FEATURE_COLUMNS, TARGET_COLUMNS
+
+
+# Working memory of a chunk per row: the parsed columns, the float64 feature matrix, the scaled
+# float32 copy and what the model libraries copy from it, with some slack.
+WORKING_BYTES_PER_ROW = 1024
+# Memory an in-memory full refit needs per byte of CSV / per stored row (measured: about 1.4 GB
+# over the baseline for a 2M row, 148 MB CSV file)
+IN_MEMORY_BYTES_PER_CSV_BYTE = 10
+IN_MEMORY_BYTES_PER_STORED_ROW = 700
+
+# Parts of the rows, in percent: the test rows the metrics are computed on, the validation rows
+# XGBoost and the MLP stop early on, the rest is trained on (the same 20% / 10% as fit_full)
+TEST_PERCENT = 20
+VALIDATION_PERCENT = 8
+SPLITS = ("train", "validation", "test")
+
+# Chunks of a CSV file held at a time to shuffle their order (the columnar store is shuffled as a whole)
+SHUFFLE_BUFFER_CHUNKS = 4
+
+
+def chunk_rows_for_budget(memory_budget_mb: float) -> int:
+    return max(1_000, int(memory_budget_mb * 2**20 // WORKING_BYTES_PER_ROW))
+
+
+def estimate_in_memory_bytes(data_files: List, data_store=None) -> int:
+    """Rough peak memory of an in-memory full refit on these data sources"""
+    if data_store is not None:
+        return data_store.num_rows * IN_MEMORY_BYTES_PER_STORED_ROW
+    return sum(os.path.getsize(file) for file in data_files) * IN_MEMORY_BYTES_PER_CSV_BYTE
+
+
+def shuffle_buffer(items: Iterable, rng: np.random.Generator, size: int) -> Iterator:
+    """The items in a random order, holding at most `size` of them at a time"""
+    buffer = []
+    for item in items:
+        buffer.append(item)
+        if len(buffer) >= size:
+            yield buffer.pop(rng.integers(len(buffer)))
+    for i in rng.permutation(len(buffer)):
+        yield buffer[i]
+
+
+def row_splits(first_row: int, n_rows: int) -> np.ndarray:
+    """Index in SPLITS of the rows `first_row` to `first_row + n_rows` of the data"""
+    # Fibonacci hashing of the row position, bucketed into 0-99
+    positions = np.arange(first_row, first_row + n_rows, dtype=np.uint64)
+    buckets = ((positions * np.uint64(0x9E3779B97F4A7C15)) >> np.uint64(40)) % np.uint64(100)
+    splits = np.zeros(n_rows, dtype=np.int8)
+    splits[buckets < TEST_PERCENT + VALIDATION_PERCENT] = SPLITS.index("validation")
+    splits[buckets < TEST_PERCENT] = SPLITS.index("test")
+    return splits
+
+
+class ChunkedTrainingData:
+    """
+    The training rows of the same sources as load_training_data, read `chunk_rows` at a time.
+    The store is compacted and its row count taken once, rows appended later are left for the next retrain.
+    """
+
+    def __init__(self, data_files: List = [], data_store=None, chunk_rows: int = 500_000):
+        self.data_files = list(data_files)
+        self.data_store = data_store
+        self.chunk_rows = chunk_rows
+        self.data_rows = None
+        if data_store is not None:
+            data_store.compact()
+            self.data_rows = data_store.num_rows
+        else:
+            for file in self.data_files:
+                # Check for missing columns before any training starts
+                missing_columns = set(REQUIRED_COLUMNS) - set(pd.read_csv(file, nrows=0).columns)
+                if len(missing_columns) > 0:
+                    raise ValueError(f"File: {file} is missing {missing_columns} required columns")
+
+    def iter_frames(self, rng: Optional[np.random.Generator] = None) -> Iterator[Tuple[int, pd.DataFrame]]:
+        """
+        (position of the first row, rows) of each chunk, rows with missing values included.
+        With `rng` the chunks come in a random order: any order for the columnar store, which is
+        read in place, SHUFFLE_BUFFER_CHUNKS chunks at a time for the CSV files.
+        """
+        if self.data_store is not None:
+            chunks = []
+            first_row = 0
+            for part in self.data_store.iter_parts(REQUIRED_COLUMNS, stop=self.data_rows):
+                n_rows = len(part[REQUIRED_COLUMNS[0]])
+                chunks += [(first_row + start, part, start) for start in range(0, n_rows, self.chunk_rows)]
+                first_row += n_rows
+            for i in (range(len(chunks)) if rng is None else rng.permutation(len(chunks))):
+                first_row, part, start = chunks[i]
+                # copies only this chunk of the memory-mapped columns
+                yield first_row, pd.DataFrame({column: np.asarray(values[start:start + self.chunk_rows]) for column, values in part.items()})
+            return
+
+        frames = self._iter_csv_frames()
+        yield from (frames if rng is None else shuffle_buffer(frames, rng, SHUFFLE_BUFFER_CHUNKS))
+
+    def _iter_csv_frames(self) -> Iterator[Tuple[int, pd.DataFrame]]:
+        first_row = 0
+        for file in self.data_files:
+            for frame in pd.read_csv(file, usecols=REQUIRED_COLUMNS, chunksize=self.chunk_rows):
+                yield first_row, frame[REQUIRED_COLUMNS]
+                first_row += len(frame)
+        if self.data_rows is None:
+            self.data_rows = first_row
+
+    def iter_chunks(self, rng: Optional[np.random.Generator] = None) -> Iterator[Tuple[np.ndarray, np.ndarray, np.ndarray]]:
+        """(features, target, index in SPLITS) of each chunk, without the rows with missing values"""
+        for first_row, frame in self.iter_frames(rng):
+            complete = frame.notna().all(axis=1).to_numpy()
+            X = frame[FEATURE_COLUMNS].to_numpy(dtype=np.float64)[complete]
+            y = frame[TARGET_COLUMNS[0]].to_numpy(dtype=np.float64)[complete]
+            yield X, y, row_splits(first_row, len(frame))[complete]
+
+    def iter_split(self, split: str, scaler: Optional[StandardScaler] = None,
+                   rng: Optional[np.random.Generator] = None) -> Iterator[Tuple[np.ndarray, np.ndarray]]:
+        """(features, target) of the rows of one of SPLITS, chunk by chunk. Scaled to float32 by `scaler` if given."""
+        index = SPLITS.index(split)
+        for X, y, splits in self.iter_chunks(rng):
+            rows = splits == index
+            if not rows.any():
+                continue
+            X, y = X[rows], y[rows]
+            if scaler is not None:
+                X = X.astype(np.float32)
+                X -= scaler.mean_.astype(np.float32)
+                X /= scaler.scale_.astype(np.float32)
+                y = y.astype(np.float32)
+            yield X, y
+
+    def write_csv(self, path):
+        """Write the rows without missing values to a CSV file, chunk by chunk"""
+        header = True
+        with open(path, "w", newline="") as f:
+            for _, frame in self.iter_frames():
+                frame.dropna().to_csv(f, columns=REQUIRED_COLUMNS, index=False, header=header)
+                header = False
+
+
+def sample_rows(chunks: Iterable[np.ndarray], n_rows: int, seed: int = 31, width: int = len(FEATURE_COLUMNS)) -> np.ndarray:
+    """Uniform sample of `n_rows` rows of the chunks of `width` columns, in one pass (the rows with the smallest random keys)"""
+    rng = np.random.default_rng(seed)
+    rows, keys = np.empty((0, width)), np.empty(0)
+    for X in chunks:
+        rows = np.concatenate([rows, np.asarray(X, dtype=np.float64)])
+        keys = np.concatenate([keys, rng.random(len(X))])
+        if len(keys) > n_rows:
+            keep = np.argpartition(keys, n_rows)[:n_rows]
+            rows, keys = rows[keep], keys[keep]
+    return rows
+
+
+def training_stats_pass(data: ChunkedTrainingData) -> Tuple[Dict, Dict[str, int]]:
+    """Sufficient statistics of the rows the models are fit on (all but the test rows) and the row count of each split"""
+    stats, counts = None, dict.fromkeys(SPLITS, 0)
+    for X, y, splits in data.iter_chunks():
+        for i, split in enumerate(SPLITS):
+            counts[split] += int((splits == i).sum())
+        fit_rows = splits != SPLITS.index("test")
+        if fit_rows.any():
+            chunk_stats = compute_training_stats(X[fit_rows], y[fit_rows])
+            stats = chunk_stats if stats is None else merge_training_stats(stats, chunk_stats)
+    if stats is None or counts["test"] == 0:
+        raise ValueError("Not enough training rows")
+    return stats, counts
+
+
+def scaler_from_stats(stats: Dict) -> StandardScaler:
+    """A fitted StandardScaler, the same as StandardScaler().fit on the rows of the statistics"""
+    scaler = StandardScaler()
+    scaler.n_features_in_ = len(FEATURE_COLUMNS)
+    scaler.feature_names_in_ = np.array(FEATURE_COLUMNS, dtype=object)
+    scaler.n_samples_seen_ = stats["n"]
+    scaler.mean_ = np.asarray(stats["x_mean"], dtype=np.float64)
+    scaler.var_ = np.diag(stats["x_comoment"]) / stats["n"]
+    scale = np.sqrt(scaler.var_)
+    # constant features are left unscaled, as StandardScaler does
+    scale[scale < 10 * np.finfo(scale.dtype).eps] = 1.0
+    scaler.scale_ = scale
+    return scaler
+
+
+def linear_regression_from_training_stats(stats: Dict, scaler: StandardScaler) -> LinearRegression:
+    """The least squares LinearRegression on the scaled features, solved from the statistics"""
+    coef, intercept = linear_regression_from_stats(stats)
+    lr_model = LinearRegression()
+    lr_model.n_features_in_ = len(FEATURE_COLUMNS)
+    lr_model.coef_ = (coef * scaler.scale_).reshape(1, -1)
+    lr_model.intercept_ = np.array([intercept + scaler.mean_ @ coef])
+    return lr_model
+
+
+class StreamingMetrics:
+    """The evaluate_model metrics accumulated chunk by chunk"""
+
+    def __init__(self):
+        self.n = 0
+        self.squared_error = 0.0
+        self.absolute_error = 0.0
+        self.y_sum = 0.0
+        self.y_squared_sum = 0.0
+
+    def add(self, y_true, y_pred):
+        y_true = np.asarray(y_true, dtype=np.float64).reshape(-1)
+        error = y_true - np.asarray(y_pred, dtype=np.float64).reshape(-1)
+        self.n += len(y_true)
+        self.squared_error += float(error @ error)
+        self.absolute_error += float(np.abs(error).sum())
+        self.y_sum += float(y_true.sum())
+        self.y_squared_sum += float(y_true @ y_true)
+
+    def result(self) -> Dict[str, float]:
+        mse = self.squared_error / self.n
+        total = self.y_squared_sum - self.y_sum ** 2 / self.n
+        return {
+            "mse": mse,
+            "mae": self.absolute_error / self.n,
+            "rmse": float(np.sqrt(mse)),
+            "r2": 1.0 - self.squared_error / total if total > 0 else 0.0,
+        }
+
+
+def xgboost_data_iter(data: ChunkedTrainingData, split: str, scaler: StandardScaler, cache_dir: str):
+    """An xgboost.DataIter over the scaled rows of one split, for ExtMemQuantileDMatrix"""
+    import xgboost as xgb
+
+    class _SplitIter(xgb.DataIter):
+        def __init__(self):
+            self._chunks = None
+            super().__init__(cache_prefix=os.path.join(cache_dir, split), release_data=True)
+
+        def next(self, input_data) -> bool:
+            if self._chunks is None:
+                self._chunks = data.iter_split(split, scaler)
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                return False
+            input_data(data=chunk[0], label=chunk[1])
+            return True
+
+        def reset(self):
+            self._chunks = None
+
+    return _SplitIter()
+
+
+def mlp_dataset(data: ChunkedTrainingData, split: str, scaler: StandardScaler, n_rows: int, batch_size: int = 512, shuffle: bool = False):
+    """tf.data pipeline of (features, target) batches of the `n_rows` rows of one split, read from the chunks on every epoch"""
+    import tensorflow as tf
+
+    # Shared by the epochs, so each one visits the chunks, and the rows of every chunk, in a new order
+    rng = np.random.default_rng(31)
+
+    def batches():
+        X_left, y_left = np.empty((0, len(FEATURE_COLUMNS)), dtype=np.float32), np.empty(0, dtype=np.float32)
+        for X, y in data.iter_split(split, scaler, rng if shuffle else None):
+            if shuffle:
+                order = rng.permutation(len(X))
+                X, y = X[order], y[order]
+            # the rows left over from the previous chunk start the first batch, so only the last batch is partial
+            X, y = np.concatenate([X_left, X]), np.concatenate([y_left, y])
+            n_full = len(X) // batch_size * batch_size
+            for start in range(0, n_full, batch_size):
+                yield X[start:start + batch_size], y[start:start + batch_size].reshape(-1, 1)
+            X_left, y_left = X[n_full:], y[n_full:]
+        if len(X_left):
+            yield X_left, y_left.reshape(-1, 1)
+
+    signature = (
+        tf.TensorSpec(shape=(None, len(FEATURE_COLUMNS)), dtype=tf.float32),
+        tf.TensorSpec(shape=(None, 1), dtype=tf.float32),
+    )
+    dataset = tf.data.Dataset.from_generator(batches, output_signature=signature)
+    # A known number of batches lets keras size its epochs
+    dataset = dataset.apply(tf.data.experimental.assert_cardinality(-(-n_rows // batch_size)))
+    return dataset.prefetch(2)
+
+
+def external_memory_cache_dir() -> tempfile.TemporaryDirectory:
+    """Directory for the XGBoost external memory pages, removed when the retrain is done"""
+    return tempfile.TemporaryDirectory(prefix="xgb-external-memory-")
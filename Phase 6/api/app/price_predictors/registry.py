@@ -0,0 +1,228 @@
+import os
+import json
+import time
+import uuid
+import shutil
+import hashlib
+import logging
+import threading
+from pathlib import Path
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from typing import Callable, Dict, Iterable, List, Optional
+
+from .ingestion import LockedFile
+from .settings import MODEL_DIR, MODEL_REGISTRY_DIR, REQUIRED_FILES
+from .settings import SCALER_PATH, LR_MODEL_PATH, XGB_MODEL_PATH, MLP_MODEL_PATH, FEATURE_COLUMNS_PATH, FEATURE_LABEL_MAPPINGS_PATH
+from .settings import COMPARABLES_INDEX_PATH, EXPLANATION_BACKGROUND_PATH
+
+
+logger = logging.getLogger(__name__)
+
+# Artifact name -> file name inside a version directory
+ARTIFACT_FILES = {
+    "scaler": SCALER_PATH.name,
+    "linear_regression": LR_MODEL_PATH.name,
+    "xgboost": XGB_MODEL_PATH.name,
+    "mlp": MLP_MODEL_PATH.name,
+    "feature_columns": FEATURE_COLUMNS_PATH.name,
+    "label_mappings": FEATURE_LABEL_MAPPINGS_PATH.name,
+}
+# Artifacts a version may or may not have
+OPTIONAL_ARTIFACT_FILES = {
+    "comparables": COMPARABLES_INDEX_PATH.name,
+    "explanation_background": EXPLANATION_BACKGROUND_PATH.name,
+}
+METADATA_FILE = "metadata.json"
+
+
+def file_sha256(path: Path) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def link_or_copy(source: Path, destination: Path):
+    # Versions are immutable, so unchanged artifacts can share the same inode
+    try:
+        os.link(source, destination)
+    except OSError:
+        shutil.copy2(source, destination)
+
+
+class ModelRegistry:
+    """
+    Registry of immutable, versioned model bundles.
+
+    Layout:
+        versions/<version>/     model artifacts (ARTIFACT_FILES, and OPTIONAL_ARTIFACT_FILES if present) + metadata.json, never modified
+        versions/<version>/serving/   arrays exported from the artifacts for shared-memory serving (serving_export.py)
+        active.json             {"version": <active version>, "history": [<previously active versions>...]}
+
+    A version directory is fully written under a temporary name and renamed into place, and
+    active.json is replaced atomically, so readers always see complete bundles.
+    """
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self.versions_dir = self.path / "versions"
+        self.active_path = self.path / "active.json"
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def _locked(self):
+        """Exclusive lock on active.json for this process (thread lock) and others (file lock)"""
+        with self._lock:
+            self.path.mkdir(parents=True, exist_ok=True)
+            with open(self.path / "registry.lock", "a+b") as f, LockedFile(f):
+                yield
+
+    # Versions
+    def version_dir(self, version: str) -> Path:
+        return self.versions_dir / version
+
+    def has_version(self, version: str) -> bool:
+        return not version.startswith(".") and "/" not in version and "\\" not in version and (self.version_dir(version) / METADATA_FILE).exists()
+
+    def get_metadata(self, version: str) -> Dict:
+        if not self.has_version(version):
+            raise KeyError(f"Model version {version} not found")
+        with open(self.version_dir(version) / METADATA_FILE) as f:
+            return json.load(f)
+
+    def list_versions(self) -> List[Dict]:
+        """Metadata of every version, oldest first"""
+        if not self.versions_dir.exists():
+            return []
+        versions = [self.get_metadata(path.name) for path in self.versions_dir.iterdir() if self.has_version(path.name)]
+        return sorted(versions, key=lambda metadata: metadata["created_at"])
+
+    def create_version(self,
+                       save_artifacts: Callable[[Path], None],
+                       metrics: Optional[Dict] = None,
+                       parent_version: Optional[str] = None,
+                       inherit: Iterable[str] = (),
+                       source: str = "retrain",
+                       extra: Optional[Dict] = None) -> str:
+        """
+        Create a new version. `save_artifacts(directory)` writes the new artifacts into `directory`,
+        the artifacts named in `inherit` (e.g. a model that was not retrained) are taken from `parent_version`.
+        """
+        version = f"{datetime.now(timezone.utc):%Y%m%dT%H%M%S}-{uuid.uuid4().hex[:6]}"
+        self.versions_dir.mkdir(parents=True, exist_ok=True)
+        tmp_dir = self.versions_dir / f".tmp-{version}"
+        tmp_dir.mkdir()
+        try:
+            save_artifacts(tmp_dir)
+            for name in inherit:
+                if parent_version is None:
+                    raise ValueError(f"Can not inherit {name} without a parent version")
+                file = ARTIFACT_FILES.get(name) or OPTIONAL_ARTIFACT_FILES[name]
+                link_or_copy(self.version_dir(parent_version) / file, tmp_dir / file)
+            # Label mappings are not produced by training, keep the current ones
+            if not (tmp_dir / ARTIFACT_FILES["label_mappings"]).exists():
+                link_or_copy(FEATURE_LABEL_MAPPINGS_PATH, tmp_dir / ARTIFACT_FILES["label_mappings"])
+
+            missing = [file for file in ARTIFACT_FILES.values() if not (tmp_dir / file).exists()]
+            if missing:
+                raise ValueError(f"Model version {version} is missing {missing}")
+            artifact_files = {**ARTIFACT_FILES, **{name: file for name, file in OPTIONAL_ARTIFACT_FILES.items() if (tmp_dir / file).exists()}}
+
+            metadata = {
+                "version": version,
+                "created_at": time.time(),
+                "source": source,
+                "parent_version": parent_version,
+                "metrics": metrics,
+                "artifacts": {name: {"file": file, "sha256": file_sha256(tmp_dir / file)} for name, file in artifact_files.items()},
+                **(extra or {}),
+            }
+            with open(tmp_dir / METADATA_FILE, "w") as f:
+                json.dump(metadata, f, indent=1)
+            os.rename(tmp_dir, self.version_dir(version))
+        except Exception:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            raise
+        logger.info("Created model version %s", version)
+        return version
+
+    def import_legacy_models(self, model_dir: Path = MODEL_DIR) -> str:
+        """Register the models found directly in trained_models/ (as exported by the notebooks) as a version"""
+        for file in REQUIRED_FILES:
+            if not file.exists():
+                raise RuntimeError(f"Required file {file} not found. Please check your trained_models directory.")
+
+        def save_artifacts(directory: Path):
+            for file in ARTIFACT_FILES.values():
+                link_or_copy(model_dir / file, directory / file)
+            for file in OPTIONAL_ARTIFACT_FILES.values():
+                if (model_dir / file).exists():
+                    link_or_copy(model_dir / file, directory / file)
+
+        return self.create_version(save_artifacts, source="legacy import")
+
+    # Activation
+    def _read_active(self) -> Dict:
+        if not self.active_path.exists():
+            return {"version": None, "history": []}
+        with open(self.active_path) as f:
+            return json.load(f)
+
+    def _write_active(self, active: Dict):
+        tmp_path = self.path / f"active.json.{uuid.uuid4().hex}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(active, f, indent=1)
+        os.replace(tmp_path, self.active_path)
+
+    def active_version(self) -> Optional[str]:
+        return self._read_active()["version"]
+
+    def ensure_active_version(self) -> str:
+        """The active version, registering the legacy trained_models/ files on the very first start"""
+        with self._locked():
+            active = self._read_active()
+            if active["version"] is None:
+                versions = self.list_versions()
+                version = versions[-1]["version"] if versions else self.import_legacy_models()
+                self._write_active({"version": version, "history": []})
+                return version
+            return active["version"]
+
+    def activate(self, version: str) -> str:
+        if not self.has_version(version):
+            raise KeyError(f"Model version {version} not found")
+        with self._locked():
+            active = self._read_active()
+            if active["version"] != version:
+                if active["version"] is not None:
+                    active["history"].append(active["version"])
+                active["version"] = version
+                self._write_active(active)
+        return version
+
+    def previous_version(self) -> Optional[str]:
+        """The version a rollback would activate"""
+        active = self._read_active()
+        for version in reversed(active["history"]):
+            if version != active["version"] and self.has_version(version):
+                return version
+        return None
+
+    def rollback(self, expected_version: Optional[str] = None) -> str:
+        """Re-activate the version that was active before the current one"""
+        with self._locked():
+            active = self._read_active()
+            while active["history"]:
+                version = active["history"].pop()
+                if version != active["version"] and self.has_version(version):
+                    if expected_version is not None and version != expected_version:
+                        raise ValueError(f"Expected to roll back to {expected_version} but the previous version is {version}")
+                    active["version"] = version
+                    self._write_active(active)
+                    return version
+        raise ValueError("There is no previous model version to roll back to")
+
+
+MODEL_REGISTRY = ModelRegistry(MODEL_REGISTRY_DIR)
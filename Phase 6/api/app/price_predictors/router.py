@@ -1,14 +1,95 @@
-import pandas as pd
+import os
+import time
+import asyncio
+import tempfile
+import functools
+import numpy as np
+from contextvars import ContextVar
+from typing import Dict, List, Literal, Optional, Union
 from fastapi import status
-from fastapi import APIRouter, HTTPException
-from fastapi.responses import JSONResponse
+from fastapi import APIRouter, HTTPException, Query, Request
+from fastapi.exceptions import RequestValidationError
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+from fastapi.routing import APIRoute
+from starlette.background import BackgroundTask
+from fastapi.concurrency import run_in_threadpool
 
-from .settings import TRAINING_ROW_INSERTION_FILE_PATH, ORIGINAL_DATASET_FILE_PATH, REQUIRED_COLUMNS
-from .views import lr_predict, xgb_predict, mlp_predict, retrain
-from .data_types import LABEL_MAPPINGS, CarFeaturesWithPrice, CarFeatures, PricePredictionResult, RetrainedModelsResult, ModelMetrics
+from .settings import TRAINING_ROW_INSERTION_FILE_PATH, ORIGINAL_DATASET_FILE_PATH, REQUIRED_COLUMNS, TRAINING_DATA_STORAGE
+from .settings import MICRO_BATCHING_ENABLED, MICRO_BATCH_MAX_WAIT_MS, MICRO_BATCH_MAX_SIZE
+from .settings import PREDICTION_CACHE_ENABLED, PREDICTION_CACHE_MAX_SIZE, PREDICTION_CACHE_TTL_SECONDS
+from .settings import RETRAIN_MODE, BULK_SCORING_CHUNK_ROWS, BULK_SCORING_MAX_UPLOAD_MB
+from .settings import COMPARABLES_DEFAULT_K, COMPARABLES_MAX_K, FEATURE_COLUMNS
+from . import MODELS, activate_version, rollback_version
+from .registry import MODEL_REGISTRY
+from .views import get_serving_bundle, prepare_input, lr_predict, xgb_predict, mlp_predict, predict_scaled_batch, batch_predict, sweep_predict, explain_predictions, find_comparables
+from .views import decode_arrow_body, columnar_batch_predict
+from .wire_format import ARROW_STREAM_MEDIA_TYPE, ARROW_STREAM_BODY, is_arrow_stream, write_arrow_columns
+from .batching import MicroBatcher
+from .bulk_scoring import check_inventory, iter_scored_csv, log_progress
+from .cache import PredictionCache
+from .ingestion import append_training_rows, append_training_columns
+from .metrics import INSERTED_ROWS, INSERT_SECONDS, STAGE_VALIDATION
+from .columnar_store import get_training_store
+from .jobs import RetrainJobManager, read_job_status
+from .data_types import LABEL_MAPPINGS_JSON, LABEL_MAPPINGS_ETAG, CarFeaturesWithPrice, CarFeatures, CarFeatureLabels, PricePredictionResult, PriceSweepRequest, PriceSweepResult, PriceExplanationResult, ComparablesResult, RetrainedModelsResult, ReadinessResult, RetrainJobStatus, ModelVersionInfo
 
 
-PredictorRouter = APIRouter()
+# [time the request was received], emptied once the validation time has been reported
+_REQUEST_RECEIVED_AT: ContextVar[Optional[list]] = ContextVar("request_received_at", default=None)
+
+
+def _observe_validation():
+    received_at = _REQUEST_RECEIVED_AT.get()
+    if received_at:
+        STAGE_VALIDATION.observe(time.perf_counter() - received_at.pop())
+
+
+class ValidationTimedRoute(APIRoute):
+    """
+    Route reporting the time spent reading and validating its request body as the "validation"
+    stage of /metrics: once per request, from receiving it to calling the endpoint (or rejecting it).
+    """
+
+    def get_route_handler(self):
+        if self.body_field is None:
+            return super().get_route_handler()
+
+        endpoint = self.dependant.call
+        if asyncio.iscoroutinefunction(endpoint):
+            @functools.wraps(endpoint)
+            async def timed_endpoint(*args, **kwargs):
+                _observe_validation()
+                return await endpoint(*args, **kwargs)
+        else:
+            @functools.wraps(endpoint)
+            def timed_endpoint(*args, **kwargs):
+                _observe_validation()
+                return endpoint(*args, **kwargs)
+        self.dependant.call = timed_endpoint
+        handler = super().get_route_handler()
+
+        async def timed_handler(request: Request) -> Response:
+            token = _REQUEST_RECEIVED_AT.set([time.perf_counter()])
+            try:
+                return await handler(request)
+            except RequestValidationError:
+                _observe_validation()
+                raise
+            finally:
+                _REQUEST_RECEIVED_AT.reset(token)
+        return timed_handler
+
+
+PredictorRouter = APIRouter(route_class=ValidationTimedRoute)
+
+# Coalesces concurrent /price requests into batched model calls
+PRICE_BATCHER = MicroBatcher(predict_scaled_batch, MICRO_BATCH_MAX_WAIT_MS, MICRO_BATCH_MAX_SIZE)
+
+# Repeated /price requests for the same configuration are answered from memory
+PREDICTION_CACHE = PredictionCache(PREDICTION_CACHE_MAX_SIZE, PREDICTION_CACHE_TTL_SECONDS)
+
+# Retraining runs in a separate process, predictions keep being served meanwhile
+RETRAIN_JOBS = RetrainJobManager()
 
 
 @PredictorRouter.post("/price")
@@ -16,51 +97,304 @@ async def get_price_predictions(car_features: CarFeatures) -> PricePredictionRes
     if car_features.fuel_type == 9:
         pass
 
-    lr_prediction = lr_predict(car_features)
-    xgb_prediction = xgb_predict(car_features)
-    mlp_prediction = mlp_predict(car_features)
-    return PricePredictionResult(
+    # Every model of this request comes from the same bundle, even if a swap happens meanwhile
+    bundle = get_serving_bundle()
+
+    if PREDICTION_CACHE_ENABLED:
+        cache_key = PREDICTION_CACHE.make_key(car_features)
+        cached_result = PREDICTION_CACHE.get(cache_key, bundle.version)
+        if cached_result is not None:
+            return cached_result
+
+    # Scale once and share the same buffer between the models
+    scaled_data = prepare_input(car_features, bundle)
+    if MICRO_BATCHING_ENABLED:
+        lr_prediction, xgb_prediction, mlp_prediction = await PRICE_BATCHER.submit(scaled_data, bundle)
+    else:
+        lr_prediction = lr_predict(scaled_data, bundle)
+        xgb_prediction = xgb_predict(scaled_data, bundle)
+        mlp_prediction = mlp_predict(scaled_data, bundle)
+    result = PricePredictionResult(
         lr_prediction=lr_prediction,
         xgb_prediction=xgb_prediction,
         mlp_prediction=mlp_prediction)
 
+    if PREDICTION_CACHE_ENABLED:
+        PREDICTION_CACHE.put(cache_key, bundle.version, result)
+    return result
+
+
+@PredictorRouter.post("/explain")
+async def get_price_explanation(car_features: CarFeatures) -> PriceExplanationResult:
+    """How much each feature moves the price of each model away from the price of the average car"""
+    return (await run_in_threadpool(explain_predictions, [car_features]))[0]
+
+
+@PredictorRouter.post("/explain/batch")
+async def get_batch_price_explanations(car_features_list: List[CarFeatures]) -> List[PriceExplanationResult]:
+    """Explanations of many cars, each model explains the whole list at once. Results are in the input order."""
+    return await run_in_threadpool(explain_predictions, car_features_list)
+
+
+@PredictorRouter.post("/price/batch")
+async def get_batch_price_predictions(car_features_list: List[CarFeatures]) -> List[PricePredictionResult]:
+    """Predict prices for many cars at once. Results are returned in the same order as the input rows."""
+    return await run_in_threadpool(batch_predict, car_features_list)
+
+
+# Request body of the Arrow routes, the FastAPI route does not read it
+ARROW_REQUEST_BODY = {"requestBody": {"required": True, "content": {ARROW_STREAM_MEDIA_TYPE: ARROW_STREAM_BODY}}}
+
+
+async def read_arrow_body(request: Request, fields: List[str]) -> Dict[str, np.ndarray]:
+    """The {field: values} columns of an Arrow stream request body (see wire_format.py)"""
+    if not is_arrow_stream(request.headers.get("content-type")):
+        raise HTTPException(status_code=status.HTTP_415_UNSUPPORTED_MEDIA_TYPE,
+                            detail=f"The request body must be an Arrow stream ({ARROW_STREAM_MEDIA_TYPE})")
+    return await run_in_threadpool(decode_arrow_body, await request.body(), fields)
+
+
+@PredictorRouter.post("/price/batch/arrow", response_class=Response, openapi_extra=ARROW_REQUEST_BODY,
+                      responses={200: {"content": {ARROW_STREAM_MEDIA_TYPE: ARROW_STREAM_BODY}}})
+async def get_arrow_batch_price_predictions(request: Request):
+    """
+    /price/batch with the cars sent as an Arrow stream with one column per field, and the predictions
+    returned as one (columns lr_prediction, xgb_prediction and mlp_prediction).
+    Categorical columns may hold codes or labels.
+    """
+    columns = await read_arrow_body(request, FEATURE_COLUMNS)
+    predictions = await run_in_threadpool(columnar_batch_predict, columns)
+    return Response(await run_in_threadpool(write_arrow_columns, predictions), media_type=ARROW_STREAM_MEDIA_TYPE)
+
+
+@PredictorRouter.post("/price/batch/labels")
+async def get_labeled_batch_price_predictions(car_features_list: List[CarFeatureLabels]) -> List[PricePredictionResult]:
+    """Like /price/batch with the categorical fields given as labels (see /label_mappings) instead of codes"""
+    return await run_in_threadpool(batch_predict, car_features_list, True)
+
+
+@PredictorRouter.post("/price/sweep")
+async def get_price_sweep(sweep: PriceSweepRequest) -> PriceSweepResult:
+    """
+    What-if prices of a car with one field (price curves) or two fields (price surfaces) varied over
+    grids of values. The whole grid is scored with one batched call per model.
+    """
+    return await run_in_threadpool(sweep_predict, sweep)
+
+
+@PredictorRouter.post("/comparables")
+async def get_comparables(car_features: CarFeatures,
+                          k: int = Query(COMPARABLES_DEFAULT_K, ge=1, le=COMPARABLES_MAX_K)) -> ComparablesResult:
+    """The `k` training rows closest to the car (standardized features), with their prices"""
+    return (await run_in_threadpool(find_comparables, [car_features], k))[0]
+
+
+@PredictorRouter.post("/comparables/batch")
+async def get_batch_comparables(car_features_list: List[CarFeatures],
+                                k: int = Query(COMPARABLES_DEFAULT_K, ge=1, le=COMPARABLES_MAX_K)) -> List[ComparablesResult]:
+    """Comparables of many cars with a single index query. Results are returned in the same order as the input rows."""
+    return await run_in_threadpool(find_comparables, car_features_list, k)
+
+
+async def spool_upload(request: Request, suffix: str, max_bytes: int) -> str:
+    """Write the request body to a temporary file as it arrives, without holding it in memory"""
+    fd, path = tempfile.mkstemp(prefix="inventory-", suffix=suffix)
+    size = 0
+    try:
+        with os.fdopen(fd, "wb") as f:
+            async for piece in request.stream():
+                size += len(piece)
+                if size > max_bytes:
+                    raise HTTPException(status_code=413, detail=f"Inventory file exceeds the limit of {max_bytes // 2**20} MB")
+                await run_in_threadpool(f.write, piece)
+    except BaseException:
+        os.unlink(path)
+        raise
+    return path
+
+
+@PredictorRouter.post("/price/inventory")
+async def score_inventory_file(request: Request, format: Optional[Literal["csv", "parquet"]] = None,
+                               chunk_rows: int = BULK_SCORING_CHUNK_ROWS):
+    """
+    Score an inventory file sent as the request body: CSV, or Parquet (`format=parquet` or a
+    Parquet content type). Categorical columns may hold labels or codes. The input rows are
+    streamed back as CSV with the three predictions and an `error` column, chunk by chunk.
+    """
+    bundle = get_serving_bundle()
+    file_format = format or ("parquet" if "parquet" in request.headers.get("content-type", "") else "csv")
+    path = await spool_upload(request, f".{file_format}", BULK_SCORING_MAX_UPLOAD_MB * 2**20)
+    try:
+        await run_in_threadpool(check_inventory, path, file_format)
+    except Exception as e:
+        os.unlink(path)
+        raise HTTPException(status_code=400, detail=f"Can not read the inventory file: {e}")
+
+    return StreamingResponse(
+        iter_scored_csv(path, bundle, file_format, max(1, chunk_rows), progress=log_progress),
+        media_type="text/csv",
+        headers={"X-Model-Version": bundle.version},
+        background=BackgroundTask(os.unlink, path),
+    )
+
+
+@PredictorRouter.get("/batching_stats")
+async def get_batching_stats():
+    """Queue depth and batch-size statistics of the /price micro-batcher"""
+    return JSONResponse(PRICE_BATCHER.stats())
+
+
+@PredictorRouter.get("/cache_stats")
+async def get_cache_stats():
+    """Hit/miss/eviction counters of the /price prediction cache"""
+    return JSONResponse(PREDICTION_CACHE.stats())
+
+
+@PredictorRouter.get("/ready", response_model=ReadinessResult, responses={503: {"model": ReadinessResult}})
+async def get_readiness():
+    """Per-model load state. Responds with 503 until every model is loaded."""
+    readiness = ReadinessResult(ready=MODELS.ready, version=MODELS.version, models=MODELS.load_states)
+    return JSONResponse(
+        readiness.model_dump(),
+        status_code=status.HTTP_200_OK if readiness.ready else status.HTTP_503_SERVICE_UNAVAILABLE)
+
+
 @PredictorRouter.get("/label_mappings")
-async def get_label_mappings():
-    return JSONResponse(LABEL_MAPPINGS)
+async def get_label_mappings(request: Request):
+    """Label ➔ code of every categorical field. Clients can revalidate with If-None-Match and get a 304."""
+    headers = {"ETag": LABEL_MAPPINGS_ETAG, "Cache-Control": "no-cache"}
+    if_none_match = request.headers.get("if-none-match", "")
+    if any(tag.strip().removeprefix("W/") in (LABEL_MAPPINGS_ETAG, "*") for tag in if_none_match.split(",")):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    return Response(LABEL_MAPPINGS_JSON, media_type="application/json", headers=headers)
+
+
+def insert_training_rows(rows: Union[List[CarFeaturesWithPrice], Dict[str, np.ndarray]]) -> int:
+    """Append rows given as models or as {column: values} columns"""
+    with INSERT_SECONDS.time():
+        if TRAINING_DATA_STORAGE == "columnar":
+            store = get_training_store()
+            inserted = store.append_columns(rows) if isinstance(rows, dict) else store.append_rows(rows)
+        elif isinstance(rows, dict):
+            inserted = append_training_columns(rows, TRAINING_ROW_INSERTION_FILE_PATH)
+        else:
+            inserted = append_training_rows(rows, TRAINING_ROW_INSERTION_FILE_PATH)
+    INSERTED_ROWS.inc(inserted)
+    return inserted
 
 
 @PredictorRouter.post("/insert_row", status_code=status.HTTP_201_CREATED)
 async def add_training_row(car_features: CarFeaturesWithPrice):
-    parsed_data = dict(car_features)
-    # Create a DataFrame from the parsed input
-    new_row = pd.DataFrame([parsed_data], columns=REQUIRED_COLUMNS)
-
     try:
-        # Try loading the existing CSV
-        df_existing = pd.read_csv(TRAINING_ROW_INSERTION_FILE_PATH, index_col=False)
-    except FileNotFoundError:
-        # If file does not exist, create empty DataFrame
-        df_existing = pd.DataFrame(columns=REQUIRED_COLUMNS)
-    
-    # Concatenate the old data with the new row
-    df_final = pd.concat([df_existing, new_row])
-
-    # Save back to CSV
-    df_final.to_csv(TRAINING_ROW_INSERTION_FILE_PATH, index=False)
+        # Appends the row instead of rewriting the whole dataset
+        await run_in_threadpool(insert_training_rows, [car_features])
+    except ValueError as e:
+        raise HTTPException(status_code=500, detail=str(e))
 
     return JSONResponse({"message": "Row inserted successfully."})
 
 
+@PredictorRouter.post("/insert_rows", status_code=status.HTTP_201_CREATED)
+async def add_training_rows(car_features_list: List[CarFeaturesWithPrice]):
+    """Insert many training rows at once with a single append"""
+    try:
+        inserted = await run_in_threadpool(insert_training_rows, car_features_list)
+    except ValueError as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+    return JSONResponse({"message": f"{inserted} rows inserted successfully.", "inserted": inserted})
+
+
+@PredictorRouter.post("/insert_rows/arrow", status_code=status.HTTP_201_CREATED, openapi_extra=ARROW_REQUEST_BODY)
+async def add_arrow_training_rows(request: Request):
+    """/insert_rows with the rows sent as an Arrow stream with one column per field, like /price/batch/arrow"""
+    columns = await read_arrow_body(request, REQUIRED_COLUMNS)
+    try:
+        inserted = await run_in_threadpool(insert_training_rows, columns)
+    except ValueError as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+    return JSONResponse({"message": f"{inserted} rows inserted successfully.", "inserted": inserted})
+
+
+def model_version_info(metadata: dict, active_version: str) -> ModelVersionInfo:
+    return ModelVersionInfo(
+        version=metadata["version"],
+        created_at=metadata["created_at"],
+        source=metadata["source"],
+        parent_version=metadata.get("parent_version"),
+        training_mode=metadata.get("training_mode"),
+        active=metadata["version"] == active_version,
+        metrics=metadata.get("metrics"),
+        hyperparameters=metadata.get("hyperparameters"),
+        artifacts={name: artifact["sha256"] for name, artifact in metadata["artifacts"].items()},
+    )
+
+
+@PredictorRouter.get("/models", response_model=List[ModelVersionInfo])
+async def list_model_versions():
+    """Every model version in the registry, oldest first"""
+    active_version = MODEL_REGISTRY.active_version()
+    return [model_version_info(metadata, active_version) for metadata in await run_in_threadpool(MODEL_REGISTRY.list_versions)]
+
+
+@PredictorRouter.post("/models/{version}/activate", response_model=ModelVersionInfo)
+async def activate_model_version(version: str):
+    """Serve a model version. Only the models that differ from the loaded ones are read from disk."""
+    if not MODEL_REGISTRY.has_version(version):
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Model version {version} not found")
+    try:
+        bundle = await run_in_threadpool(activate_version, version)
+    except RuntimeError as e:
+        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(e))
+    return model_version_info(bundle.metadata, bundle.version)
+
+
+@PredictorRouter.post("/models/rollback", response_model=ModelVersionInfo)
+async def rollback_model_version():
+    """Go back to the model version that was served before the current one"""
+    try:
+        bundle = await run_in_threadpool(rollback_version)
+    except ValueError as e:
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail=str(e))
+    except RuntimeError as e:
+        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(e))
+    return model_version_info(bundle.metadata, bundle.version)
+
+
+@PredictorRouter.post("/retrain_jobs", status_code=status.HTTP_202_ACCEPTED, response_model=RetrainJobStatus)
+async def start_retrain_job(mode: Literal["full", "incremental", "auto", "tune"] = RETRAIN_MODE):
+    """
+    Start retraining the models in the background. Poll `/retrain_jobs/{job_id}` for the progress.
+    `incremental` only trains on the rows added since the active version, `auto` refits from scratch when due.
+    `tune` searches the XGBoost and MLP hyperparameters before refitting from scratch.
+    """
+    try:
+        job_status, _ = RETRAIN_JOBS.start(mode=mode)
+    except RuntimeError as e:
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail=str(e))
+    return job_status
+
+
+@PredictorRouter.get("/retrain_jobs/{job_id}", response_model=RetrainJobStatus)
+async def get_retrain_job(job_id: str):
+    """Progress, per-stage timings and final metrics of a retraining job"""
+    job_status = read_job_status(job_id)
+    if job_status is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Retrain job {job_id} not found")
+    return job_status
+
 
-##############################################################################
-# Under construction. Caution this might not be safe 
-##############################################################################
-# TODO: Properly test and implement this so that:
-#  - new models are stored along side the previous ones
-#  - choose between which trained model to use. (maybe versioning will be useful)
-#  - Schedule retraining at midnight (maybe)
 @PredictorRouter.post("/__retrain_models__", response_model=RetrainedModelsResult)
-async def retrain_models() -> ModelMetrics:
-    """Under construction. **Caution:** this is not safe it will overwrite existing models both in memory and on disk"""
-    res = retrain([ORIGINAL_DATASET_FILE_PATH, TRAINING_ROW_INSERTION_FILE_PATH])
-    return res['metrics']
+async def retrain_models() -> RetrainedModelsResult:
+    """Retrains the models, stores them as a new version and serves it. Use `/models/rollback` to undo."""
+    # Runs as a background job, predictions are still served while waiting for it
+    try:
+        _, job_future = RETRAIN_JOBS.start()
+    except RuntimeError as e:
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail=str(e))
+
+    job_status = await asyncio.wrap_future(job_future)
+    if job_status.status != "succeeded":
+        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=job_status.error)
+    return job_status.result
@@ -0,0 +1,127 @@
+import os
+import json
+import uuid
+import shutil
+import logging
+import multiprocessing
+import numpy as np
+from pathlib import Path
+from typing import Dict, Tuple
+
+from .ingestion import LockedFile
+from .registry import MODEL_REGISTRY, ARTIFACT_FILES
+from .mlp_serving import NumpyMLP, check_parity as check_mlp_parity
+from .xgb_serving import FlatTreeEnsemble, FLAT_EVALUATOR_AVAILABLE, check_parity as check_xgb_parity
+from .settings import MLP_PARITY_ATOL, XGB_PARITY_ATOL, XGB_SMALL_BATCH_ROWS
+
+
+logger = logging.getLogger(__name__)
+
+# Serving export of a registry version: versions/<version>/serving/
+#   manifest.json           MLP activations, XGBoost base score, which models were exported
+#   scaler_*.npy, lr_*.npy  scaler statistics and linear regression coefficients
+#   mlp_<i>_*.npy           Dense layers of the MLP (see NumpyMLP)
+#   xgb_*.npy               flat tree arrays of the XGBoost model (see FlatTreeEnsemble)
+# The arrays are memory-mapped read-only when serving, so every worker process maps the same
+# page cache instead of holding its own copy of the weights, and none of them imports TensorFlow.
+EXPORT_DIR_NAME = "serving"
+MANIFEST_FILE = "manifest.json"
+
+
+def export_dir(version: str) -> Path:
+    return MODEL_REGISTRY.version_dir(version) / EXPORT_DIR_NAME
+
+
+def has_serving_export(version: str) -> bool:
+    return (export_dir(version) / MANIFEST_FILE).exists()
+
+
+def write_serving_export(version: str):
+    """
+    Write the serving export of a registry version (atomically, like the version itself).
+    Loads the full models, TensorFlow included, so the API runs it in a separate process.
+    """
+    import tensorflow as tf
+    from . import read_scaler, read_linear_regression, read_xgboost
+
+    version_dir = MODEL_REGISTRY.version_dir(version)
+    scaler = read_scaler(version_dir / ARTIFACT_FILES["scaler"])
+    lr_model = read_linear_regression(version_dir / ARTIFACT_FILES["linear_regression"])
+    arrays = {
+        "scaler_mean": np.asarray(scaler.mean_, dtype=np.float32),
+        "scaler_scale": np.asarray(scaler.scale_, dtype=np.float32),
+        "lr_coef": np.asarray(lr_model.coef_, dtype=np.float64).reshape(-1),
+        "lr_intercept": np.asarray(np.ravel(lr_model.intercept_)[:1], dtype=np.float64),
+    }
+    manifest = {"version": version, "mlp_activations": None, "xgb_base_score": None, "errors": {}}
+
+    # Models that can not be exported (or do not match their original) are loaded by each worker instead
+    try:
+        mlp_model = tf.keras.models.load_model(version_dir / ARTIFACT_FILES["mlp"])
+        mlp = NumpyMLP.from_keras(mlp_model)
+        check_mlp_parity(mlp_model, mlp.predict, MLP_PARITY_ATOL)
+        for i, (kernel, bias, _) in enumerate(mlp.layers):
+            arrays[f"mlp_{i}_kernel"] = kernel
+            arrays[f"mlp_{i}_bias"] = bias
+        manifest["mlp_activations"] = [activation for _, _, activation in mlp.layers]
+    except Exception as e:
+        logger.warning("MLP of version %s not exported: %s", version, e)
+        manifest["errors"]["mlp"] = str(e)
+
+    try:
+        if not FLAT_EVALUATOR_AVAILABLE:
+            raise RuntimeError("the flat tree evaluator requires numba")
+        xgb_model = read_xgboost(version_dir / ARTIFACT_FILES["xgboost"])
+        ensemble = FlatTreeEnsemble.from_booster(xgb_model.get_booster())
+        check_xgb_parity(xgb_model, ensemble.predict, XGB_PARITY_ATOL, XGB_SMALL_BATCH_ROWS)
+        for name in FlatTreeEnsemble.ARRAYS:
+            arrays[f"xgb_{name}"] = getattr(ensemble, name)
+        manifest["xgb_base_score"] = float(ensemble.base_score)
+    except Exception as e:
+        logger.warning("XGBoost model of version %s not exported: %s", version, e)
+        manifest["errors"]["xgboost"] = str(e)
+
+    destination = export_dir(version)
+    tmp_dir = version_dir / f".tmp-{EXPORT_DIR_NAME}-{uuid.uuid4().hex[:6]}"
+    tmp_dir.mkdir()
+    try:
+        for name, array in arrays.items():
+            np.save(tmp_dir / f"{name}.npy", np.ascontiguousarray(array))
+        with open(tmp_dir / MANIFEST_FILE, "w") as f:
+            json.dump(manifest, f, indent=2)
+        os.rename(tmp_dir, destination)
+    except OSError:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        # Another process exported the same version first
+        if not has_serving_export(version):
+            raise
+    except BaseException:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+
+
+def ensure_serving_export(version: str):
+    """Write the serving export of `version` if no process did it yet"""
+    if has_serving_export(version):
+        return
+    MODEL_REGISTRY.path.mkdir(parents=True, exist_ok=True)
+    with open(MODEL_REGISTRY.path / "export.lock", "a+b") as f, LockedFile(f):
+        if has_serving_export(version):
+            return
+        # spawn: the serving processes never import TensorFlow, only the exporting one does
+        process = multiprocessing.get_context("spawn").Process(
+            target=write_serving_export, args=(version,), name=f"serving-export-{version}")
+        process.start()
+        process.join()
+        if not has_serving_export(version):
+            raise RuntimeError(f"Could not export model version {version} for serving (exit code {process.exitcode})")
+
+
+def load_serving_export(version: str) -> Tuple[Dict, Dict[str, np.ndarray]]:
+    """Manifest and read-only memory-mapped arrays of the serving export of `version`"""
+    path = export_dir(version)
+    with open(path / MANIFEST_FILE) as f:
+        manifest = json.load(f)
+    # np.asarray drops the np.memmap subclass but keeps the mapping, so numba sees plain arrays
+    arrays = {file.stem: np.asarray(np.load(file, mmap_mode="r")) for file in path.glob("*.npy")}
+    return manifest, arrays
@@ -1,3 +1,4 @@
+import os
 from pathlib import Path
 
 
@@ -39,6 +40,136 @@ if not TRAINING_ROW_INSERTION_FILE_PATH.exists():
 		f.write("\n")
 	
 
+# Columnar training data store (see columnar_store.py) which replaces the CSV files above.
+# The CSV files are imported into it once, when the API starts (import_training_datasets).
+#  - "columnar": /insert_row(s) and retrain use the columnar store
+#  - "csv": /insert_row(s) append to TRAINING_ROW_INSERTION_FILE_PATH and retrain parses the CSV files
+TRAINING_DATA_STORAGE = "columnar"
+COLUMNAR_STORE_DIR = DATASET_DIR / 'columnar'
+# Inserted rows are stored as small segments, merged back into the columns once there are this many
+COLUMNAR_COMPACTION_MIN_SEGMENTS = 64
+COLUMN_DTYPES = {
+	"engine_type": "int32",
+	"fuel_type": "int32",
+	"transmission": "int32",
+	"body_type": "int32",
+	"has_incidents": "int32",
+	"wheel_system": "int32",
+	"horsepower": "float64",
+	"maximum_seating": "int32",
+	"mileage": "float64",
+	"torque": "float64",
+	"year": "int32",
+	"combined_fuel_economy": "float64",
+	"legroom": "float64",
+	"major_options_count": "float64",
+	"size_of_vehicle": "float64",
+	"price": "float64",
+}
+
+
+# Status files of the background retraining jobs (see jobs.py)
+RETRAIN_JOBS_DIR = CWD / "retrain_jobs"
+
+# How retraining uses the data (see training.py)
+#  - "full": every model is refit from scratch on the whole dataset
+#  - "incremental": only the rows added since the active version are used, the scaler and the linear
+#    regression are updated from running statistics, XGBoost keeps boosting and the MLP keeps training
+#  - "auto": incremental, with a full refit when one is due (see below) or the new rows drifted
+#  - "tune": a full refit preceded by a hyperparameter search (see TUNING_* below and tuning.py)
+RETRAIN_MODE = "auto"
+# A full refit is due after this many incremental versions in a row, or when the last one is this old
+FULL_REFIT_MAX_INCREMENTS = 20
+FULL_REFIT_MAX_AGE_HOURS = 7 * 24
+# ... or when the new rows would be more than this fraction of the data the models have seen
+FULL_REFIT_MAX_NEW_ROWS_RATIO = 0.5
+# ... or when a feature/target mean of the new rows moved by more than this many standard deviations
+# (only checked once there are RETRAIN_DRIFT_MIN_ROWS new rows)
+RETRAIN_DRIFT_THRESHOLD = 0.5
+RETRAIN_DRIFT_MIN_ROWS = 100
+# XGBoost training profile used by retrain (see train_xgboost in training.py)
+#  - "legacy": the original setup, XGBRegressor.fit on the pandas frame without early stopping
+#  - "hist": histogram tree method with max_bin bins on all cores. The QuantileDMatrix is built
+#    once from float32 arrays and boosting stops once the RMSE on a held out part of the training
+#    rows has not improved for early_stopping_rounds rounds (trees after the best round are dropped)
+XGB_TRAINING_PROFILE = "hist"
+XGB_TRAINING_PROFILES = {
+	"legacy": {
+		"n_estimators": 512,
+		"params": {"max_depth": 24, "max_leaves": 800, "learning_rate": 0.125, "gamma": 0.005, "random_state": 31},
+	},
+	"hist": {
+		"n_estimators": 512,
+		"params": {"max_depth": 24, "max_leaves": 800, "learning_rate": 0.125, "gamma": 0.005, "random_state": 31,
+				   "tree_method": "hist", "max_bin": 256, "n_jobs": os.cpu_count()},
+		"quantile_dmatrix": True,
+		"early_stopping_rounds": 20,
+		"validation_fraction": 0.1,
+		# early stopping is skipped when the validation part would be smaller than this
+		"min_validation_rows": 100,
+	},
+}
+# Full refits that would need more than RETRAIN_MEMORY_BUDGET_MB run out of core (see out_of_core.py):
+# the data is streamed in chunks sized to the budget, XGBoost caches its quantized data on disk and
+# the MLP trains from a tf.data pipeline. True or False forces one way or the other.
+RETRAIN_OUT_OF_CORE = "auto"
+RETRAIN_MEMORY_BUDGET_MB = 1024
+# The models of a retrain are fit at the same time (RETRAIN_PARALLEL), XGBoost on RETRAIN_XGB_THREADS
+# cores and TensorFlow on RETRAIN_MLP_THREADS so that their thread pools do not compete for the same
+# cores. Out-of-core refits always fit them one after the other.
+RETRAIN_PARALLEL = True
+RETRAIN_MLP_THREADS = max(1, os.cpu_count() // 4)
+RETRAIN_XGB_THREADS = max(1, os.cpu_count() - RETRAIN_MLP_THREADS)
+# Extra boosting rounds and MLP epochs of an incremental retrain
+INCREMENTAL_XGB_ROUNDS = 32
+INCREMENTAL_MLP_EPOCHS = 3
+INCREMENTAL_MLP_LEARNING_RATE = 1e-4
+# MLP of a full refit (see new_mlp_model in training.py): Dense layers of these sizes, each followed by dropout
+MLP_TRAINING_PARAMS = {"hidden_layers": [64, 32], "dropout": 0.3, "learning_rate": 0.001, "epochs": 5, "batch_size": 512}
+
+# Hyperparameter search of retrain(mode="tune"), see tuning.py. Successive halving: `configs` random
+# configurations of each model (and the current one) are scored by cross-validation with a budget of
+# boosting rounds / epochs, the best 1/TUNING_ETA of them go on with TUNING_ETA times the budget, up to
+# `max_budget`. The winner is recorded in the metadata of the version ("hyperparameters") and used by
+# every full refit that follows, instead of the XGB_TRAINING_PROFILE params and MLP_TRAINING_PARAMS.
+# Space entries are ("int" | "float" | "log", low, high) ranges or ("choice", [values]).
+TUNING_SEARCH_SPACES = {
+	"xgboost": {
+		"configs": 27, "min_budget": 32, "max_budget": 512,
+		"space": {
+			"max_depth": ("int", 4, 24),
+			"max_leaves": ("int", 32, 1024),
+			"learning_rate": ("log", 0.02, 0.3),
+			"gamma": ("log", 1e-4, 0.1),
+			"min_child_weight": ("log", 0.5, 32),
+			"subsample": ("float", 0.6, 1.0),
+			"colsample_bytree": ("float", 0.6, 1.0),
+		},
+	},
+	"mlp": {
+		"configs": 9, "min_budget": 1, "max_budget": 9,
+		"space": {
+			"hidden_layers": ("choice", [[32], [64, 32], [128, 64], [128, 64, 32], [256, 128]]),
+			"dropout": ("float", 0.0, 0.4),
+			"learning_rate": ("log", 1e-4, 3e-3),
+			"batch_size": ("choice", [256, 512, 1024]),
+		},
+	},
+}
+TUNING_ETA = 3
+TUNING_FOLDS = 3
+# The search runs on a uniform sample of at most this many training rows
+TUNING_MAX_ROWS = 200_000
+# No new rung is started after this many seconds, the winner is then the best of the last finished rung
+TUNING_MAX_SECONDS = 3600
+# Trials run in TUNING_WORKERS processes with TUNING_WORKER_THREADS threads each
+TUNING_WORKERS = max(1, os.cpu_count() // 2)
+TUNING_WORKER_THREADS = max(1, os.cpu_count() // TUNING_WORKERS)
+TUNING_SEED = 31
+# Prepared data and trial results of the searches, an interrupted search resumes from the finished trials
+TUNING_DIR = CWD / "tuning"
+
+
 # Files related the model
 FEATURE_COLUMNS_PATH = MODEL_DIR / 'feature_columns.json'
 FEATURE_LABEL_MAPPINGS_PATH = MODEL_DIR / 'label_mappings.json'
@@ -48,6 +179,95 @@ LR_MODEL_PATH = MODEL_DIR / 'lr_price_prediction.pkl'
 XGB_MODEL_PATH = MODEL_DIR / 'xgb_price_prediction.ubj'
 MLP_MODEL_PATH = MODEL_DIR / 'mlp_price_prediction.keras'
 SCALER_PATH = MODEL_DIR / 'scaler_price_prediction.pkl'
+# Optional, see COMPARABLES_ENABLED and EXPLANATION_BACKGROUND_ROWS
+COMPARABLES_INDEX_PATH = MODEL_DIR / 'comparables_index.joblib'
+EXPLANATION_BACKGROUND_PATH = MODEL_DIR / 'explanation_background.npy'
+
+# Versioned model bundles (see registry.py). The files above are registered as the first
+# version when the registry is empty, retraining creates new versions instead of overwriting them.
+MODEL_REGISTRY_DIR = MODEL_DIR / 'registry'
+
+
+# Upper bound of rows accepted by the /price/batch endpoint in a single call
+BATCH_PREDICTION_MAX_ROWS = 50_000
+
+# Upper bound of grid points of a /price/sweep request (product of the lengths of its grids)
+SWEEP_MAX_POINTS = 20_000
+
+# Bulk scoring of inventory files (see bulk_scoring.py and /price/inventory)
+# Files are read, scored and written BULK_SCORING_CHUNK_ROWS rows at a time. Uploads to
+# /price/inventory are spooled to a temporary file of at most BULK_SCORING_MAX_UPLOAD_MB.
+# Parquet files require pyarrow.
+BULK_SCORING_CHUNK_ROWS = 50_000
+BULK_SCORING_MAX_UPLOAD_MB = 2048
+
+# Comparable vehicles (see comparables.py and /comparables)
+# Full refits build a KD-tree over the scaled FEATURE_COLUMNS of every training row, saved with the
+# models of the version and memory-mapped when the version is loaded (shared by the worker processes).
+# Incremental retrains keep the index of their parent version, new rows are indexed by the next full refit.
+COMPARABLES_ENABLED = True
+COMPARABLES_LEAF_SIZE = 40
+COMPARABLES_DEFAULT_K = 10
+COMPARABLES_MAX_K = 100
+COMPARABLES_MAX_BATCH_ROWS = 1_000
+
+# Per-prediction explanations (see explanations.py and /explain)
+# Retrain samples EXPLANATION_BACKGROUND_ROWS training rows, the "average car" the feature contributions
+# are measured from, and saves them with the models of the version. The MLP attributions average the
+# gradients at EXPLANATION_MLP_STEPS points between each background row and the explained row.
+EXPLANATION_BACKGROUND_ROWS = 64
+EXPLANATION_MLP_STEPS = 4
+EXPLAIN_MAX_BATCH_ROWS = 1_000
+
+# Micro-batching of concurrent /price requests (see batching.py)
+# Requests arriving within MICRO_BATCH_MAX_WAIT_MS of each other are scored together,
+# up to MICRO_BATCH_MAX_SIZE rows per model call.
+MICRO_BATCHING_ENABLED = True
+MICRO_BATCH_MAX_WAIT_MS = 2.0
+MICRO_BATCH_MAX_SIZE = 256
+
+# How the MLP is evaluated when serving predictions (see mlp_serving.py)
+#  - "keras": MLP_MODEL.predict
+#  - "numpy": weights are read from the keras model once and the forward pass runs as NumPy matmuls
+#  - "tf_function": the keras model traced once with a fixed input signature
+# "numpy" and "tf_function" are checked against keras predict on load and fall back to "keras"
+# when the outputs differ by more than MLP_PARITY_ATOL (the saved model computes in float16).
+MLP_SERVING_MODE = "numpy"
+MLP_PARITY_ATOL = 5e-2
+
+# How the XGBoost model is evaluated when serving predictions (see xgb_serving.py)
+#  - "predict": XGB_MODEL.predict, builds a DMatrix on every call
+#  - "inplace": booster.inplace_predict straight on the float32 rows
+#  - "flat": batches of up to XGB_SMALL_BATCH_ROWS rows are scored by an array-backed copy of the
+#    trees compiled with numba, larger ones with inplace_predict (inplace_predict only without numba)
+# Batches of up to XGB_SMALL_BATCH_ROWS rows run on a single thread, larger ones on XGB_SERVING_THREADS.
+# "inplace" and "flat" are checked against XGB_MODEL.predict on load and fall back to it when the
+# outputs differ by more than XGB_PARITY_ATOL.
+XGB_SERVING_MODE = "flat"
+XGB_SERVING_THREADS = os.cpu_count()
+XGB_SMALL_BATCH_ROWS = 64
+XGB_PARITY_ATOL = 1e-3
+
+# Serving with several worker processes (see gunicorn.conf.py, which enables it)
+# The models are served from a "serving export" of each version (see serving_export.py): plain
+# arrays memory-mapped read-only, so all the workers share one copy of the weights. Every worker
+# checks the registry every MODEL_WATCH_INTERVAL_SECONDS and switches to the version activated by
+# a retrain or rollback done in another worker (0 disables it).
+SHARED_MODEL_MEMORY = os.environ.get("SHARED_MODEL_MEMORY", "0") == "1"
+MODEL_WATCH_INTERVAL_SECONDS = 2.0
+
+# Prometheus metrics served on /api/v1/metrics (see metrics.py)
+# Timing the request stages costs two perf_counter calls and a histogram update per stage.
+# Several worker processes share their values through the multiprocess mode of prometheus_client,
+# gunicorn.conf.py points PROMETHEUS_MULTIPROC_DIR to METRICS_DIR.
+METRICS_ENABLED = True
+METRICS_DIR = CWD / "metrics"
+
+# LRU + TTL cache in front of /price (see cache.py)
+# Entries are dropped automatically when the serving models change.
+PREDICTION_CACHE_ENABLED = True
+PREDICTION_CACHE_MAX_SIZE = 10_000
+PREDICTION_CACHE_TTL_SECONDS = 15 * 60
 
 
 #############################################################################
@@ -0,0 +1,678 @@
+############################################################################################
+# Model retraining functions
+# can be put in a separate script to schedule using `systemd` or `crontab`
+#
+# This module pulls in the keras training stack, so it is only imported when a retrain runs.
+############################################################################################
+import copy
+import json
+import time
+import joblib
+import tempfile
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pandas as pd
+import xgboost as xgb
+
+from sklearn.preprocessing import StandardScaler
+from sklearn.linear_model import LinearRegression
+from sklearn.model_selection import train_test_split
+from sklearn.metrics import mean_absolute_error, r2_score, root_mean_squared_error, mean_squared_error
+
+from . import MODELS, ModelBundle, read_scaler, read_linear_regression, read_xgboost
+from .registry import MODEL_REGISTRY, ARTIFACT_FILES, OPTIONAL_ARTIFACT_FILES, link_or_copy
+from .comparables import build_comparables_index, read_comparables
+from .explanations import save_background
+from .tuning import default_hyperparameters, search_hyperparameters
+from .incremental import compute_training_stats, merge_training_stats, training_stats_to_json, training_stats_from_json
+from .incremental import linear_regression_from_stats, drift_score, rescale_xgboost_splits, rescale_mlp_inputs
+from .settings import REQUIRED_COLUMNS, FEATURE_COLUMNS, TARGET_COLUMNS, COMBINED_DATASET_LATEST_FILE_PATH
+from .settings import RETRAIN_MODE, FULL_REFIT_MAX_INCREMENTS, FULL_REFIT_MAX_AGE_HOURS, FULL_REFIT_MAX_NEW_ROWS_RATIO
+from .settings import RETRAIN_DRIFT_THRESHOLD, RETRAIN_DRIFT_MIN_ROWS, INCREMENTAL_XGB_ROUNDS, INCREMENTAL_MLP_EPOCHS, INCREMENTAL_MLP_LEARNING_RATE
+from .settings import XGB_TRAINING_PROFILE, XGB_TRAINING_PROFILES, RETRAIN_OUT_OF_CORE, RETRAIN_MEMORY_BUDGET_MB
+from .settings import RETRAIN_PARALLEL, RETRAIN_XGB_THREADS, RETRAIN_MLP_THREADS, COMPARABLES_ENABLED, EXPLANATION_BACKGROUND_ROWS
+from .settings import MLP_TRAINING_PARAMS, TUNING_MAX_ROWS, TUNING_SEED
+from .out_of_core import ChunkedTrainingData, StreamingMetrics, chunk_rows_for_budget, estimate_in_memory_bytes
+from .out_of_core import training_stats_pass, scaler_from_stats, linear_regression_from_training_stats, sample_rows, SPLITS
+from .out_of_core import xgboost_data_iter, mlp_dataset, external_memory_cache_dir
+
+
+def evaluate_model(y_true, y_pred):
+	return {
+		"mse": float(mean_squared_error(y_true, y_pred)),
+		"mae": float(mean_absolute_error(y_true, y_pred)),
+		"rmse": float(root_mean_squared_error(y_true, y_pred)),
+		"r2": float(r2_score(y_true, y_pred))
+	}
+
+
+def train_xgboost(X_train, y_train, profile=XGB_TRAINING_PROFILE, xgb_model=None, n_estimators=None, n_jobs=None, hyperparameters=None):
+	"""
+	Train an XGBRegressor with one of XGB_TRAINING_PROFILES (see settings.py).
+	`xgb_model` is a booster to keep boosting from, `n_estimators` overrides the number of rounds of the profile
+	and `n_jobs` its number of threads. `hyperparameters` override its rounds and params (see xgb_training_profile).
+	"""
+	profile = xgb_training_profile(profile, hyperparameters)
+	if n_jobs:
+		profile = dict(profile, params=dict(profile["params"], n_jobs=n_jobs))
+	n_estimators = n_estimators or profile["n_estimators"]
+	if not profile.get("quantile_dmatrix"):
+		model = xgb.XGBRegressor(n_estimators=n_estimators, **profile["params"])
+		model.fit(X_train, y_train, xgb_model=xgb_model)
+		return model
+
+	# Native API so the quantized matrix is built exactly once, from float32 arrays
+	X_train = np.ascontiguousarray(X_train, dtype=np.float32)
+	y_train = np.asarray(y_train, dtype=np.float32).reshape(-1)
+	params = xgb_native_params(profile)
+
+	early_stopping_rounds = profile.get("early_stopping_rounds")
+	if early_stopping_rounds and int(len(X_train) * profile["validation_fraction"]) >= profile.get("min_validation_rows", 1):
+		X_fit, X_valid, y_fit, y_valid = train_test_split(X_train, y_train, test_size=profile["validation_fraction"], random_state=31)
+	else:
+		X_fit, y_fit, early_stopping_rounds = X_train, y_train, None
+
+	dtrain = xgb.QuantileDMatrix(X_fit, y_fit, max_bin=params.get("max_bin"), nthread=params.get("nthread"))
+	evals = []
+	if early_stopping_rounds:
+		evals = [(xgb.QuantileDMatrix(X_valid, y_valid, ref=dtrain, max_bin=params.get("max_bin"), nthread=params.get("nthread")), "validation")]
+	return boost_xgboost(params, profile, dtrain, evals, n_estimators, early_stopping_rounds, xgb_model)
+
+
+def xgb_training_profile(profile, hyperparameters=None):
+	"""One of XGB_TRAINING_PROFILES, with its n_estimators and params overridden by `hyperparameters` (see tuning.py)"""
+	profile = XGB_TRAINING_PROFILES[profile]
+	if not hyperparameters:
+		return profile
+	params = dict(hyperparameters)
+	return dict(profile, n_estimators=params.pop("n_estimators", profile["n_estimators"]), params=dict(profile["params"], **params))
+
+
+def xgb_native_params(profile):
+	# XGBRegressor argument names -> native parameter names
+	native_names = {"random_state": "seed", "n_jobs": "nthread"}
+	params = {native_names.get(name, name): value for name, value in profile["params"].items()}
+	params.setdefault("objective", "reg:squarederror")
+	return params
+
+
+def boost_xgboost(params, profile, dtrain, evals, n_estimators, early_stopping_rounds, xgb_model=None):
+	"""xgb.train on already built matrices, returned as an XGBRegressor"""
+	booster = xgb.train(
+		params, dtrain,
+		num_boost_round=n_estimators,
+		evals=evals,
+		early_stopping_rounds=early_stopping_rounds,
+		xgb_model=xgb_model,
+		verbose_eval=False,
+	)
+	if early_stopping_rounds:
+		# keep the trees up to the best round only, the later ones were not improving the validation RMSE
+		booster = booster[:booster.best_iteration + 1]
+
+	model = xgb.XGBRegressor(**profile["params"])
+	model.load_model(bytearray(booster.save_raw(raw_format="ubj")))
+	return model
+
+
+def train_xgboost_external(data, scaler, split_rows, cache_dir, profile=XGB_TRAINING_PROFILE, hyperparameters=None):
+	"""
+	Train with the training rows of `data` streamed into an ExtMemQuantileDMatrix (quantized pages
+	cached in `cache_dir`), stopping early on its validation rows like the "hist" profile.
+	Always uses the hist tree method, whatever the profile.
+	"""
+	profile = xgb_training_profile(profile, hyperparameters)
+	params = xgb_native_params(profile)
+	params["tree_method"] = "hist"
+	max_bin = params.get("max_bin", 256)
+
+	dtrain = xgb.ExtMemQuantileDMatrix(xgboost_data_iter(data, "train", scaler, cache_dir), max_bin=max_bin, nthread=params.get("nthread"))
+	early_stopping_rounds = profile.get("early_stopping_rounds") or 20
+	evals = []
+	if split_rows["validation"] >= profile.get("min_validation_rows", 1):
+		dvalid = xgb.ExtMemQuantileDMatrix(xgboost_data_iter(data, "validation", scaler, cache_dir), ref=dtrain, max_bin=max_bin, nthread=params.get("nthread"))
+		evals = [(dvalid, "validation")]
+	else:
+		early_stopping_rounds = None
+	return boost_xgboost(params, profile, dtrain, evals, profile["n_estimators"], early_stopping_rounds)
+
+
+def load_training_data(data_files=[], data_store=None, start_row=0):
+	"""
+	Load the training rows from `start_row` onward (rows are in insertion order).
+	Returns the rows and the total number of rows in the data source.
+	"""
+	loaded_dfs = []
+	for file in data_files:
+		df = pd.read_csv(file)
+
+		# Check for missing columns
+		missing_columns = set(REQUIRED_COLUMNS) - set(df.columns)
+		if len(missing_columns)>0:
+			raise ValueError(f"File: {file} is missing {missing_columns} required columns")
+
+		# cleanup extra columns
+		extra_columns = set(df.columns) - set(REQUIRED_COLUMNS)
+		df.drop(columns=extra_columns, inplace=True)
+
+		# add to loaded dataframes
+		loaded_dfs.append(df)
+
+	if data_store is not None:
+		if start_row == 0:
+			# Merge pending segments first so the columns are memory-mapped rather than concatenated
+			data_store.compact()
+		# Only the requested rows are read, rows appended meanwhile are left for the next retrain
+		data_rows = data_store.num_rows
+		columns = data_store.load_columns(REQUIRED_COLUMNS, start=start_row, stop=data_rows)
+		return pd.DataFrame(columns, columns=REQUIRED_COLUMNS, copy=False), data_rows
+
+	# combine the loaded dataframes
+	combined_df = pd.concat(loaded_dfs, axis=0)
+	return combined_df.iloc[start_row:], len(combined_df)
+
+
+def incremental_blocker(parent, data_source):
+	"""Why the active version can not be updated incrementally, None if it can"""
+	if parent is None:
+		return "no model version is active"
+	if "training_stats" not in parent:
+		return f"model version {parent['version']} has no training statistics"
+	if data_source == "mixed":
+		return "the training data comes from both files and a data store"
+	if parent["data_source"] != data_source:
+		return "the training data source changed"
+	return None
+
+
+def full_refit_due(parent, new_df):
+	"""Why a full refit should run instead of an incremental one, None if it is not due"""
+	if parent["increments_since_full_refit"] >= FULL_REFIT_MAX_INCREMENTS:
+		return f"scheduled after {FULL_REFIT_MAX_INCREMENTS} incremental versions"
+	if time.time() - parent["full_refit_at"] > FULL_REFIT_MAX_AGE_HOURS * 3600:
+		return f"scheduled, the last full refit is older than {FULL_REFIT_MAX_AGE_HOURS} hours"
+	if len(new_df) > FULL_REFIT_MAX_NEW_ROWS_RATIO * parent["data_rows"]:
+		return f"{len(new_df)} new rows for {parent['data_rows']} existing ones"
+	if len(new_df) >= RETRAIN_DRIFT_MIN_ROWS:
+		new_df = new_df.dropna()
+		score = drift_score(
+			training_stats_from_json(parent["training_stats"]),
+			compute_training_stats(new_df[FEATURE_COLUMNS].to_numpy(), new_df[TARGET_COLUMNS].to_numpy()))
+		if score > RETRAIN_DRIFT_THRESHOLD:
+			return f"the new rows drifted ({score:.2f} standard deviations)"
+	return None
+
+
+def limit_tensorflow_threads(n_threads):
+	"""Run TensorFlow ops on `n_threads` cores. Only possible before the TensorFlow runtime starts."""
+	import tensorflow as tf
+	try:
+		tf.config.threading.set_intra_op_parallelism_threads(n_threads)
+		tf.config.threading.set_inter_op_parallelism_threads(min(n_threads, 2))
+	except RuntimeError:
+		pass  # already started (e.g. by an earlier retrain in this process), its thread pools stay as they are
+
+
+def fit_models(fits, parallel, report):
+	"""
+	Run the {model name: fit} callables, each returning (model, metrics), one after the other or with
+	`parallel` at the same time in threads. The fits share the training arrays without copying them,
+	and XGBoost and TensorFlow release the GIL while they train.
+	Returns {name: model}, {name: metrics} and the seconds spent in each fit.
+	"""
+	def timed(fit):
+		start = time.perf_counter()
+		model, metrics = fit()
+		return model, metrics, time.perf_counter() - start
+
+	if parallel and len(fits) > 1:
+		report("training")
+		with ThreadPoolExecutor(max_workers=len(fits), thread_name_prefix="retrain") as executor:
+			futures = {name: executor.submit(timed, fit) for name, fit in fits.items()}
+			results = {name: future.result() for name, future in futures.items()}
+	else:
+		results = {}
+		for name, fit in fits.items():
+			report(name)
+			results[name] = timed(fit)
+	models = {name: model for name, (model, _, _) in results.items()}
+	metrics = {name: model_metrics for name, (_, model_metrics, _) in results.items()}
+	seconds = {name: elapsed for name, (_, _, elapsed) in results.items()}
+	return models, metrics, seconds
+
+
+NO_MLP_METRICS = {
+	"mse": 0,
+	"mae": 0,
+	"rmse": 0,
+	"r2": 0,
+}
+
+
+def new_mlp_model(n_features, params=MLP_TRAINING_PARAMS):
+	"""The compiled (untrained) MLP of a full refit and its training callbacks, `params` like MLP_TRAINING_PARAMS"""
+	# MLP model requirements
+	import tensorflow as tf
+	from tensorflow.keras.models import Sequential
+	from tensorflow.keras.layers import Dense, Dropout
+	from tensorflow.keras.optimizers import Adam
+	from tensorflow.keras.callbacks import EarlyStopping, ReduceLROnPlateau
+	from tensorflow.keras.mixed_precision import set_global_policy
+	set_global_policy('mixed_float16')  # Enable mixed precision for faster training on GPU
+
+	# Best model: 64-32 with 0.3 dropout (increased to reduce overfitting), unless tuned
+	layers = []
+	for units in params["hidden_layers"]:
+		layers.append(Dense(units, activation='relu', input_shape=(n_features,)) if not layers else Dense(units, activation='relu'))
+		layers.append(Dropout(params["dropout"]))
+	mlp_model = Sequential(layers + [Dense(1)])
+
+	mlp_model.compile(
+		optimizer=Adam(learning_rate=params["learning_rate"]),
+		loss=tf.keras.losses.Huber(),
+		metrics=['mae']
+	)
+
+	# Callbacks: EarlyStopping and ReduceLROnPlateau
+	early_stopping = EarlyStopping(monitor='val_loss', patience=5, restore_best_weights=True)
+	reduce_lr = ReduceLROnPlateau(monitor='val_loss', factor=0.5, patience=2)
+	return mlp_model, [early_stopping, reduce_lr]
+
+
+def split_training_data(combined_df):
+	"""X_train, X_test, y_train, y_test of a full refit"""
+	X, y = combined_df[FEATURE_COLUMNS], combined_df[TARGET_COLUMNS]
+	return train_test_split(X, y, test_size=0.2, random_state=31)
+
+
+def fit_full(combined_df, train_mlp, report, parallel=RETRAIN_PARALLEL, hyperparameters=None):
+	"""
+	Fit every model from scratch, with `parallel` the three of them at the same time (see RETRAIN_PARALLEL).
+	XGBoost and the MLP use `hyperparameters` (see tuning.py), the default ones if not given.
+	"""
+	hyperparameters = hyperparameters or default_hyperparameters()
+	mlp_params = hyperparameters["mlp"]
+
+	# split data for training and testing
+	X_train, X_test, y_train, y_test = split_training_data(combined_df)
+
+	# scale data
+	report("scaling")
+	std_scaler = StandardScaler()
+	X_train_scaled = std_scaler.fit_transform(X_train)
+	X_test_scaled = std_scaler.transform(X_test)
+	# running statistics the next incremental retrain starts from
+	training_stats = compute_training_stats(X_train.to_numpy(), y_train.to_numpy())
+
+
+	# Each fit returns its model and metrics
+	def fit_lr():
+		lr_model = LinearRegression()
+		lr_model.fit(X_train_scaled, y_train)
+		# evaluate model
+		y_pred_lr = lr_model.predict(X_test_scaled)
+		return lr_model, evaluate_model(y_test, y_pred_lr)
+
+	def fit_xgb():
+		# train XGB_model on the scaled features, which is what it is given when serving
+		xgb_model = train_xgboost(X_train_scaled, y_train, n_jobs=RETRAIN_XGB_THREADS if parallel else None,
+								  hyperparameters=hyperparameters["xgboost"])
+		# evaluate model
+		y_pred_xgb = xgb_model.predict(X_test_scaled)
+		return xgb_model, evaluate_model(y_test, y_pred_xgb)
+
+	def fit_mlp():
+		if parallel:
+			limit_tensorflow_threads(RETRAIN_MLP_THREADS)
+		# Prepare MLP model
+		assert X_train_scaled.shape[0] == y_train.shape[0], "Check size of X_train and y_train gap!"
+		assert X_test_scaled.shape[0] == y_test.shape[0], "Check size of X_test and y_test gap!"
+		mlp_model, callbacks = new_mlp_model(X_train_scaled.shape[1], mlp_params)
+
+		# Train the MLP model
+		mlp_model.fit(
+			X_train_scaled, y_train,
+			validation_split=0.2,
+			epochs=mlp_params["epochs"],
+			batch_size=mlp_params["batch_size"],
+			callbacks=callbacks,
+			verbose=True
+		)
+
+		# Evaluate model
+		y_pred_mlp = mlp_model.predict(X_test_scaled)
+		return mlp_model, evaluate_model(y_test, y_pred_mlp)
+
+	fits = {"linear_regression": fit_lr, "xgboost": fit_xgb}
+	if train_mlp:
+		fits["mlp"] = fit_mlp
+	models, metrics, seconds = fit_models(fits, parallel, report)
+	if not train_mlp:
+		models["mlp"], metrics["mlp"] = None, NO_MLP_METRICS
+
+	models["scaler"] = std_scaler
+	metrics["training_seconds"] = seconds
+	return models, metrics, training_stats
+
+
+def fit_full_out_of_core(data, train_mlp, report, hyperparameters=None):
+	"""
+	Fit every model from scratch like fit_full, streaming `data` (a ChunkedTrainingData) instead of
+	holding it in memory. See out_of_core.py.
+	The fits run one after the other, each one streaming its own chunks would multiply the memory used.
+	"""
+	hyperparameters = hyperparameters or default_hyperparameters()
+	mlp_params = hyperparameters["mlp"]
+	report("scaling")
+	# running statistics of the training rows: the scaler, the linear regression and the next incremental retrain
+	training_stats, split_rows = training_stats_pass(data)
+	std_scaler = scaler_from_stats(training_stats)
+
+	def fit_xgb():
+		with external_memory_cache_dir() as cache_dir:
+			return train_xgboost_external(data, std_scaler, split_rows, cache_dir, hyperparameters=hyperparameters["xgboost"]), None
+
+	def fit_mlp():
+		mlp_model, callbacks = new_mlp_model(len(FEATURE_COLUMNS), mlp_params)
+		mlp_model.fit(
+			mlp_dataset(data, "train", std_scaler, split_rows["train"], batch_size=mlp_params["batch_size"], shuffle=True),
+			validation_data=mlp_dataset(data, "validation", std_scaler, split_rows["validation"], batch_size=mlp_params["batch_size"]),
+			epochs=mlp_params["epochs"],
+			# the chunks are shuffled as they are read
+			shuffle=False,
+			callbacks=callbacks,
+			verbose=True
+		)
+		return mlp_model, None
+
+	fits = {"linear_regression": lambda: (linear_regression_from_training_stats(training_stats, std_scaler), None), "xgboost": fit_xgb}
+	if train_mlp:
+		fits["mlp"] = fit_mlp
+	models, _, seconds = fit_models(fits, False, report)
+	lr_model, xgb_model, mlp_model = models["linear_regression"], models["xgboost"], models.get("mlp")
+
+	report("evaluating")
+	evaluation = {name: StreamingMetrics() for name in ("linear_regression", "xgboost", "mlp")}
+	for X_test_scaled, y_test in data.iter_split("test", std_scaler):
+		evaluation["linear_regression"].add(y_test, lr_model.predict(X_test_scaled))
+		evaluation["xgboost"].add(y_test, xgb_model.predict(X_test_scaled))
+		if mlp_model is not None:
+			evaluation["mlp"].add(y_test, mlp_model.predict(X_test_scaled, batch_size=4096, verbose=0))
+	metrics = {name: accumulator.result() for name, accumulator in evaluation.items() if accumulator.n}
+	if mlp_model is None:
+		metrics["mlp"] = NO_MLP_METRICS
+	metrics["training_seconds"] = seconds
+
+	models = {"scaler": std_scaler, "linear_regression": lr_model, "xgboost": xgb_model, "mlp": mlp_model}
+	return models, metrics, training_stats
+
+
+def fit_incremental(new_df, parent, train_mlp, report, parallel=RETRAIN_PARALLEL, hyperparameters=None):
+	"""
+	Update the models of the `parent` version with the new rows only.
+
+	The scaler statistics are updated with partial_fit and the linear regression is solved from
+	the merged running statistics, both are the same as a full fit on all the rows. The previous
+	XGBoost trees and MLP weights are moved to the updated scaling, then XGBoost keeps boosting and
+	the MLP keeps training on the new rows (with `parallel` at the same time).
+	XGBoost keeps the params of the `hyperparameters` the parent was trained with.
+	"""
+	hyperparameters = hyperparameters or default_hyperparameters()
+	new_df = new_df.dropna()
+	X, y = new_df[FEATURE_COLUMNS], new_df[TARGET_COLUMNS]
+	if len(new_df) >= 10:
+		X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=0.2, random_state=31)
+	else:
+		# too few rows to hold some out, the metrics are computed on the training rows
+		X_train, X_test, y_train, y_test = X, X, y, y
+	version_dir = MODEL_REGISTRY.version_dir(parent["version"])
+
+	report("scaling")
+	parent_scaler = read_scaler(version_dir / ARTIFACT_FILES["scaler"])
+	std_scaler = copy.deepcopy(parent_scaler)
+	std_scaler.partial_fit(X_train)
+	X_train_scaled = std_scaler.transform(X_train)
+	X_test_scaled = std_scaler.transform(X_test)
+	rescaling = (parent_scaler.mean_, parent_scaler.scale_, std_scaler.mean_, std_scaler.scale_)
+
+	training_stats = merge_training_stats(
+		training_stats_from_json(parent["training_stats"]),
+		compute_training_stats(X_train.to_numpy(), y_train.to_numpy()))
+
+	def fit_lr():
+		coef, intercept = linear_regression_from_stats(training_stats)
+		lr_model = read_linear_regression(version_dir / ARTIFACT_FILES["linear_regression"])
+		# coefficients for the scaled features
+		lr_model.coef_ = (coef * std_scaler.scale_).reshape(np.shape(lr_model.coef_))
+		lr_model.intercept_ = np.full(np.shape(lr_model.intercept_), intercept + std_scaler.mean_ @ coef)
+		return lr_model, evaluate_model(y_test, lr_model.predict(X_test_scaled))
+
+	def fit_xgb():
+		booster = read_xgboost(version_dir / ARTIFACT_FILES["xgboost"]).get_booster()
+		rescale_xgboost_splits(booster, *rescaling)
+		xgb_model = train_xgboost(X_train_scaled, y_train, xgb_model=booster, n_estimators=INCREMENTAL_XGB_ROUNDS,
+								  n_jobs=RETRAIN_XGB_THREADS if parallel else None, hyperparameters=hyperparameters["xgboost"])
+		return xgb_model, evaluate_model(y_test, xgb_model.predict(X_test_scaled))
+
+	def fit_mlp():
+		if parallel:
+			limit_tensorflow_threads(RETRAIN_MLP_THREADS)
+		import tensorflow as tf
+		from tensorflow.keras.optimizers import Adam
+		from tensorflow.keras.mixed_precision import set_global_policy
+		set_global_policy('mixed_float16')
+
+		# The MLP always follows the updated scaler, it is only trained further if train_mlp is set
+		mlp_model = tf.keras.models.load_model(version_dir / ARTIFACT_FILES["mlp"])
+		rescale_mlp_inputs(mlp_model, *rescaling)
+		if train_mlp:
+			mlp_model.compile(
+				optimizer=Adam(learning_rate=INCREMENTAL_MLP_LEARNING_RATE),
+				loss=tf.keras.losses.Huber(),
+				metrics=['mae']
+			)
+			mlp_model.fit(X_train_scaled, y_train, epochs=INCREMENTAL_MLP_EPOCHS, batch_size=hyperparameters["mlp"]["batch_size"], verbose=True)
+		return mlp_model, evaluate_model(y_test, mlp_model.predict(X_test_scaled))
+
+	models, metrics, seconds = fit_models({"linear_regression": fit_lr, "xgboost": fit_xgb, "mlp": fit_mlp}, parallel, report)
+	models["scaler"] = std_scaler
+	metrics["training_seconds"] = seconds
+	return models, metrics, training_stats
+
+
+def tuning_rows(combined_df=None, chunked_data=None):
+	"""X, y of a uniform sample of at most TUNING_MAX_ROWS rows the models are fit on (the test rows are left out)"""
+	if chunked_data is not None:
+		test = SPLITS.index("test")
+		rows = sample_rows((np.column_stack([X, y])[splits != test] for X, y, splits in chunked_data.iter_chunks()),
+						   TUNING_MAX_ROWS, TUNING_SEED, width=len(FEATURE_COLUMNS) + 1)
+		return rows[:, :-1], rows[:, -1]
+	X_train, _, y_train, _ = split_training_data(combined_df)
+	rows = np.sort(np.random.default_rng(TUNING_SEED).permutation(len(X_train))[:TUNING_MAX_ROWS])
+	return X_train.iloc[rows].to_numpy(dtype=np.float64), y_train.iloc[rows].to_numpy(dtype=np.float64).reshape(-1)
+
+
+def retrain(data_files=[],
+			data_store=None,
+			save_models=True,
+			update_models_in_memory=True,
+			save_combined_dataset=True,
+			train_mlp=True,
+			mode=RETRAIN_MODE,
+			progress_callback=None,
+			out_of_core=RETRAIN_OUT_OF_CORE,
+			memory_budget_mb=RETRAIN_MEMORY_BUDGET_MB,
+			parallel=RETRAIN_PARALLEL,
+):
+	"""
+	Retrain the models and store them as a new registry version.
+	`mode` is "full", "incremental", "auto" or "tune", see RETRAIN_MODE in settings.py.
+	`out_of_core` is True, False or "auto" (full refits only), see RETRAIN_OUT_OF_CORE in settings.py.
+	`parallel` fits the models at the same time, see RETRAIN_PARALLEL.
+	"""
+	def report(stage):
+		# lets background jobs follow the progress of the retraining
+		if progress_callback is not None:
+			progress_callback(stage)
+
+	report("loading_data")
+	parent_version = MODEL_REGISTRY.active_version()
+	parent = MODEL_REGISTRY.get_metadata(parent_version) if parent_version else None
+	data_source = "files" if data_store is None else "columnar" if not data_files else "mixed"
+
+	training_mode, reason = "full", "requested" if mode != "tune" else "hyperparameter search"
+	if mode not in ("full", "tune"):
+		reason = incremental_blocker(parent, data_source)
+		if reason is None:
+			new_df, data_rows = load_training_data(data_files, data_store, start_row=parent["data_rows"])
+			if data_rows < parent["data_rows"]:
+				reason = "the training data was replaced"
+			elif new_df.empty:
+				raise ValueError(f"No new training rows since model version {parent_version}")
+			elif mode == "auto":
+				reason = full_refit_due(parent, new_df)
+		if reason is None:
+			training_mode = "incremental"
+		elif mode == "incremental":
+			raise ValueError(f"Incremental retraining is not possible: {reason}")
+
+	# XGBoost and MLP hyperparameters of the parent (searched by an earlier "tune" retrain or the defaults)
+	hyperparameters = (parent or {}).get("hyperparameters") or default_hyperparameters()
+	tuning = None
+
+	def tune(**rows):
+		nonlocal hyperparameters, tuning
+		report("tuning")
+		hyperparameters, tuning = search_hyperparameters(*tuning_rows(**rows), hyperparameters, ["xgboost", "mlp"] if train_mlp else ["xgboost"])
+
+	if training_mode == "full" and out_of_core == "auto":
+		out_of_core = estimate_in_memory_bytes(data_files, data_store) > memory_budget_mb * 2**20
+	if training_mode == "full" and out_of_core:
+		chunked_data = ChunkedTrainingData(data_files, data_store, chunk_rows_for_budget(memory_budget_mb))
+		if mode == "tune":
+			tune(chunked_data=chunked_data)
+		models, metrics, training_stats = fit_full_out_of_core(chunked_data, train_mlp, report, hyperparameters)
+		data_rows = chunked_data.data_rows
+		full_refit_at, increments_since_full_refit = time.time(), 0
+	elif training_mode == "full":
+		combined_df, data_rows = load_training_data(data_files, data_store)
+		combined_df = combined_df.dropna()
+		if mode == "tune":
+			tune(combined_df=combined_df)
+		models, metrics, training_stats = fit_full(combined_df, train_mlp, report, parallel, hyperparameters)
+		full_refit_at, increments_since_full_refit = time.time(), 0
+	else:
+		models, metrics, training_stats = fit_incremental(new_df, parent, train_mlp, report, parallel, hyperparameters)
+		full_refit_at, increments_since_full_refit = parent["full_refit_at"], parent["increments_since_full_refit"] + 1
+	std_scaler, lr_model, xgb_model, mlp_model = models["scaler"], models["linear_regression"], models["xgboost"], models["mlp"]
+
+	# Comparable vehicles index over the rows of a full refit, incremental versions keep the one of their parent
+	comparables_dir, comparables_path = None, None
+	comparables_rows = parent.get("comparables_rows") if training_mode == "incremental" else None
+	if COMPARABLES_ENABLED and training_mode == "full":
+		report("comparables")
+		# built next to the registry versions, so that saving it is a hard link
+		MODEL_REGISTRY.path.mkdir(parents=True, exist_ok=True)
+		comparables_dir = tempfile.TemporaryDirectory(prefix=".comparables-", dir=MODEL_REGISTRY.path)
+		comparables_path = Path(comparables_dir.name) / OPTIONAL_ARTIFACT_FILES["comparables"]
+		if out_of_core:
+			chunks = ((X, y) for X, y, _ in chunked_data.iter_chunks())
+		else:
+			chunks = [(combined_df[FEATURE_COLUMNS].to_numpy(dtype=np.float64), combined_df[TARGET_COLUMNS[0]].to_numpy(dtype=np.float64))]
+		comparables_rows = build_comparables_index(chunks, std_scaler, comparables_path)
+
+	# Background rows of the explanations (see explanations.py), incremental versions keep the ones of their parent
+	explanation_background = None
+	if training_mode == "full":
+		if out_of_core:
+			explanation_background = sample_rows((X for X, _, _ in chunked_data.iter_chunks()), EXPLANATION_BACKGROUND_ROWS)
+		else:
+			explanation_background = sample_rows([combined_df[FEATURE_COLUMNS].to_numpy(dtype=np.float64)], EXPLANATION_BACKGROUND_ROWS)
+
+	version = None
+	if save_models:
+		report("saving")
+		# Save files as a new version, the previous versions stay available for rollbacks
+		def save_artifacts(directory):
+			xgb_model.save_model(directory / ARTIFACT_FILES["xgboost"])
+			if mlp_model is not None:
+				mlp_model.save(directory / ARTIFACT_FILES["mlp"])
+			joblib.dump(lr_model, directory / ARTIFACT_FILES["linear_regression"])
+			joblib.dump(std_scaler, directory / ARTIFACT_FILES["scaler"])
+			with open(directory / ARTIFACT_FILES["feature_columns"], 'w+') as f:
+				json.dump(FEATURE_COLUMNS, fp=f)
+			if comparables_path is not None:
+				link_or_copy(comparables_path, directory / OPTIONAL_ARTIFACT_FILES["comparables"])
+			if explanation_background is not None:
+				save_background(explanation_background, directory / OPTIONAL_ARTIFACT_FILES["explanation_background"])
+
+		# keep the previous MLP if it was not retrained
+		inherit = [] if mlp_model is not None else ["mlp"]
+		if training_mode == "incremental":
+			inherit += [name for name in ("comparables", "explanation_background") if name in parent["artifacts"]]
+		version = MODEL_REGISTRY.create_version(
+			save_artifacts,
+			metrics=metrics,
+			parent_version=parent_version,
+			inherit=inherit,
+			extra={
+				"training_rows": training_stats["n"],
+				"training_mode": training_mode,
+				"training_mode_reason": reason,
+				"out_of_core": bool(training_mode == "full" and out_of_core),
+				"data_source": data_source,
+				"data_rows": data_rows,
+				"full_refit_at": full_refit_at,
+				"increments_since_full_refit": increments_since_full_refit,
+				"training_stats": training_stats_to_json(training_stats),
+				"comparables_rows": comparables_rows,
+				"hyperparameters": hyperparameters,
+				"tuning": tuning,
+			},
+		)
+
+	if update_models_in_memory:
+		# update the serving models, the previous MLP is kept if it was not retrained
+		current = MODELS.active
+		if mlp_model is None and current is None:
+			raise RuntimeError("Can not serve the retrained models without an MLP, no model version is loaded")
+		comparables = current.comparables if training_mode == "incremental" and current is not None else None
+		if comparables_path is not None:
+			# memory-mapped from the saved version, read into memory if there is none since the built file is removed below
+			comparables = (read_comparables(MODEL_REGISTRY.version_dir(version) / OPTIONAL_ARTIFACT_FILES["comparables"]) if version
+						   else read_comparables(comparables_path, mmap=False))
+		bundle = ModelBundle(
+			version or f"unsaved-{parent_version}",
+			scaler=std_scaler,
+			lr_model=lr_model,
+			xgb_model=xgb_model,
+			mlp_model=mlp_model if mlp_model is not None else current.mlp_model,
+			mlp_predictor=None if mlp_model is not None else current.mlp_predictor,
+			metadata=MODEL_REGISTRY.get_metadata(version) if version else {},
+			comparables=comparables,
+		)
+		if version:
+			MODEL_REGISTRY.activate(version)
+		MODELS.activate(bundle)
+	if comparables_dir is not None:
+		comparables_dir.cleanup()
+
+	# the columnar store already holds the combined dataset
+	if save_combined_dataset and data_store is None and training_mode == "full":
+		if out_of_core:
+			chunked_data.write_csv(COMBINED_DATASET_LATEST_FILE_PATH)
+		else:
+			combined_df.to_csv(COMBINED_DATASET_LATEST_FILE_PATH, columns=REQUIRED_COLUMNS, index=False)
+
+	return {
+		"version": version,
+		"training_mode": training_mode,
+		"hyperparameters": hyperparameters,
+		"models": {
+			"linear_regression": lr_model,
+			"xgboost": xgb_model,
+			"mlp": mlp_model
+		},
+		"metrics": metrics
+	}
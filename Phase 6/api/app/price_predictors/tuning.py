@@ -0,0 +1,278 @@
+"""
+Hyperparameter search of retrain(mode="tune"), see TUNING_SEARCH_SPACES in settings.py.
+
+Successive halving over random configurations of XGBoost and of the MLP, the current configuration
+always among them. A trial is the k-fold cross-validation of one configuration with a budget of
+boosting rounds or epochs. The trials of a rung run in a pool of worker processes, XGBoost and
+MLP trials side by side.
+
+The rows are prepared once per search: a sample of the training rows, scaled to float32 and saved
+as .npy files with the rows ordered by fold, so that every fold is a contiguous slice. The workers
+memory-map them: they share a single copy through the page cache and a validation fold is a view.
+
+Every finished trial is appended to trials.jsonl next to the prepared rows (a directory per data
+fingerprint under TUNING_DIR). The configurations come from a seeded generator, so running the
+search again on the same rows, e.g. after an interruption, only runs the trials without a result.
+"""
+import os
+import json
+import time
+import shutil
+import hashlib
+import logging
+import multiprocessing
+import numpy as np
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import Dict, List, Tuple
+
+from .settings import XGB_TRAINING_PROFILE, XGB_TRAINING_PROFILES, MLP_TRAINING_PARAMS
+from .settings import TUNING_SEARCH_SPACES, TUNING_ETA, TUNING_FOLDS, TUNING_MAX_SECONDS, TUNING_WORKERS, TUNING_WORKER_THREADS
+from .settings import TUNING_SEED, TUNING_DIR
+
+
+logger = logging.getLogger(__name__)
+
+# Hyperparameter of each model that the budget of a trial is spent on
+BUDGET_PARAMS = {"xgboost": "n_estimators", "mlp": "epochs"}
+
+
+def default_hyperparameters() -> Dict[str, Dict]:
+    """The hyperparameters of a retrain without search results: the XGB_TRAINING_PROFILE ones and MLP_TRAINING_PARAMS"""
+    profile = XGB_TRAINING_PROFILES[XGB_TRAINING_PROFILE]
+    xgb_params = {name: value for name, value in profile["params"].items() if name in TUNING_SEARCH_SPACES["xgboost"]["space"]}
+    return {"xgboost": {"n_estimators": profile["n_estimators"], **xgb_params}, "mlp": dict(MLP_TRAINING_PARAMS)}
+
+
+def sample_config(space: Dict, rng: np.random.Generator) -> Dict:
+    config = {}
+    for name, (kind, *bounds) in space.items():
+        if kind == "int":
+            config[name] = int(rng.integers(bounds[0], bounds[1] + 1))
+        elif kind == "float":
+            config[name] = float(f"{rng.uniform(*bounds):.4g}")
+        elif kind == "log":
+            config[name] = float(f"{np.exp(rng.uniform(np.log(bounds[0]), np.log(bounds[1]))):.4g}")
+        elif kind == "choice":
+            config[name] = bounds[0][int(rng.integers(len(bounds[0])))]
+        else:
+            raise ValueError(f"Unknown kind '{kind}' of the search space entry '{name}'")
+    return config
+
+
+def candidate_configs(model: str, current: Dict, n_configs: int, seed: int = TUNING_SEED) -> List[Dict]:
+    """The `current` hyperparameters of `model` (without its budget) and `n_configs` random variations of them"""
+    base = {name: value for name, value in current.items() if name != BUDGET_PARAMS[model]}
+    rng = np.random.default_rng([seed, list(BUDGET_PARAMS).index(model)])
+    space = TUNING_SEARCH_SPACES[model]["space"]
+    return [base] + [{**base, **sample_config(space, rng)} for _ in range(n_configs)]
+
+
+def rung_budgets(min_budget: int, max_budget: int, eta: int = TUNING_ETA) -> List[int]:
+    """Budget of each rung of successive halving, growing `eta` times per rung up to `max_budget`"""
+    n_rungs = 1 + int(np.log(max_budget / min_budget) / np.log(eta) + 1e-9)
+    return [max(min_budget, int(round(max_budget / eta ** (n_rungs - 1 - rung)))) for rung in range(n_rungs)]
+
+
+def prepare_rows(X: np.ndarray, y: np.ndarray, root: Path = TUNING_DIR, n_folds: int = TUNING_FOLDS, seed: int = TUNING_SEED) -> Path:
+    """
+    Save the rows of the trials (X scaled, both float32, ordered by fold) to a directory named after
+    their fingerprint and return it. A directory prepared from the same rows before is reused as is.
+    """
+    from sklearn.preprocessing import StandardScaler
+
+    X = np.ascontiguousarray(X, dtype=np.float64)
+    y = np.ascontiguousarray(y, dtype=np.float64).reshape(-1)
+    digest = hashlib.sha256(json.dumps({"folds": n_folds, "seed": seed, "shape": X.shape}).encode())
+    digest.update(X.tobytes())
+    digest.update(y.tobytes())
+    directory = Path(root) / digest.hexdigest()[:16]
+    if (directory / "folds.json").exists():
+        return directory
+
+    folds = np.random.default_rng(seed).permutation(len(X)) % n_folds
+    order = np.argsort(folds, kind="stable")
+    # rows of fold i are order[bounds[i]:bounds[i + 1]]
+    bounds = np.searchsorted(folds[order], np.arange(n_folds + 1))
+    tmp_dir = directory.with_name(f"{directory.name}.{os.getpid()}.tmp")
+    tmp_dir.mkdir(parents=True, exist_ok=True)
+    np.save(tmp_dir / "X.npy", StandardScaler().fit_transform(X[order]).astype(np.float32))
+    np.save(tmp_dir / "y.npy", y[order].astype(np.float32))
+    (tmp_dir / "folds.json").write_text(json.dumps(bounds.tolist()))
+    os.replace(tmp_dir, directory)
+    return directory
+
+
+# Memory-mapped rows of the worker process, see _init_worker
+_ROWS = {}
+
+
+def _init_worker(directory: Path, n_threads: int):
+    _ROWS["X"] = np.load(directory / "X.npy", mmap_mode="r")
+    _ROWS["y"] = np.load(directory / "y.npy", mmap_mode="r")
+    _ROWS["bounds"] = json.loads((directory / "folds.json").read_text())
+    _ROWS["threads"] = n_threads
+
+
+def fold_rows(fold: int) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """(X_train, y_train, X_valid, y_valid) of a fold, the validation rows are a view of the memory map"""
+    X, y, bounds = _ROWS["X"], _ROWS["y"], _ROWS["bounds"]
+    start, stop = bounds[fold], bounds[fold + 1]
+    return np.concatenate([X[:start], X[stop:]]), np.concatenate([y[:start], y[stop:]]), X[start:stop], y[start:stop]
+
+
+def rmse(y_true, y_pred) -> float:
+    error = np.asarray(y_true, dtype=np.float64).reshape(-1) - np.asarray(y_pred, dtype=np.float64).reshape(-1)
+    return float(np.sqrt(np.mean(error ** 2)))
+
+
+def xgboost_fold_rmse(config: Dict, budget: int, X_train, y_train, X_valid, y_valid) -> float:
+    import xgboost as xgb
+    from .training import xgb_native_params
+
+    profile = XGB_TRAINING_PROFILES[XGB_TRAINING_PROFILE]
+    # histograms whatever the profile, like the out-of-core refit
+    params = xgb_native_params({"params": dict(profile["params"], **config, tree_method="hist", n_jobs=_ROWS["threads"])})
+    dtrain = xgb.QuantileDMatrix(X_train, y_train, max_bin=params.get("max_bin", 256), nthread=_ROWS["threads"])
+    booster = xgb.train(params, dtrain, num_boost_round=budget, verbose_eval=False)
+    return rmse(y_valid, booster.inplace_predict(X_valid))
+
+
+def mlp_fold_rmse(config: Dict, budget: int, X_train, y_train, X_valid, y_valid) -> float:
+    import tensorflow as tf
+    from .training import limit_tensorflow_threads, new_mlp_model
+
+    limit_tensorflow_threads(_ROWS["threads"])
+    # the models of the earlier trials are not needed anymore
+    tf.keras.backend.clear_session()
+    params = dict(MLP_TRAINING_PARAMS, **config)
+    mlp_model, callbacks = new_mlp_model(X_train.shape[1], params)
+    mlp_model.fit(X_train, y_train, validation_data=(X_valid, y_valid), epochs=budget,
+                  batch_size=params["batch_size"], callbacks=callbacks, verbose=0)
+    return rmse(y_valid, mlp_model.predict(X_valid, batch_size=4096, verbose=0))
+
+
+FOLD_RMSE_FUNCTIONS = {"xgboost": xgboost_fold_rmse, "mlp": mlp_fold_rmse}
+
+
+def run_trial(model: str, config: Dict, budget: int) -> Dict:
+    """Cross-validated RMSE of `model` with the hyperparameters `config` and `budget` rounds / epochs, in a worker process"""
+    start = time.perf_counter()
+    fold_rmse = [FOLD_RMSE_FUNCTIONS[model](config, budget, *fold_rows(fold)) for fold in range(len(_ROWS["bounds"]) - 1)]
+    return {"rmse": float(np.mean(fold_rmse)), "fold_rmse": fold_rmse, "seconds": time.perf_counter() - start}
+
+
+def trial_key(model: str, config: Dict, budget: int) -> str:
+    return hashlib.sha256(json.dumps([model, config, budget], sort_keys=True).encode()).hexdigest()
+
+
+def read_trials(path: Path) -> Dict[str, Dict]:
+    """The trials saved by an earlier run of the search, by trial_key"""
+    trials = {}
+    if not path.exists():
+        return trials
+    with open(path, "rb+") as f:
+        for line in f:
+            try:
+                trial = json.loads(line)
+            except ValueError:
+                continue  # the line being written when the search was interrupted
+            trials[trial["key"]] = trial
+        # the next trial starts on a line of its own
+        if f.tell() and not line.endswith(b"\n"):
+            f.write(b"\n")
+    return trials
+
+
+def append_trial(path: Path, trial: Dict):
+    with open(path, "a") as f:
+        f.write(json.dumps(trial) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def search_hyperparameters(X: np.ndarray, y: np.ndarray, current: Dict[str, Dict], models: List[str],
+                           root: Path = TUNING_DIR, max_seconds: float = TUNING_MAX_SECONDS,
+                           workers: int = TUNING_WORKERS, worker_threads: int = TUNING_WORKER_THREADS) -> Tuple[Dict[str, Dict], Dict]:
+    """
+    Successive halving of the hyperparameters of `models` on the (unscaled) training rows X, y,
+    starting from the `current` ones ({model: hyperparameters}, like default_hyperparameters).
+    Returns the winning hyperparameters (the `current` ones for the models not searched) and a summary of the search.
+    """
+    started = time.perf_counter()
+    directory = prepare_rows(X, y, root)
+    trials_path = directory / "trials.jsonl"
+    saved_trials = read_trials(trials_path)
+
+    searches = {}
+    for model in models:
+        spec = TUNING_SEARCH_SPACES[model]
+        searches[model] = {
+            "configs": candidate_configs(model, current[model], spec["configs"]),
+            "budgets": rung_budgets(spec["min_budget"], spec["max_budget"]),
+            "best": None,
+            "rungs": 0,
+        }
+    n_rungs = max(len(search["budgets"]) for search in searches.values())
+    trials_run, trials_reused, stopped_early = 0, 0, False
+
+    pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"),
+                               initializer=_init_worker, initargs=(directory, worker_threads))
+    try:
+        for rung in range(n_rungs):
+            if rung > 0 and time.perf_counter() - started > max_seconds:
+                stopped_early = True
+                break
+            # every trial of the rung, (model, config index) -> result
+            results, futures = {}, {}
+            for model, search in searches.items():
+                if rung >= len(search["budgets"]):
+                    continue
+                budget = search["budgets"][rung]
+                for index, config in enumerate(search["configs"]):
+                    key = trial_key(model, config, budget)
+                    if key in saved_trials:
+                        results[model, index] = saved_trials[key]
+                        trials_reused += 1
+                    else:
+                        futures[pool.submit(run_trial, model, config, budget)] = (model, index, key)
+            logger.info("Tuning rung %d/%d: %d trials to run, %d saved", rung + 1, n_rungs, len(futures), len(results))
+
+            for future in as_completed(futures):
+                model, index, key = futures[future]
+                search = searches[model]
+                trial = {"key": key, "model": model, "config": search["configs"][index], "budget": search["budgets"][rung], **future.result()}
+                append_trial(trials_path, trial)
+                results[model, index] = trial
+                trials_run += 1
+
+            for model, search in searches.items():
+                if rung >= len(search["budgets"]):
+                    continue
+                # diverged trials (NaN) rank last
+                ranking = sorted(range(len(search["configs"])),
+                                 key=lambda index: np.nan_to_num(results[model, index]["rmse"], nan=np.inf))
+                best = results[model, ranking[0]]
+                search["best"] = (search["configs"][ranking[0]], best["budget"], best["rmse"])
+                search["rungs"] = rung + 1
+                search["configs"] = [search["configs"][index] for index in ranking[:max(1, len(ranking) // TUNING_ETA)]]
+                logger.info("Tuning %s rung %d/%d (budget %d): best CV RMSE %.5f", model, rung + 1, len(search["budgets"]), best["budget"], best["rmse"])
+    except BaseException:
+        pool.shutdown(wait=False, cancel_futures=True)
+        raise
+    pool.shutdown()
+
+    hyperparameters = {model: dict(params) for model, params in current.items()}
+    summary = {"rows": len(X), "folds": TUNING_FOLDS, "trials_run": trials_run, "trials_reused": trials_reused,
+               "stopped_early": stopped_early, "models": {}}
+    for model, search in searches.items():
+        config, budget, cv_rmse = search["best"]
+        hyperparameters[model] = {**config, BUDGET_PARAMS[model]: budget}
+        summary["models"][model] = {"cv_rmse": cv_rmse, "rungs": search["rungs"], "budgets": search["budgets"]}
+    summary["seconds"] = time.perf_counter() - started
+
+    # only the cache of the latest rows is kept, the other searches can not be resumed anymore anyway
+    for other in Path(root).iterdir():
+        if other.is_dir() and other != directory:
+            shutil.rmtree(other, ignore_errors=True)
+    return hyperparameters, summary
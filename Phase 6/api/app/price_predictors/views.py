@@ -1,254 +1,272 @@
-import json
-import joblib
-import pandas as pd
-import xgboost as xgb
-import tensorflow as tf
+import numpy as np
+from typing import Dict, List, Tuple
 from fastapi import HTTPException
 
-from .data_types import CarFeatures, PricePredictionResult
+from .data_types import LABEL_TABLES, CarFeatures, CarFeatureLabels, PricePredictionResult, ComparablesResult, max_vehicle_year
+from .data_types import PriceSweepRequest, PriceSweepResult, PriceExplanationResult, invalid_feature_values
+from .wire_format import read_arrow_columns
 
-from . import STANDARD_SCALER, XGB_MODEL, MLP_MODEL, LR_MODEL
-from .settings import REQUIRED_COLUMNS, FEATURE_COLUMNS, TARGET_COLUMNS
-from .settings import SCALER_PATH, XGB_MODEL_PATH, MLP_MODEL_PATH, LR_MODEL_PATH, FEATURE_COLUMNS_PATH, COMBINED_DATASET_LATEST_FILE_PATH
+from . import MODELS, ModelBundle
+from .metrics import STAGE_VALIDATION, STAGE_PREPARATION, STAGE_LR, STAGE_XGB, STAGE_MLP, STAGE_COMPARABLES, STAGE_EXPLANATION
+from .settings import FEATURE_COLUMNS, BATCH_PREDICTION_MAX_ROWS, COMPARABLES_MAX_BATCH_ROWS, SWEEP_MAX_POINTS, EXPLAIN_MAX_BATCH_ROWS
 
 
 
 
-def validate_and_prepare_input(input_data: CarFeatures) -> pd.DataFrame:
-	"""Convert input data to properly formatted DataFrame"""
-	try:
-		# Create DataFrame and ensure correct column order
-		input_df = pd.DataFrame(input_data, columns=FEATURE_COLUMNS, index=[0])
+def get_serving_bundle() -> ModelBundle:
+	"""The active model bundle, taken once per request so a concurrent swap can not mix versions.
+	Rejects predictions with 503 until the models have been loaded."""
+	bundle = MODELS.active
+	if bundle is None:
+		raise HTTPException(status_code=503, detail=f"Models are not ready: {MODELS.not_ready_reason()}")
+	return bundle
 
-		# Fill any missing columns with 0 for now (or appropriate default later)
-		input_df = input_df.fillna(0)
 
-		return input_df
-	except Exception as e:
-		raise ValueError(f"Input validation failed: {str(e)}")
+def prepare_input(car_features: CarFeatures, bundle: ModelBundle) -> np.ndarray:
+	"""Convert input data to a scaled float32 row of shape (1, n_features) in FEATURE_COLUMNS order.
 
+	The returned buffer is shared by all three models, so the scaling is done only once per request.
+	"""
+	try:
+		with STAGE_PREPARATION.time():
+			input_row = np.fromiter(
+				(getattr(car_features, column) for column in FEATURE_COLUMNS),
+				dtype=np.float32,
+				count=len(FEATURE_COLUMNS),
+			).reshape(1, -1)
+			# Same as STANDARD_SCALER.transform, done in place
+			input_row -= bundle.scaler_mean
+			input_row /= bundle.scaler_scale
+		return input_row
+	except Exception as e:
+		raise HTTPException(status_code=400, detail=f"Input validation failed: {str(e)}")
 
 
-def lr_predict(car_features: CarFeatures):
+def prepare_batch_input(car_features_list: List[CarFeatures], bundle: ModelBundle) -> np.ndarray:
+	"""Build one scaled float32 matrix (rows in input order, columns in FEATURE_COLUMNS order)"""
+	try:
+		with STAGE_PREPARATION.time():
+			input_matrix = np.array(
+				[[getattr(car_features, column) for column in FEATURE_COLUMNS] for car_features in car_features_list],
+				dtype=np.float32,
+			)
+			input_matrix -= bundle.scaler_mean
+			input_matrix /= bundle.scaler_scale
+		return input_matrix
+	except Exception as e:
+		raise HTTPException(status_code=400, detail=f"Input validation failed: {str(e)}")
+
+
+def prepare_labeled_batch_input(car_features_list: List[CarFeatureLabels], bundle: ModelBundle) -> np.ndarray:
+	"""Like prepare_batch_input for rows with label strings: each categorical column is encoded with one
+	lookup over the whole batch, and the invalid values of every row are reported together with a 422"""
+	with STAGE_VALIDATION.time():
+		input_matrix = np.empty((len(car_features_list), len(FEATURE_COLUMNS)), dtype=np.float32)
+		errors = []
+
+		def reject(mask, column, message):
+			for row in np.flatnonzero(mask).tolist():
+				errors.append({"type": "value_error", "loc": ["body", row, column], "msg": message(row)})
+
+		for i, column in enumerate(FEATURE_COLUMNS):
+			values = [getattr(car_features, column) for car_features in car_features_list]
+			table = LABEL_TABLES.get(column)
+			if table is None:
+				input_matrix[:, i] = values
+				continue
+			codes = table.encode(values)
+			input_matrix[:, i] = codes
+			reject(codes < 0, column, lambda row: f"Invalid label '{values[row]}' for field '{column}'. Valid labels are: {table.valid_labels_text}")
+
+		mileage = input_matrix[:, FEATURE_COLUMNS.index("mileage")]
+		reject(mileage < 0, "mileage", lambda row: "Mileage must be a non-negative number")
+		max_year = max_vehicle_year()
+		year = input_matrix[:, FEATURE_COLUMNS.index("year")]
+		reject((year < 1900) | (year > max_year), "year", lambda row: f"Year must be between 1900 and {max_year}")
+	if errors:
+		raise HTTPException(status_code=422, detail=sorted(errors, key=lambda error: error["loc"][1]))
+
+	with STAGE_PREPARATION.time():
+		input_matrix -= bundle.scaler_mean
+		input_matrix /= bundle.scaler_scale
+	return input_matrix
+
+
+def lr_predict(scaled_data: np.ndarray, bundle: ModelBundle):
 	"""Linear Regression prediction endpoint"""
 	try:
-		parsed_data = dict(car_features)
-		input_df = validate_and_prepare_input(parsed_data)
-		scaled_data = STANDARD_SCALER.transform(input_df)
-
-		prediction = LR_MODEL.predict(scaled_data)
+		with STAGE_LR.time():
+			prediction = scaled_data @ bundle.lr_coef + bundle.lr_intercept
 		# return prediction
 		prediction_value = prediction[0]
 		return prediction_value
 	except Exception as e:
 		raise HTTPException(status_code=400, detail=str(e))
 
-def xgb_predict(car_features: CarFeatures):
+def xgb_predict(scaled_data: np.ndarray, bundle: ModelBundle):
 	"""XGBoost prediction endpoint"""
 	try:
-		parsed_data = dict(car_features)
-		input_df = validate_and_prepare_input(parsed_data)
-		scaled_df = STANDARD_SCALER.transform(input_df)
-
-		prediction = XGB_MODEL.predict(scaled_df)
+		with STAGE_XGB.time():
+			prediction = bundle.xgb_predictor(scaled_data)
 		# return prediction
 		prediction_value = prediction[0]
 		return prediction_value
 	except Exception as e:
 		raise HTTPException(status_code=400, detail=str(e))
 
-def mlp_predict(car_features: CarFeatures):
+def mlp_predict(scaled_data: np.ndarray, bundle: ModelBundle):
 	"""Neural Network prediction endpoint"""
 	try:
-		parsed_data = dict(car_features)
-		input_df = validate_and_prepare_input(parsed_data)
-		scaled_data = STANDARD_SCALER.transform(input_df)
-		prediction = MLP_MODEL.predict(scaled_data, verbose=0)
+		with STAGE_MLP.time():
+			prediction = bundle.mlp_predictor(scaled_data)
 		# return prediction
-		prediction_value = prediction[0][0]
+		prediction_value = prediction[0]
 		return prediction_value
 	except Exception as e:
 		raise HTTPException(status_code=400, detail=str(e))
 
 
+def predict_scaled_batch(scaled_data: np.ndarray, bundle: ModelBundle) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+	"""Run each model of the bundle once over an already scaled matrix and return one 1-D array of predictions per model"""
+	try:
+		with STAGE_LR.time():
+			lr_predictions = scaled_data @ bundle.lr_coef + bundle.lr_intercept
+		with STAGE_XGB.time():
+			xgb_predictions = bundle.xgb_predictor(scaled_data)
+		with STAGE_MLP.time():
+			mlp_predictions = bundle.mlp_predictor(scaled_data)
+	except Exception as e:
+		raise HTTPException(status_code=400, detail=str(e))
+	return lr_predictions, xgb_predictions, mlp_predictions
+
+
+def batch_predict(car_features_list: List[CarFeatures], labeled: bool = False) -> List[PricePredictionResult]:
+	"""Predict prices for many rows with a single predict call per model. With `labeled` the rows are CarFeatureLabels."""
+	if len(car_features_list) == 0:
+		return []
+	if len(car_features_list) > BATCH_PREDICTION_MAX_ROWS:
+		raise HTTPException(status_code=413, detail=f"Batch size {len(car_features_list)} exceeds the limit of {BATCH_PREDICTION_MAX_ROWS} rows")
 
+	bundle = get_serving_bundle()
+	if labeled:
+		scaled_data = prepare_labeled_batch_input(car_features_list, bundle)
+	else:
+		scaled_data = prepare_batch_input(car_features_list, bundle)
+	lr_predictions, xgb_predictions, mlp_predictions = predict_scaled_batch(scaled_data, bundle)
 
+	return [
+		PricePredictionResult(lr_prediction=lr_value, xgb_prediction=xgb_value, mlp_prediction=mlp_value)
+		for lr_value, xgb_value, mlp_value in zip(lr_predictions.tolist(), xgb_predictions.tolist(), mlp_predictions.tolist())
+	]
 
 
-############################################################################################
-# Model retraining functions
-# can be put in a separate script to schedule using `systemd` or `crontab`
-############################################################################################
-import json
-import joblib
-import pandas as pd
-import xgboost as xgb
-
-from sklearn.preprocessing import StandardScaler
-from sklearn.linear_model import LinearRegression
-from sklearn.model_selection import train_test_split
-from sklearn.metrics import mean_absolute_error, r2_score, root_mean_squared_error, mean_squared_error
-
-# MLP model requirements
-from tensorflow.keras.models import Sequential
-from tensorflow.keras.layers import Dense
-from tensorflow.keras.optimizers import Adam
-from tensorflow.keras.callbacks import EarlyStopping, ReduceLROnPlateau
-from tensorflow.keras.layers import Dropout
-from tensorflow.keras.mixed_precision import set_global_policy
-from tensorflow.keras.layers import Dense, Dropout, BatchNormalization, LeakyReLU
-set_global_policy('mixed_float16')  # Enable mixed precision for faster training on GPU
-import tensorflow as tf
-
-
-def evaluate_model(y_true, y_pred):
-	return {
-		"mse": mean_squared_error(y_true, y_pred),
-		"mae": mean_absolute_error(y_true, y_pred),
-		"rmse": root_mean_squared_error(y_true, y_pred),
-		"r2": r2_score(y_true, y_pred)
-	}
-
-def retrain(data_files=[],
-			save_models=True, 
-			update_models_in_memory=True, 
-			save_combined_dataset=True,
-			train_mlp=True,
-):
-	loaded_dfs = []
-	for file in data_files:
-		df = pd.read_csv(file)
-		
-		# Check for missing columns
-		missing_columns = set(REQUIRED_COLUMNS) - set(df.columns)
-		if len(missing_columns)>0:
-			raise ValueError(f"File: {file} is missing {missing_columns} required columns")
-		
-		# cleanup extra columns
-		extra_columns = set(df.columns) - set(REQUIRED_COLUMNS)
-		df.drop(columns=extra_columns, inplace=True)
-		
-		# add to loaded dataframes
-		loaded_dfs.append(df)
-
-
-	# combine the loaded dataframes
-	combined_df = pd.concat(loaded_dfs, axis=0)
-	combined_df.dropna(inplace=True)
-	combined_df.reset_index()
-	# print(combined_df.isna.sum()) # debug
-	 
-
-	# split data for training and testing
-	X, y = combined_df[FEATURE_COLUMNS], combined_df[TARGET_COLUMNS]
-	X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=0.2, random_state=31)
-
-	# scale data	
-	std_scaler = StandardScaler()
-	X_train_scaled = std_scaler.fit_transform(X_train)
-	X_test_scaled = std_scaler.transform(X_test)
-
-
-	# train LR model
-	lr_model = LinearRegression()
-	lr_model.fit(X_train_scaled, y_train)
-	# evaluate model
-	y_pred_lr = lr_model.predict(X_test_scaled)
-	lr_metrics = evaluate_model(y_test, y_pred_lr)
-
-
-	# train XGB_model
-	xgb_model = xgb.XGBRegressor(
-		n_estimators=512,
-		max_depth=24,
-		max_leaves=800,
-		learning_rate=0.125,
-		gamma=0.005,
-		random_state=31
+def decode_arrow_body(body: bytes, fields: List[str]) -> Dict[str, np.ndarray]:
+	"""The columns `fields` of an Arrow stream request body, checked one column at a time (see wire_format.py).
+	The invalid values of every row are reported together with a 422, like prepare_labeled_batch_input."""
+	try:
+		with STAGE_VALIDATION.time():
+			columns, errors = read_arrow_columns(body, fields)
+	except RuntimeError as e:
+		raise HTTPException(status_code=415, detail=str(e))
+	except ValueError as e:
+		raise HTTPException(status_code=400, detail=str(e))
+	if errors:
+		raise HTTPException(status_code=422, detail=errors)
+	return columns
+
+
+def columnar_batch_predict(columns: Dict[str, np.ndarray]) -> Dict[str, np.ndarray]:
+	"""batch_predict for rows given as validated {column: values}: each column is copied straight into the
+	feature matrix, no model is built per row. Returns one array per PricePredictionResult field, in the input order."""
+	n_rows = len(columns[FEATURE_COLUMNS[0]])
+	if n_rows > BATCH_PREDICTION_MAX_ROWS:
+		raise HTTPException(status_code=413, detail=f"Batch size {n_rows} exceeds the limit of {BATCH_PREDICTION_MAX_ROWS} rows")
+	if n_rows == 0:
+		return {field: np.empty(0) for field in PricePredictionResult.model_fields}
+
+	bundle = get_serving_bundle()
+	with STAGE_PREPARATION.time():
+		input_matrix = np.empty((n_rows, len(FEATURE_COLUMNS)), dtype=np.float32)
+		for i, column in enumerate(FEATURE_COLUMNS):
+			input_matrix[:, i] = columns[column]
+		input_matrix -= bundle.scaler_mean
+		input_matrix /= bundle.scaler_scale
+	predictions = predict_scaled_batch(input_matrix, bundle)
+	return {field: np.asarray(values, dtype=np.float64).reshape(-1) for field, values in zip(PricePredictionResult.model_fields, predictions)}
+
+
+def sweep_predict(sweep: PriceSweepRequest) -> PriceSweepResult:
+	"""Score every point of the sweep grid with a single predict call per model: the base row is
+	repeated into one matrix and the swept columns are filled with the (outer product of the) grids"""
+	# checked before any grid is built
+	shape = tuple(axis.n_values for axis in sweep.sweeps)
+	n_points = int(np.prod(shape))
+	if n_points > SWEEP_MAX_POINTS:
+		raise HTTPException(status_code=413, detail=f"Sweep grid of {n_points} points exceeds the limit of {SWEEP_MAX_POINTS} points")
+	grids = [axis.grid() for axis in sweep.sweeps]
+
+	with STAGE_VALIDATION.time():
+		errors = []
+		for i, (axis, grid) in enumerate(zip(sweep.sweeps, grids)):
+			invalid, message = invalid_feature_values(axis.field, grid)
+			errors += [{"type": "value_error", "loc": ["body", "sweeps", i, "grid", int(j)], "input": float(grid[j]), "msg": message}
+					   for j in np.flatnonzero(invalid)]
+	if errors:
+		raise HTTPException(status_code=422, detail=errors)
+
+	bundle = get_serving_bundle()
+	with STAGE_PREPARATION.time():
+		base_row = np.array([getattr(sweep.base, column) for column in FEATURE_COLUMNS], dtype=np.float32)
+		input_matrix = np.repeat(base_row.reshape(1, -1), n_points, axis=0)
+		for axis, values in zip(sweep.sweeps, np.meshgrid(*grids, indexing="ij")):
+			input_matrix[:, FEATURE_COLUMNS.index(axis.field)] = values.ravel()
+		input_matrix -= bundle.scaler_mean
+		input_matrix /= bundle.scaler_scale
+	lr_predictions, xgb_predictions, mlp_predictions = predict_scaled_batch(input_matrix, bundle)
+
+	return PriceSweepResult(
+		fields=[axis.field for axis in sweep.sweeps],
+		values=[grid.tolist() for grid in grids],
+		lr_prediction=np.reshape(lr_predictions, shape).tolist(),
+		xgb_prediction=np.reshape(xgb_predictions, shape).tolist(),
+		mlp_prediction=np.reshape(mlp_predictions, shape).tolist(),
 	)
-	xgb_model.fit(X_train, y_train)
-	# evaluate model
-	y_pred_xgb = xgb_model.predict(X_test)
-	xgb_metrics = evaluate_model(y_test, y_pred_xgb)
-
-
-	if train_mlp:
-		# Prepare MLP model
-		assert X_train_scaled.shape[0] == y_train.shape[0], "Check size of X_train and y_train gap!"
-		assert X_test_scaled.shape[0] == y_test.shape[0], "Check size of X_test and y_test gap!"
-		# Best model 
-		mlp_model = Sequential([
-			Dense(64, activation='relu', input_shape=(X_train_scaled.shape[1],)),
-			Dropout(0.3),  # Increase dropout to reduce overfitting
-			Dense(32, activation='relu'),
-			Dropout(0.3),
-			Dense(1)
-		])
-		
-		mlp_model.compile(
-			optimizer=Adam(learning_rate=0.001),
-			loss=tf.keras.losses.Huber(),
-			metrics=['mae']
-		)
-
-		# Callbacks: EarlyStopping and ReduceLROnPlateau
-		early_stopping = EarlyStopping(monitor='val_loss', patience=5, restore_best_weights=True)
-		reduce_lr = ReduceLROnPlateau(monitor='val_loss', factor=0.5, patience=2)
-
-		# Train the MLP model
-		mlp_model.fit(
-			X_train_scaled, y_train,
-			validation_split=0.2,
-			epochs=5,
-			batch_size=512,
-			callbacks=[early_stopping, reduce_lr],
-			verbose=True
-		)
-
-		# Evaluate model
-		y_pred_mlp = mlp_model.predict(X_test_scaled)
-		mlp_metrics = evaluate_model(y_test, y_pred_mlp)
-	else:
-		mlp_model = None
-		mlp_metrics = {
-			"mse": 0,
-			"mae": 0,
-			"rmse": 0,
-			"r2": 0,
-		}
-
-
-	if update_models_in_memory:
-		# update global variables
-		global STANDARD_SCALER, LR_MODEL, MLP_MODEL, XGB_MODEL
-		STANDARD_SCALER = std_scaler
-		LR_MODEL = lr_model
-		MLP_MODEL = mlp_model
-		XGB_MODEL = xgb_model
-	
-	if save_models:
-		# Save files
-		xgb_model.save_model(XGB_MODEL_PATH)
-		if train_mlp:
-			mlp_model.save(MLP_MODEL_PATH)
-		joblib.dump(lr_model, LR_MODEL_PATH)
-		joblib.dump(std_scaler, SCALER_PATH)
-		with open(FEATURE_COLUMNS_PATH, 'w+') as f:
-			json.dump(list(X_train.columns), fp=f)
-	
-	if save_combined_dataset:
-		combined_df.to_csv(COMBINED_DATASET_LATEST_FILE_PATH, columns=REQUIRED_COLUMNS, index=False)
-	
-	return {
-		"models": {
-			"linear_regression": lr_model,
-			"xgboost": xgb_model,
-			"mlp": mlp_model
-		},
-		"metrics": {
-			"linear_regression": lr_metrics,
-			"xgboost": xgb_metrics,
-			"mlp": mlp_metrics
-		}
-	}
 
+
+def find_comparables(car_features_list: List[CarFeatures], k: int) -> List[ComparablesResult]:
+	"""The `k` training rows closest to each car, with a single index query for the whole list"""
+	if len(car_features_list) == 0:
+		return []
+	if len(car_features_list) > COMPARABLES_MAX_BATCH_ROWS:
+		raise HTTPException(status_code=413, detail=f"Batch size {len(car_features_list)} exceeds the limit of {COMPARABLES_MAX_BATCH_ROWS} rows")
+
+	bundle = get_serving_bundle()
+	if bundle.comparables is None:
+		raise HTTPException(status_code=503, detail=f"Model version {bundle.version} has no comparables index, it is built by the next full retrain")
+	features = np.array(
+		[[getattr(car_features, column) for column in FEATURE_COLUMNS] for car_features in car_features_list],
+		dtype=np.float64,
+	)
+	with STAGE_COMPARABLES.time():
+		comparables = bundle.comparables.comparables(features, k)
+	return [ComparablesResult(comparables=neighbours) for neighbours in comparables]
+
+
+def explain_predictions(car_features_list: List[CarFeatures]) -> List[PriceExplanationResult]:
+	"""Feature contributions of the three models for each car, each model explains the whole list at once"""
+	if len(car_features_list) == 0:
+		return []
+	if len(car_features_list) > EXPLAIN_MAX_BATCH_ROWS:
+		raise HTTPException(status_code=413, detail=f"Batch size {len(car_features_list)} exceeds the limit of {EXPLAIN_MAX_BATCH_ROWS} rows")
+
+	bundle = get_serving_bundle()
+	features = np.array(
+		[[getattr(car_features, column) for column in FEATURE_COLUMNS] for car_features in car_features_list],
+		dtype=np.float64,
+	)
+	with STAGE_EXPLANATION.time():
+		explanations = bundle.explainer.explain(features)
+	return [
+		PriceExplanationResult(lr_explanation=explanation["linear_regression"], xgb_explanation=explanation["xgboost"], mlp_explanation=explanation["mlp"])
+		for explanation in explanations
+	]
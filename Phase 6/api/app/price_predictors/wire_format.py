@@ -0,0 +1,107 @@
+"""
+Apache Arrow IPC stream bodies for the bulk paths: /price/batch/arrow and /insert_rows/arrow take
+the same rows as the JSON routes /price/batch and /insert_rows, sent as an Arrow stream with one
+column per field (Content-Type ARROW_STREAM_MEDIA_TYPE). Separate routes are used instead of
+content negotiation on the JSON routes, so their contract is unchanged. Requires pyarrow.
+
+Arrow columns are decoded straight into NumPy arrays (float64 columns without a copy) and checked
+with one vectorized test per column (see invalid_feature_values) instead of building and validating
+one pydantic model per row. Categorical columns may hold either integer codes or label strings.
+"""
+import numpy as np
+from typing import Dict, List, Optional, Tuple
+
+from .data_types import LABEL_TABLES, CarFeatures, invalid_feature_values
+
+
+ARROW_STREAM_MEDIA_TYPE = "application/vnd.apache.arrow.stream"
+
+# Request and response body of the Arrow routes, for the OpenAPI schema
+ARROW_STREAM_BODY = {"schema": {"type": "string", "format": "binary"}}
+
+
+def is_arrow_stream(header: Optional[str]) -> bool:
+    """Whether a Content-Type header names the Arrow stream format"""
+    return ARROW_STREAM_MEDIA_TYPE in (header or "")
+
+
+def require_pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.ipc
+    except ImportError:
+        raise RuntimeError("Arrow request bodies require pyarrow (pip install pyarrow)") from None
+    return pyarrow
+
+
+def _column_values(array, field: str) -> Tuple[np.ndarray, Optional[str]]:
+    """float64 values of one Arrow column (NaN for nulls), and for label columns the message of the unknown labels (also NaN)"""
+    pa = require_pyarrow()
+    array = array.combine_chunks() if hasattr(array, "combine_chunks") else array
+    if pa.types.is_dictionary(array.type):
+        array = array.dictionary_decode()
+    table = LABEL_TABLES.get(field)
+    if table is not None and (pa.types.is_string(array.type) or pa.types.is_large_string(array.type)):
+        codes = table.encode(array.fill_null("").to_numpy(zero_copy_only=False)).astype(np.float64)
+        codes[codes < 0] = np.nan
+        return codes, f"Invalid label for field '{field}'. Valid labels are: {table.valid_labels_text}"
+    if not (pa.types.is_integer(array.type) or pa.types.is_floating(array.type) or pa.types.is_boolean(array.type)):
+        raise ValueError(f"Column '{field}' has the type {array.type}, expected numbers")
+    if pa.types.is_boolean(array.type):
+        array = array.cast(pa.int8())
+    return array.to_numpy(zero_copy_only=False).astype(np.float64, copy=False), None
+
+
+def read_arrow_columns(body: bytes, fields: List[str]) -> Tuple[Dict[str, np.ndarray], List[Dict]]:
+    """
+    Columns `fields` of an Arrow stream body, and the validation errors of its rows in the format of
+    FastAPI's 422 details (an empty list if every row is valid). Whole-number fields are decoded as
+    int64, the others as float64. Raises a ValueError if the body is not an Arrow stream with these columns.
+    """
+    pa = require_pyarrow()
+    try:
+        table = pa.ipc.open_stream(pa.py_buffer(body)).read_all()
+    except pa.ArrowInvalid as e:
+        raise ValueError(f"The request body is not an Arrow stream: {e}") from None
+    missing = [field for field in fields if field not in table.column_names]
+    if missing:
+        raise ValueError(f"The Arrow stream is missing the columns {missing}")
+
+    columns, errors = {}, []
+
+    def reject(mask, field, message):
+        for row in np.flatnonzero(mask).tolist():
+            errors.append({"type": "value_error", "loc": ["body", row, field], "msg": message})
+
+    for field in fields:
+        array = table.column(field)
+        values, label_message = _column_values(array, field)
+        checked = ~array.is_null().to_numpy(zero_copy_only=False) if array.null_count else np.ones(len(values), dtype=bool)
+        reject(~checked, field, "Field required")
+        if label_message is not None:
+            unknown_labels = np.isnan(values) & checked
+            reject(unknown_labels, field, label_message)
+            checked &= ~unknown_labels
+        if field in CarFeatures.model_fields:
+            invalid, message = invalid_feature_values(field, values)
+        else:
+            invalid, message = ~np.isfinite(values), f"Field '{field}' must be a finite number"
+        reject(invalid & checked, field, message)
+        columns[field] = values
+
+    if errors:
+        return columns, sorted(errors, key=lambda error: error["loc"][1])
+    for field, values in columns.items():
+        if field in CarFeatures.model_fields and CarFeatures.model_fields[field].annotation is int:
+            columns[field] = values.astype(np.int64)
+    return columns, errors
+
+
+def write_arrow_columns(columns: Dict[str, np.ndarray]) -> bytes:
+    """An Arrow stream body with one column per item of `columns`"""
+    pa = require_pyarrow()
+    batch = pa.record_batch([pa.array(np.asarray(values)) for values in columns.values()], names=list(columns))
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, batch.schema) as writer:
+        writer.write_batch(batch)
+    return sink.getvalue().to_pybytes()
@@ -0,0 +1,204 @@
+import json
+import logging
+import numpy as np
+from typing import Callable, Optional, Tuple
+
+try:
+    import numba
+except ImportError:  # optional, only needed by the "flat" serving mode
+    numba = None
+
+
+logger = logging.getLogger(__name__)
+
+XGB_SERVING_MODES = ("predict", "inplace", "flat")
+
+# Objectives whose prediction is the raw sum of the trees plus the base score
+_IDENTITY_OBJECTIVES = ("reg:squarederror", "reg:absoluteerror", "reg:pseudohubererror")
+
+
+def _iteration_range(booster) -> Tuple[int, int]:
+    """Rounds XGBRegressor.predict uses: up to the best iteration when the model was early stopped"""
+    best_iteration = booster.attr("best_iteration")
+    return (0, int(best_iteration) + 1) if best_iteration is not None else (0, 0)
+
+
+class FlatTreeEnsemble:
+    """
+    Array-backed copy of a gbtree regression model for low-latency scoring of a few rows.
+
+    The nodes of every tree are stored in flat arrays (feature, threshold, children, leaf value),
+    leaves point to themselves. The trees are walked by a loop compiled with numba, which avoids
+    the per-call setup of the booster and is much faster than it for a single row.
+    """
+
+    # Arrays describing the trees, in the order they are passed to the compiled evaluator
+    ARRAYS = ("roots", "feature", "threshold", "left", "right", "default_left", "value")
+
+    def __init__(self, roots, feature, threshold, left, right, default_left, value, base_score: float):
+        self.roots = roots
+        self.feature = feature
+        self.threshold = threshold
+        self.left = left
+        self.right = right
+        self.default_left = default_left
+        self.value = value
+        self.base_score = np.float32(base_score)
+
+    @classmethod
+    def from_booster(cls, booster) -> "FlatTreeEnsemble":
+        model = json.loads(booster.save_raw(raw_format="json"))
+        learner = model["learner"]
+        objective = learner["objective"]["name"]
+        if objective not in _IDENTITY_OBJECTIVES:
+            raise ValueError(f"Objective {objective} is not supported by the flat tree evaluator")
+        gradient_booster = learner["gradient_booster"]
+        if gradient_booster["name"] != "gbtree":
+            raise ValueError(f"Booster {gradient_booster['name']} is not supported by the flat tree evaluator")
+
+        trees = gradient_booster["model"]["trees"]
+        n_rounds = _iteration_range(booster)[1]
+        if n_rounds:
+            trees = trees[:n_rounds * int(gradient_booster["model"]["gbtree_model_param"]["num_parallel_tree"])]
+
+        roots, features, thresholds, lefts, rights, default_lefts, values = [], [], [], [], [], [], []
+        offset = 0
+        for tree in trees:
+            if tree.get("categories"):
+                raise ValueError("Categorical splits are not supported by the flat tree evaluator")
+            left = np.asarray(tree["left_children"], dtype=np.int32)
+            right = np.asarray(tree["right_children"], dtype=np.int32)
+            conditions = np.asarray(tree["split_conditions"], dtype=np.float32)
+            n_nodes = len(left)
+            is_leaf = left == -1
+            node_ids = np.arange(n_nodes, dtype=np.int32)
+
+            roots.append(offset)
+            features.append(np.where(is_leaf, 0, tree["split_indices"]).astype(np.int32))
+            thresholds.append(np.where(is_leaf, 0, conditions).astype(np.float32))
+            lefts.append(np.where(is_leaf, node_ids, left) + offset)
+            rights.append(np.where(is_leaf, node_ids, right) + offset)
+            default_lefts.append(np.asarray(tree["default_left"], dtype=bool))
+            # leaves store their value in split_conditions
+            values.append(np.where(is_leaf, conditions, 0).astype(np.float32))
+            offset += n_nodes
+
+        base_score = float(str(learner["learner_model_param"]["base_score"]).strip("[]"))
+        return cls(
+            np.asarray(roots, dtype=np.int32), np.concatenate(features), np.concatenate(thresholds),
+            np.concatenate(lefts).astype(np.int32), np.concatenate(rights).astype(np.int32),
+            np.concatenate(default_lefts), np.concatenate(values), base_score,
+        )
+
+    def predict(self, scaled_data: np.ndarray) -> np.ndarray:
+        """Predictions of shape (n_rows,)"""
+        if _compiled_predict is None:
+            raise RuntimeError("The flat tree evaluator requires numba")
+        data = np.ascontiguousarray(scaled_data, dtype=np.float32)
+        output = np.empty(len(data), dtype=np.float32)
+        _compiled_predict(data, self.roots, self.feature, self.threshold, self.left, self.right,
+                          self.default_left, self.value, self.base_score, output)
+        return output
+
+
+def _compile_predict():
+    # nogil so concurrent requests can score in parallel
+    @numba.njit(nogil=True)
+    def predict(data, roots, feature, threshold, left, right, default_left, value, base_score, output):
+        for row in range(data.shape[0]):
+            total = np.float32(0)
+            for root in roots:
+                node = root
+                while left[node] != node:
+                    feature_value = data[row, feature[node]]
+                    if feature_value < threshold[node] or (np.isnan(feature_value) and default_left[node]):
+                        node = left[node]
+                    else:
+                        node = right[node]
+                total += value[node]
+            output[row] = base_score + total
+    return predict
+
+
+_compiled_predict: Optional[Callable] = _compile_predict() if numba is not None else None
+FLAT_EVALUATOR_AVAILABLE = _compiled_predict is not None
+
+
+def _predict_predictor(model) -> Callable[[np.ndarray], np.ndarray]:
+    def predict(scaled_data: np.ndarray) -> np.ndarray:
+        return np.asarray(model.predict(scaled_data)).reshape(-1)
+    return predict
+
+
+def _inplace_predictor(model, threads: int, small_batch_rows: int) -> Callable[[np.ndarray], np.ndarray]:
+    booster = model.get_booster()
+    iteration_range = _iteration_range(booster)
+    # Small batches are not worth waking up a thread pool for
+    single_thread = booster.copy()
+    single_thread.set_param({"nthread": 1})
+    multi_thread = booster.copy()
+    multi_thread.set_param({"nthread": threads})
+
+    def predict(scaled_data: np.ndarray) -> np.ndarray:
+        # float32 C-contiguous input is used as is, no DMatrix is built
+        data = np.ascontiguousarray(scaled_data, dtype=np.float32)
+        booster = single_thread if len(data) <= small_batch_rows else multi_thread
+        return booster.inplace_predict(data, iteration_range=iteration_range, validate_features=False).reshape(-1)
+    return predict
+
+
+def _flat_predictor(model, threads: int, small_batch_rows: int) -> Callable[[np.ndarray], np.ndarray]:
+    large_batch_predict = _inplace_predictor(model, threads, small_batch_rows)
+    try:
+        if _compiled_predict is None:
+            raise RuntimeError("the flat tree evaluator requires numba")
+        ensemble = FlatTreeEnsemble.from_booster(model.get_booster())
+    except Exception as e:
+        logger.warning("Using inplace_predict for every batch size: %s", e)
+        return large_batch_predict
+
+    def predict(scaled_data: np.ndarray) -> np.ndarray:
+        if len(scaled_data) <= small_batch_rows:
+            return ensemble.predict(scaled_data)
+        return large_batch_predict(scaled_data)
+    return predict
+
+
+def check_parity(model, predictor: Callable[[np.ndarray], np.ndarray], atol: float, small_batch_rows: int,
+                 n_rows: int = 256, seed: int = 31) -> float:
+    """Compare `predictor` with XGBRegressor.predict on random scaled inputs (small and large batches)"""
+    n_features = model.get_booster().num_features()
+    probe = np.random.default_rng(seed).standard_normal((max(n_rows, small_batch_rows + 1), n_features)).astype(np.float32)
+    expected = np.asarray(model.predict(probe), dtype=np.float32).reshape(-1)
+    max_diff = 0.0
+    for rows in (slice(0, 1), slice(0, small_batch_rows), slice(None)):
+        max_diff = max(max_diff, float(np.max(np.abs(predictor(probe[rows]) - expected[rows]))))
+    if max_diff > atol:
+        raise ValueError(f"XGBoost serving output differs from predict by {max_diff:.6f} (tolerance {atol})")
+    return max_diff
+
+
+def build_xgb_predictor(model, mode: str = "inplace", threads: int = 1, small_batch_rows: int = 64,
+                        parity_atol: float = 1e-3) -> Callable[[np.ndarray], np.ndarray]:
+    """
+    Create the callable used to score scaled rows with the XGBoost model.
+
+    `mode` is one of XGB_SERVING_MODES. The inplace and flat modes are verified against
+    XGBRegressor.predict on load, and fall back to it if they do not match.
+    """
+    if mode not in XGB_SERVING_MODES:
+        raise ValueError(f"Unknown XGBoost serving mode '{mode}'. Valid modes are {list(XGB_SERVING_MODES)}")
+    if mode == "predict":
+        return _predict_predictor(model)
+
+    try:
+        if mode == "inplace":
+            predictor = _inplace_predictor(model, threads, small_batch_rows)
+        else:
+            predictor = _flat_predictor(model, threads, small_batch_rows)
+        max_diff = check_parity(model, predictor, parity_atol, small_batch_rows)
+        logger.info("XGBoost serving mode '%s' matches predict (max abs diff %.6f)", mode, max_diff)
+        return predictor
+    except Exception as e:
+        logger.warning("Falling back to predict for the XGBoost model: %s", e)
+        return _predict_predictor(model)
@@ -0,0 +1,73 @@
+"""
+Throughput of /insert_row style ingestion: the previous read-concat-rewrite implementation
+against the append-only one in `app.price_predictors.ingestion`.
+
+Run from `Phase 6/api`:
+    python -m benchmarks.bench_insert_rows --existing-rows 0 10000 100000 --inserts 200
+"""
+import time
+import argparse
+import tempfile
+import numpy as np
+import pandas as pd
+from pathlib import Path
+
+from app.price_predictors.settings import REQUIRED_COLUMNS
+from app.price_predictors.data_types import CarFeaturesWithPrice
+from app.price_predictors.ingestion import append_training_rows
+
+
+EXAMPLE_ROW = CarFeaturesWithPrice.model_config["json_schema_extra"]["example"]
+
+
+def legacy_insert(car_features: CarFeaturesWithPrice, file_path: Path):
+    """The implementation /insert_row used before the append-only ingestion"""
+    new_row = pd.DataFrame([dict(car_features)], columns=REQUIRED_COLUMNS)
+    try:
+        df_existing = pd.read_csv(file_path, index_col=False)
+    except FileNotFoundError:
+        df_existing = pd.DataFrame(columns=REQUIRED_COLUMNS)
+    df_final = pd.concat([df_existing, new_row])
+    df_final.to_csv(file_path, index=False)
+
+
+def append_insert(car_features: CarFeaturesWithPrice, file_path: Path):
+    append_training_rows([car_features], file_path)
+
+
+def make_file(file_path: Path, n_rows: int):
+    rows = pd.DataFrame([EXAMPLE_ROW] * n_rows, columns=REQUIRED_COLUMNS)
+    rows["mileage"] = np.arange(n_rows, dtype=float)
+    rows.to_csv(file_path, index=False)
+
+
+def bench(insert_fn, existing_rows: int, inserts: int) -> dict:
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        file_path = Path(tmp_dir) / "additional_dataset.csv"
+        make_file(file_path, existing_rows)
+        row = CarFeaturesWithPrice(**EXAMPLE_ROW)
+
+        start = time.perf_counter()
+        for _ in range(inserts):
+            insert_fn(row, file_path)
+        elapsed = time.perf_counter() - start
+
+        assert len(pd.read_csv(file_path)) == existing_rows + inserts, "rows were lost"
+    return {"existing_rows": existing_rows, "inserts": inserts, "seconds": elapsed, "rows_per_second": inserts / elapsed}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--existing-rows", type=int, nargs="+", default=[0, 10_000, 100_000])
+    parser.add_argument("--inserts", type=int, default=200)
+    args = parser.parse_args()
+
+    print(f"{'implementation':<10} {'existing rows':>14} {'inserts':>8} {'seconds':>9} {'rows/s':>10}")
+    for existing_rows in args.existing_rows:
+        for name, insert_fn in (("legacy", legacy_insert), ("append", append_insert)):
+            result = bench(insert_fn, existing_rows, args.inserts)
+            print(f"{name:<10} {existing_rows:>14} {args.inserts:>8} {result['seconds']:>9.3f} {result['rows_per_second']:>10.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,145 @@
+"""
+JSON against Arrow IPC stream bodies on the bulk paths: throughput and allocations of /price/batch
+against /price/batch/arrow (round trip through the FastAPI app, in-process, and the handler work
+alone: decoding and validating the body, then predicting) and of decoding /insert_rows against
+/insert_rows/arrow bodies into a ColumnarStore.
+
+Allocations are the peak of the memory traced by tracemalloc and the number of generation 0
+garbage collections during one call, a proxy for the number of Python objects created.
+Requires pyarrow.
+
+Run from `Phase 6/api`:
+    python -m benchmarks.bench_wire_format --batch-sizes 100 1000 10000
+"""
+import gc
+import time
+import argparse
+import tempfile
+import tracemalloc
+import numpy as np
+from pathlib import Path
+from typing import List
+from pydantic import TypeAdapter
+
+from app.price_predictors.data_types import CarFeatures, CarFeaturesWithPrice
+from app.price_predictors.settings import FEATURE_COLUMNS, REQUIRED_COLUMNS
+from app.price_predictors.wire_format import ARROW_STREAM_MEDIA_TYPE, require_pyarrow
+from benchmarks.synthetic import synthetic_frame
+
+
+# What FastAPI validates the JSON bodies of /price/batch and /insert_rows with
+CAR_FEATURES_LIST = TypeAdapter(List[CarFeatures])
+CAR_FEATURES_WITH_PRICE_LIST = TypeAdapter(List[CarFeaturesWithPrice])
+
+
+def arrow_body(frame) -> bytes:
+    pa = require_pyarrow()
+    table = pa.Table.from_pandas(frame, preserve_index=False)
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    return sink.getvalue().to_pybytes()
+
+
+def bench(fn, min_seconds: float = 1.0) -> float:
+    """Mean seconds per call"""
+    fn()
+    calls, start = 0, time.perf_counter()
+    while True:
+        fn()
+        calls += 1
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_seconds:
+            return elapsed / calls
+
+
+def allocations(fn) -> dict:
+    """Peak traced memory and generation 0 collections of one call"""
+    fn()
+    gc.collect()
+    collections = gc.get_stats()[0]["collections"]
+    tracemalloc.start()
+    try:
+        fn()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return {"peak_kb": peak / 1024, "gen0_collections": gc.get_stats()[0]["collections"] - collections}
+
+
+def price_batch_functions(client, frame) -> dict:
+    """(format, part) -> function doing one /price/batch (or /price/batch/arrow) call of the rows of `frame`"""
+    from app.price_predictors.views import batch_predict, decode_arrow_body, columnar_batch_predict
+
+    rows = frame[FEATURE_COLUMNS].to_dict("records")
+    json_body = frame[FEATURE_COLUMNS].to_json(orient="records").encode()
+    arrow = arrow_body(frame[FEATURE_COLUMNS])
+    arrow_headers = {"content-type": ARROW_STREAM_MEDIA_TYPE}
+
+    def post(path, **kwargs):
+        response = client.post(f"/api/v1/predict{path}", **kwargs)
+        if response.status_code != 200:
+            raise RuntimeError(f"{path} answered {response.status_code}: {response.text[:200]}")
+        return response
+
+    return {
+        ("json", "round trip"): lambda: post("/price/batch", json=rows).json(),
+        ("arrow", "round trip"): lambda: post("/price/batch/arrow", content=arrow_body(frame[FEATURE_COLUMNS]), headers=arrow_headers).content,
+        ("json", "handler"): lambda: batch_predict(CAR_FEATURES_LIST.validate_json(json_body)),
+        ("arrow", "handler"): lambda: columnar_batch_predict(decode_arrow_body(arrow, FEATURE_COLUMNS)),
+    }
+
+
+def insert_functions(store, frame) -> dict:
+    """format -> function decoding an /insert_rows (or /insert_rows/arrow) body of the rows of `frame` and appending it to `store`"""
+    from app.price_predictors.views import decode_arrow_body
+
+    json_body = frame.to_json(orient="records").encode()
+    arrow = arrow_body(frame)
+    return {
+        "json": lambda: store.append_rows(CAR_FEATURES_WITH_PRICE_LIST.validate_json(json_body)),
+        "arrow": lambda: store.append_columns(decode_arrow_body(arrow, REQUIRED_COLUMNS)),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[100, 1_000, 10_000])
+    parser.add_argument("--min-seconds", type=float, default=1.0, help="minimum time measured per case")
+    args = parser.parse_args()
+
+    from fastapi.testclient import TestClient
+    from app.main import app
+    from app.price_predictors.columnar_store import ColumnarStore
+
+    print(f"{'path':<27} {'format':<6} {'rows':>6} {'ms/call':>9} {'rows/s':>11} {'peak KiB':>10} {'gen0 gc':>8}")
+
+    def report(path, wire_format, n_rows, fn):
+        seconds = bench(fn, args.min_seconds)
+        allocated = allocations(fn)
+        print(f"{path:<27} {wire_format:<6} {n_rows:>6} {seconds * 1e3:>9.2f} {n_rows / seconds:>11.0f} "
+              f"{allocated['peak_kb']:>10.0f} {allocated['gen0_collections']:>8}")
+
+    with TestClient(app) as client:
+        deadline = time.time() + 300
+        while client.get("/api/v1/predict/ready").status_code != 200:
+            if time.time() > deadline:
+                raise TimeoutError("The models were not loaded after 300s")
+            time.sleep(0.2)
+
+        for batch_size in args.batch_sizes:
+            frame = synthetic_frame(batch_size, seed=7)
+            for (wire_format, part), fn in price_batch_functions(client, frame).items():
+                report(f"/price/batch {part}", wire_format, batch_size, fn)
+
+    for batch_size in args.batch_sizes:
+        frame = synthetic_frame(batch_size, seed=8)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            # a large compaction threshold keeps background compactions out of the measurements
+            store = ColumnarStore(Path(tmp_dir) / "columnar", compaction_min_segments=np.iinfo(np.int32).max)
+            for wire_format, fn in insert_functions(store, frame).items():
+                report("/insert_rows decode+append", wire_format, batch_size, fn)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+"""
+Latency of the XGBoost serving modes in `XGB_SERVING_MODES` per row and per batch,
+each verified against XGBRegressor.predict first.
+
+Uses the active model version (or trained_models/ when there is no registry yet), or
+a synthetic model trained with the "legacy" profile with `--synthetic-rows`.
+
+Run from `Phase 6/api`:
+    python -m benchmarks.bench_xgb_serving --batch-sizes 1 16 256 4096
+    python -m benchmarks.bench_xgb_serving --synthetic-rows 50000
+"""
+import time
+import argparse
+import numpy as np
+
+from app.price_predictors.settings import FEATURE_COLUMNS, XGB_MODEL_PATH, XGB_SERVING_THREADS, XGB_SMALL_BATCH_ROWS
+from app.price_predictors.xgb_serving import XGB_SERVING_MODES, build_xgb_predictor, check_parity
+
+
+def load_model(synthetic_rows: int):
+    from app.price_predictors import read_xgboost
+    if not synthetic_rows:
+        from app.price_predictors.registry import MODEL_REGISTRY, ARTIFACT_FILES
+        version = MODEL_REGISTRY.active_version()
+        path = MODEL_REGISTRY.version_dir(version) / ARTIFACT_FILES["xgboost"] if version else XGB_MODEL_PATH
+        return read_xgboost(path)
+
+    from app.price_predictors.training import train_xgboost
+    rng = np.random.default_rng(31)
+    X = rng.standard_normal((synthetic_rows, len(FEATURE_COLUMNS)))
+    y = 10 + X[:, :4].sum(axis=1) + np.sin(X[:, 4]) + rng.normal(0, 0.1, synthetic_rows)
+    return train_xgboost(X, y, "legacy")
+
+
+def bench(predictor, data: np.ndarray, min_seconds: float = 1.0) -> float:
+    """Mean seconds per call"""
+    predictor(data)
+    calls, start = 0, time.perf_counter()
+    while True:
+        predictor(data)
+        calls += 1
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_seconds:
+            return elapsed / calls
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--modes", nargs="+", default=list(XGB_SERVING_MODES))
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 16, 256, 4096])
+    parser.add_argument("--synthetic-rows", type=int, default=0, help="benchmark a model trained on random data")
+    args = parser.parse_args()
+
+    model = load_model(args.synthetic_rows)
+    booster = model.get_booster()
+    print(f"model: {booster.num_boosted_rounds()} rounds, {booster.num_features()} features")
+    data = np.random.default_rng(31).standard_normal((max(args.batch_sizes), booster.num_features())).astype(np.float32)
+
+    print(f"{'mode':<8} {'max abs diff':>12} {'batch':>6} {'us/call':>10} {'us/row':>9}")
+    for mode in args.modes:
+        predictor = build_xgb_predictor(model, mode, XGB_SERVING_THREADS, XGB_SMALL_BATCH_ROWS, parity_atol=np.inf)
+        max_diff = check_parity(model, predictor, np.inf, XGB_SMALL_BATCH_ROWS)
+        for batch_size in args.batch_sizes:
+            seconds = bench(predictor, data[:batch_size])
+            print(f"{mode:<8} {max_diff:>12.2e} {batch_size:>6} {seconds * 1e6:>10.1f} {seconds * 1e6 / batch_size:>9.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+"""
+XGBoost training cost of the profiles in `XGB_TRAINING_PROFILES`: wall time, peak RSS and test RMSE
+on the combined training dataset (same split and scaling as `retrain`).
+
+Each profile runs in a fresh process so the peak RSS of one does not hide the other.
+
+Run from `Phase 6/api`:
+    python -m benchmarks.bench_xgb_training --profiles legacy hist
+    python -m benchmarks.bench_xgb_training --synthetic-rows 500000
+"""
+import time
+import argparse
+import resource
+import multiprocessing
+import numpy as np
+import pandas as pd
+from sklearn.preprocessing import StandardScaler
+from sklearn.model_selection import train_test_split
+
+from app.price_predictors.settings import REQUIRED_COLUMNS, FEATURE_COLUMNS, TARGET_COLUMNS, TRAINING_DATA_STORAGE
+from app.price_predictors.settings import ORIGINAL_DATASET_FILE_PATH, TRAINING_ROW_INSERTION_FILE_PATH, XGB_TRAINING_PROFILES
+
+
+def load_dataset(synthetic_rows: int) -> pd.DataFrame:
+    if synthetic_rows:
+        rng = np.random.default_rng(31)
+        df = pd.DataFrame(rng.normal(size=(synthetic_rows, len(FEATURE_COLUMNS))), columns=FEATURE_COLUMNS)
+        df[TARGET_COLUMNS[0]] = 10 + df.iloc[:, :4].sum(axis=1) + np.sin(df.iloc[:, 4]) + rng.normal(0, 0.1, synthetic_rows)
+        return df
+
+    from app.price_predictors.training import load_training_data
+    if TRAINING_DATA_STORAGE == "columnar":
+        from app.price_predictors.columnar_store import get_training_store, import_training_datasets
+        import_training_datasets()
+        df, _ = load_training_data(data_store=get_training_store())
+    else:
+        files = [file for file in (ORIGINAL_DATASET_FILE_PATH, TRAINING_ROW_INSERTION_FILE_PATH) if file.exists()]
+        df, _ = load_training_data(data_files=files)
+    return df[REQUIRED_COLUMNS].dropna()
+
+
+def max_rss_mb() -> float:
+    # ru_maxrss is in KiB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def run_profile(profile: str, synthetic_rows: int, results):
+    from app.price_predictors.training import train_xgboost
+
+    df = load_dataset(synthetic_rows)
+    X_train, X_test, y_train, y_test = train_test_split(df[FEATURE_COLUMNS], df[TARGET_COLUMNS], test_size=0.2, random_state=31)
+    scaler = StandardScaler()
+    X_train_scaled = scaler.fit_transform(X_train)
+    X_test_scaled = scaler.transform(X_test)
+    rss_before = max_rss_mb()
+
+    start = time.perf_counter()
+    model = train_xgboost(X_train_scaled, y_train, profile)
+    elapsed = time.perf_counter() - start
+
+    rmse = float(np.sqrt(np.mean((model.predict(X_test_scaled) - y_test.to_numpy().reshape(-1)) ** 2)))
+    results.put({
+        "profile": profile,
+        "rows": len(X_train),
+        "rounds": model.get_booster().num_boosted_rounds(),
+        "seconds": elapsed,
+        "peak_rss_mb": max_rss_mb(),
+        "training_rss_mb": max_rss_mb() - rss_before,
+        "test_rmse": rmse,
+    })
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--profiles", nargs="+", default=list(XGB_TRAINING_PROFILES))
+    parser.add_argument("--synthetic-rows", type=int, default=0, help="benchmark on random data instead of the training dataset")
+    args = parser.parse_args()
+
+    context = multiprocessing.get_context("spawn")
+    print(f"{'profile':<10} {'train rows':>10} {'rounds':>7} {'seconds':>9} {'peak RSS MB':>12} {'+RSS MB':>9} {'test RMSE':>10}")
+    for profile in args.profiles:
+        results = context.Queue()
+        process = context.Process(target=run_profile, args=(profile, args.synthetic_rows, results))
+        process.start()
+        result = results.get()
+        process.join()
+        print(f"{result['profile']:<10} {result['rows']:>10} {result['rounds']:>7} {result['seconds']:>9.2f} "
+              f"{result['peak_rss_mb']:>12.0f} {result['training_rss_mb']:>9.0f} {result['test_rmse']:>10.4f}")
+
+
+if __name__ == "__main__":
+    main()
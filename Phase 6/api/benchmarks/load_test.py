@@ -0,0 +1,130 @@
+"""
+Throughput and memory of the API with several worker processes.
+
+Starts the server in each deployment, waits for /ready, then sends /price requests from
+`--clients` client processes over keep-alive connections for `--seconds` (random mileage, so
+the prediction cache does not answer them). Reports requests per second, latency percentiles
+and the memory of the server processes: PSS counts shared pages once, divided between the
+processes mapping them, USS only what a process does not share.
+
+Deployments:
+  - gunicorn: gunicorn.conf.py, models loaded once before forking and memory-mapped (SHARED_MODEL_MEMORY)
+  - uvicorn: `uvicorn --workers N`, every worker loads its own copy of the models
+
+Run from `Phase 6/api`:
+    python -m benchmarks.load_test --workers 1 2 4 --clients 16
+"""
+import os
+import sys
+import json
+import time
+import signal
+import argparse
+import subprocess
+import http.client
+import multiprocessing
+import numpy as np
+import psutil
+
+
+EXAMPLE_CAR = {
+    "engine_type": 6, "fuel_type": 5, "transmission": 0, "body_type": 5, "has_incidents": 0, "wheel_system": 2,
+    "horsepower": 177.0, "maximum_seating": 5, "mileage": 7.0, "torque": 200.0, "year": 2019,
+    "combined_fuel_economy": 25.0, "legroom": 76.3, "major_options_count": 1.0, "size_of_vehicle": 426.6,
+}
+
+
+def server_command(deployment: str, workers: int, port: int):
+    if deployment == "gunicorn":
+        return [sys.executable, "-m", "gunicorn", "app.main:app", "--workers", str(workers), "--bind", f"127.0.0.1:{port}"]
+    return [sys.executable, "-m", "uvicorn", "app.main:app", "--workers", str(workers), "--port", str(port), "--log-level", "warning"]
+
+
+def wait_until_ready(port: int, timeout: float = 300.0):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            connection = http.client.HTTPConnection("127.0.0.1", port, timeout=5)
+            connection.request("GET", "/api/v1/predict/ready")
+            if connection.getresponse().status == 200:
+                return
+        except OSError:
+            pass
+        time.sleep(0.5)
+    raise TimeoutError(f"Server on port {port} not ready after {timeout}s")
+
+
+def run_client(port: int, seconds: float, seed: int, results):
+    rng = np.random.default_rng(seed)
+    connection = http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+    latencies, errors = [], 0
+    deadline = time.perf_counter() + seconds
+    while time.perf_counter() < deadline:
+        body = json.dumps(dict(EXAMPLE_CAR, mileage=float(rng.uniform(0, 200_000))))
+        start = time.perf_counter()
+        connection.request("POST", "/api/v1/predict/price", body, {"Content-Type": "application/json"})
+        response = connection.getresponse()
+        response.read()
+        latencies.append(time.perf_counter() - start)
+        errors += response.status != 200
+    results.put((latencies, errors))
+
+
+def server_memory_mb(server: psutil.Process):
+    processes = [server] + server.children(recursive=True)
+    memory = [process.memory_full_info() for process in processes]
+    return sum(m.pss for m in memory) / 2**20, sum(m.uss for m in memory) / 2**20, len(processes)
+
+
+def run_deployment(deployment: str, workers: int, clients: int, seconds: float, port: int) -> dict:
+    server = subprocess.Popen(server_command(deployment, workers, port), stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        wait_until_ready(port)
+        # every worker has answered at least once
+        time.sleep(2)
+        context = multiprocessing.get_context("spawn")
+        results = context.Queue()
+        processes = [context.Process(target=run_client, args=(port, seconds, seed, results)) for seed in range(clients)]
+        for process in processes:
+            process.start()
+        outcomes = [results.get() for _ in processes]
+        for process in processes:
+            process.join()
+        pss_mb, uss_mb, n_processes = server_memory_mb(psutil.Process(server.pid))
+    finally:
+        server.send_signal(signal.SIGTERM)
+        server.wait(timeout=60)
+
+    latencies = np.concatenate([np.asarray(latency) for latency, _ in outcomes])
+    return {
+        "deployment": deployment,
+        "workers": workers,
+        "requests_per_second": len(latencies) / seconds,
+        "p50_ms": float(np.percentile(latencies, 50) * 1e3),
+        "p99_ms": float(np.percentile(latencies, 99) * 1e3),
+        "errors": sum(errors for _, errors in outcomes),
+        "processes": n_processes,
+        "pss_mb": pss_mb,
+        "uss_mb": uss_mb,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--deployments", nargs="+", default=["gunicorn", "uvicorn"], choices=["gunicorn", "uvicorn"])
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, os.cpu_count()])
+    parser.add_argument("--clients", type=int, default=16)
+    parser.add_argument("--seconds", type=float, default=10.0)
+    parser.add_argument("--port", type=int, default=8765)
+    args = parser.parse_args()
+
+    print(f"{'deployment':<10} {'workers':>7} {'req/s':>8} {'p50 ms':>7} {'p99 ms':>7} {'errors':>6} {'PSS MB':>8} {'USS MB':>8}")
+    for deployment in args.deployments:
+        for workers in sorted(set(args.workers)):
+            result = run_deployment(deployment, workers, args.clients, args.seconds, args.port)
+            print(f"{result['deployment']:<10} {result['workers']:>7} {result['requests_per_second']:>8.0f} {result['p50_ms']:>7.1f} "
+                  f"{result['p99_ms']:>7.1f} {result['errors']:>6} {result['pss_mb']:>8.0f} {result['uss_mb']:>8.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,288 @@
+"""
+Benchmark suite of the price_predictors package, results are written to JSON so runs can be compared.
+
+Sections:
+  - models:  latency of lr_predict, xgb_predict and mlp_predict on single rows and on batches
+  - api:     end-to-end latency of /price and /price/batch through the FastAPI app, in-process
+  - insert:  throughput of inserting training rows against the size of the existing data
+  - retrain: wall time and peak RSS of a full retrain() (one fresh process per dataset size)
+
+Every input is synthetic (see synthetic.py) and seeded, the models are the active model version.
+
+Run from `Phase 6/api`:
+    python -m benchmarks.suite --output results.json
+    python -m benchmarks.suite --sections models api --output after.json --compare before.json
+    python -m benchmarks.suite --sections retrain --retrain-rows 10000 100000 1000000
+    python -m benchmarks.suite --sections retrain --retrain-rows 3000000 --out-of-core on --memory-budget-mb 256
+    python -m benchmarks.suite --sections retrain --sequential --output sequential.json
+"""
+import sys
+import json
+import time
+import platform
+import argparse
+import resource
+import tempfile
+import subprocess
+import multiprocessing
+import numpy as np
+from pathlib import Path
+from datetime import datetime, timezone
+
+from app.price_predictors import settings
+from benchmarks.synthetic import synthetic_frame, synthetic_car_features
+
+
+SECTIONS = ("models", "api", "insert", "retrain")
+
+
+def latency_stats(seconds, rows: int = 1) -> dict:
+    seconds = np.asarray(seconds)
+    stats = {
+        "calls": len(seconds),
+        "mean_ms": float(seconds.mean() * 1e3),
+        "p50_ms": float(np.percentile(seconds, 50) * 1e3),
+        "p95_ms": float(np.percentile(seconds, 95) * 1e3),
+        "p99_ms": float(np.percentile(seconds, 99) * 1e3),
+    }
+    if rows > 1:
+        stats["us_per_row"] = stats["mean_ms"] * 1e3 / rows
+    return stats
+
+
+def time_calls(fn, inputs, warmup: int = 5) -> list:
+    for value in inputs[:warmup]:
+        fn(value)
+    timings = []
+    for value in inputs:
+        start = time.perf_counter()
+        fn(value)
+        timings.append(time.perf_counter() - start)
+    return timings
+
+
+def max_rss_mb() -> float:
+    # ru_maxrss is in KiB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def bench_models(args) -> dict:
+    from app.price_predictors import MODELS, load_models
+    from app.price_predictors.views import prepare_input, prepare_batch_input, lr_predict, xgb_predict, mlp_predict
+
+    if not MODELS.ready:
+        load_models()
+    bundle = MODELS.active
+    predictors = {"lr": lr_predict, "xgb": xgb_predict, "mlp": mlp_predict}
+
+    rows = synthetic_car_features(args.requests, seed=1)
+    scaled_rows = [prepare_input(row, bundle) for row in rows]
+    results = {
+        "version": bundle.version,
+        "single": {"preparation": latency_stats(time_calls(lambda row: prepare_input(row, bundle), rows))},
+        "batch": {},
+    }
+    for name, predict in predictors.items():
+        results["single"][name] = latency_stats(time_calls(lambda scaled: predict(scaled, bundle), scaled_rows))
+
+    for batch_size in args.batch_sizes:
+        batch = prepare_batch_input(synthetic_car_features(batch_size, seed=2), bundle)
+        repeats = max(5, min(args.requests, args.batch_rows // batch_size))
+        results["batch"][str(batch_size)] = {
+            # each *_predict scores the whole matrix (and returns the first prediction)
+            name: latency_stats(time_calls(lambda scaled: predict(scaled, bundle), [batch] * repeats), batch_size)
+            for name, predict in predictors.items()
+        }
+    return results
+
+
+def bench_api(args) -> dict:
+    from fastapi.testclient import TestClient
+    from app.main import app
+
+    rows = [row.model_dump() for row in synthetic_car_features(args.requests, seed=3)]
+    results = {"price_batch": {}}
+    with TestClient(app) as client:
+        deadline = time.time() + 300
+        while client.get("/api/v1/predict/ready").status_code != 200:
+            if time.time() > deadline:
+                raise TimeoutError("The models were not loaded after 300s")
+            time.sleep(0.2)
+
+        def post(path, body):
+            response = client.post(path, json=body)
+            if response.status_code != 200:
+                raise RuntimeError(f"{path} answered {response.status_code}: {response.text[:200]}")
+
+        # Distinct rows miss the prediction cache, the same row hits it
+        results["price"] = latency_stats(time_calls(lambda row: post("/api/v1/predict/price", row), rows))
+        results["price_cached"] = latency_stats(time_calls(lambda row: post("/api/v1/predict/price", row), [rows[0]] * len(rows)))
+        for batch_size in args.batch_sizes:
+            batch = [row.model_dump() for row in synthetic_car_features(batch_size, seed=4)]
+            repeats = max(5, min(args.requests, args.batch_rows // batch_size))
+            results["price_batch"][str(batch_size)] = latency_stats(
+                time_calls(lambda body: post("/api/v1/predict/price/batch", body), [batch] * repeats), batch_size)
+    return results
+
+
+def bench_insert(args) -> dict:
+    from app.price_predictors.data_types import CarFeaturesWithPrice
+    from app.price_predictors.ingestion import append_training_rows
+    from app.price_predictors.columnar_store import ColumnarStore
+
+    new_rows = [CarFeaturesWithPrice(**row) for row in synthetic_frame(args.inserts, seed=5).to_dict("records")]
+    results = {}
+    for existing_rows in args.insert_existing_rows:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            csv_path = Path(tmp_dir) / "additional_dataset.csv"
+            synthetic_frame(existing_rows, seed=6).to_csv(csv_path, index=False)
+            store = ColumnarStore(Path(tmp_dir) / "columnar")
+            if existing_rows:
+                store.import_csv(csv_path)
+            # What /insert_row does for each TRAINING_DATA_STORAGE, one row per call
+            insert_functions = {
+                "csv": (lambda row: append_training_rows([row], csv_path), [csv_path]),
+                "columnar": (lambda row: store.append_rows([row]), store.path.rglob("*")),
+            }
+            for storage, (insert, files) in insert_functions.items():
+                start = time.perf_counter()
+                timings = time_calls(insert, new_rows, warmup=0)
+                elapsed = time.perf_counter() - start
+                results[f"{storage}/{existing_rows}"] = {
+                    "storage": storage,
+                    "existing_rows": existing_rows,
+                    "data_mb": sum(path.stat().st_size for path in files if path.is_file()) / 2**20,
+                    "rows_per_second": len(new_rows) / elapsed,
+                    **latency_stats(timings),
+                }
+    return results
+
+
+def _run_retrain(csv_path: str, train_mlp: bool, out_of_core, memory_budget_mb: float, parallel: bool, results):
+    from app.price_predictors.training import retrain
+
+    rss_before = max_rss_mb()
+    stage_seconds, stage = {}, [None, time.perf_counter()]
+
+    def on_progress(name):
+        now = time.perf_counter()
+        if stage[0] is not None:
+            stage_seconds[stage[0]] = now - stage[1]
+        stage[:] = [name, now]
+
+    start = time.perf_counter()
+    result = retrain(data_files=[Path(csv_path)], save_models=False, update_models_in_memory=False,
+                     save_combined_dataset=False, train_mlp=train_mlp, mode="full", progress_callback=on_progress,
+                     out_of_core=out_of_core, memory_budget_mb=memory_budget_mb, parallel=parallel)
+    on_progress(None)
+    results.put({
+        "seconds": time.perf_counter() - start,
+        "stage_seconds": stage_seconds,
+        "model_seconds": result["metrics"]["training_seconds"],
+        "rss_before_mb": rss_before,
+        "peak_rss_mb": max_rss_mb(),
+    })
+
+
+def bench_retrain(args) -> dict:
+    context = multiprocessing.get_context("spawn")
+    results = {}
+    for n_rows in args.retrain_rows:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            csv_path = Path(tmp_dir) / "dataset.csv"
+            synthetic_frame(n_rows, seed=7).to_csv(csv_path, index=False)
+            queue = context.Queue()
+            # A fresh process per size so the peak RSS of one run does not hide the next
+            out_of_core = {"auto": "auto", "on": True, "off": False}[args.out_of_core]
+            process = context.Process(target=_run_retrain, args=(str(csv_path), not args.no_mlp, out_of_core, args.memory_budget_mb,
+                                                                not args.sequential, queue))
+            process.start()
+            process.join()
+            if process.exitcode != 0:
+                raise RuntimeError(f"retrain on {n_rows} rows failed with exit code {process.exitcode}")
+            results[str(n_rows)] = {"rows": n_rows, "train_mlp": not args.no_mlp, "out_of_core": args.out_of_core,
+                                    "memory_budget_mb": args.memory_budget_mb, "parallel": not args.sequential, **queue.get()}
+    return results
+
+
+def environment() -> dict:
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {
+        "created_at": datetime.now(timezone.utc).isoformat(),
+        "commit": commit,
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "cpu_count": multiprocessing.cpu_count(),
+        "numpy": np.__version__,
+        "settings": {
+            name: getattr(settings, name)
+            for name in ("TRAINING_DATA_STORAGE", "XGB_TRAINING_PROFILE", "XGB_SERVING_MODE", "MLP_SERVING_MODE",
+                         "MICRO_BATCHING_ENABLED", "PREDICTION_CACHE_ENABLED", "METRICS_ENABLED",
+                         "RETRAIN_OUT_OF_CORE", "RETRAIN_MEMORY_BUDGET_MB", "RETRAIN_PARALLEL", "RETRAIN_XGB_THREADS",
+                         "RETRAIN_MLP_THREADS")
+        },
+    }
+
+
+def flatten(results: dict, prefix: str = "") -> dict:
+    values = {}
+    for key, value in results.items():
+        if isinstance(value, dict):
+            values.update(flatten(value, f"{prefix}{key}."))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            values[f"{prefix}{key}"] = value
+    return values
+
+
+def compare(baseline: dict, current: dict):
+    """Print the main figures of both runs side by side (ratio > 1 means the current run is higher)"""
+    keys = ("p50_ms", "p99_ms", "us_per_row", "rows_per_second", "seconds", "peak_rss_mb")
+    old, new = flatten(baseline["results"]), flatten(current["results"])
+    print(f"\ncompared with {baseline['environment'].get('commit')} ({baseline['environment']['created_at']})")
+    print(f"{'metric':<50} {'baseline':>12} {'current':>12} {'ratio':>7}")
+    for name, value in new.items():
+        if name.rsplit(".", 1)[-1] in keys and name in old:
+            ratio = value / old[name] if old[name] else float("nan")
+            print(f"{name:<50} {old[name]:>12.3f} {value:>12.3f} {ratio:>7.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sections", nargs="+", default=list(SECTIONS), choices=SECTIONS)
+    parser.add_argument("--output", type=Path, default=Path("benchmark-results.json"))
+    parser.add_argument("--compare", type=Path, help="results of a previous run to compare with")
+    parser.add_argument("--requests", type=int, default=500, help="single-row calls per measurement")
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[100, 1000, 10_000])
+    parser.add_argument("--batch-rows", type=int, default=200_000, help="rows scored per batch size (bounds the repeats)")
+    parser.add_argument("--inserts", type=int, default=200, help="rows inserted per measurement")
+    parser.add_argument("--insert-existing-rows", type=int, nargs="+", default=[0, 10_000, 100_000, 1_000_000])
+    parser.add_argument("--retrain-rows", type=int, nargs="+", default=[10_000, 100_000, 1_000_000])
+    parser.add_argument("--no-mlp", action="store_true", help="retrain without the MLP")
+    parser.add_argument("--out-of-core", choices=["auto", "on", "off"], default="auto", help="out-of-core full refit (RETRAIN_OUT_OF_CORE)")
+    parser.add_argument("--memory-budget-mb", type=float, default=settings.RETRAIN_MEMORY_BUDGET_MB)
+    parser.add_argument("--sequential", action="store_true", help="fit the models one after the other (RETRAIN_PARALLEL off)")
+    args = parser.parse_args()
+
+    benches = {"models": bench_models, "api": bench_api, "insert": bench_insert, "retrain": bench_retrain}
+    report = {"environment": environment(), "arguments": {key: value for key, value in vars(args).items() if key not in ("output", "compare")},
+              "results": {}}
+    for section in args.sections:
+        start = time.perf_counter()
+        print(f"{section}...", flush=True)
+        report["results"][section] = benches[section](args)
+        print(f"{section} done in {time.perf_counter() - start:.1f}s", flush=True)
+
+    args.output.write_text(json.dumps(report, indent=2))
+    print(f"results written to {args.output}")
+    for name, value in flatten(report["results"]).items():
+        if name.rsplit(".", 1)[-1] in ("p50_ms", "p99_ms", "rows_per_second", "seconds", "rss_before_mb", "peak_rss_mb"):
+            print(f"  {name:<50} {value:>12.3f}")
+    if args.compare:
+        compare(json.loads(args.compare.read_text()), report)
+
+
+if __name__ == "__main__":
+    main()
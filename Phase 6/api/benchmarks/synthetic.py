@@ -0,0 +1,44 @@
+"""
+Synthetic training and scoring rows: categorical codes drawn from LABEL_MAPPINGS and numeric
+features from realistic ranges, with a log price that depends on them.
+"""
+from datetime import datetime
+from typing import List
+
+import numpy as np
+import pandas as pd
+
+from app.price_predictors.settings import REQUIRED_COLUMNS, TARGET_COLUMNS
+from app.price_predictors.data_types import LABEL_MAPPINGS, CarFeatures
+
+
+CATEGORICAL_COLUMNS = ["engine_type", "fuel_type", "transmission", "body_type", "has_incidents", "wheel_system"]
+
+
+def synthetic_frame(n_rows: int, seed: int = 31) -> pd.DataFrame:
+    """`n_rows` rows with every column of REQUIRED_COLUMNS (features and log price)"""
+    rng = np.random.default_rng(seed)
+    df = pd.DataFrame({
+        column: rng.choice(np.array(sorted(LABEL_MAPPINGS[column].values())), n_rows)
+        for column in CATEGORICAL_COLUMNS
+    })
+    df["horsepower"] = rng.uniform(70, 500, n_rows).round()
+    df["maximum_seating"] = rng.integers(2, 9, n_rows)
+    # Most cars for sale are recent, a few have very high mileage
+    df["mileage"] = np.minimum(rng.exponential(40_000, n_rows), 400_000).round()
+    df["torque"] = (df["horsepower"] * rng.uniform(0.8, 1.5, n_rows)).round()
+    df["year"] = datetime.now().year - np.minimum(rng.exponential(4, n_rows), 30).astype(int)
+    df["combined_fuel_economy"] = rng.uniform(12, 50, n_rows).round(1)
+    df["legroom"] = rng.uniform(60, 90, n_rows).round(1)
+    df["major_options_count"] = rng.integers(0, 20, n_rows).astype(float)
+    df["size_of_vehicle"] = rng.uniform(300, 600, n_rows).round(1)
+
+    age = datetime.now().year - df["year"]
+    price = 20_000 + 60 * df["horsepower"] - 0.05 * df["mileage"] + 300 * df["major_options_count"]
+    price = np.maximum(price * 0.9 ** age * np.exp(rng.normal(0, 0.1, n_rows)), 1_000)
+    df[TARGET_COLUMNS[0]] = np.log(price)
+    return df[REQUIRED_COLUMNS]
+
+
+def synthetic_car_features(n_rows: int, seed: int = 31) -> List[CarFeatures]:
+    return [CarFeatures(**row) for row in synthetic_frame(n_rows, seed).drop(columns=TARGET_COLUMNS).to_dict("records")]
@@ -0,0 +1,57 @@
+# Multi-worker deployment of the API, run from `Phase 6/api` (gunicorn picks this file up):
+#     gunicorn app.main:app
+#     WEB_CONCURRENCY=8 gunicorn app.main:app
+#
+# The app is imported and the active model version loaded once, in the master process, before
+# the workers are forked. The models are served from arrays memory-mapped read-only
+# (SHARED_MODEL_MEMORY, see serving_export.py), so the workers share a single copy of the weights
+# and start without loading anything. A version activated by a retrain or rollback in one worker
+# is picked up by the others within MODEL_WATCH_INTERVAL_SECONDS. /api/v1/metrics reports the sum
+# of the metrics of every worker (multiprocess mode of prometheus_client).
+import gc
+import os
+import glob
+
+os.environ.setdefault("SHARED_MODEL_MEMORY", "1")
+# Must be set before prometheus_client is imported, i.e. before the app (settings.METRICS_DIR)
+os.environ.setdefault("PROMETHEUS_MULTIPROC_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "app", "price_predictors", "metrics"))
+os.makedirs(os.environ["PROMETHEUS_MULTIPROC_DIR"], exist_ok=True)
+
+bind = os.environ.get("BIND", "0.0.0.0:8000")
+workers = int(os.environ.get("WEB_CONCURRENCY", os.cpu_count() or 1))
+worker_class = "uvicorn.workers.UvicornWorker"
+preload_app = True
+# Same as uvicorn --proxy-headers
+forwarded_allow_ips = "*"
+# Retraining runs in its own process, requests never take this long
+timeout = 60
+
+
+def on_starting(server):
+    # Values of the processes of a previous run, the files of the master (<type>_<pid>.db) were
+    # created when the app was preloaded
+    own_suffix = f"_{os.getpid()}.db"
+    for path in glob.glob(os.path.join(os.environ["PROMETHEUS_MULTIPROC_DIR"], "*.db")):
+        if not path.endswith(own_suffix):
+            os.remove(path)
+
+
+def when_ready(server):
+    from app.price_predictors import load_models
+    from app.price_predictors.settings import TRAINING_DATA_STORAGE
+    from app.price_predictors.columnar_store import import_training_datasets
+
+    if TRAINING_DATA_STORAGE == "columnar":
+        import_training_datasets()
+    # The model load times are reported by the master, the forked workers start from zero
+    load_models()
+    # Nothing allocated so far is ever collected, so the garbage collector of the workers does not
+    # touch (and copy) the pages they share with the master
+    gc.freeze()
+
+
+def child_exit(server, worker):
+    from prometheus_client import multiprocess
+
+    # The counters and histograms of the worker are still summed, its live gauge values are dropped
+    multiprocess.mark_process_dead(worker.pid)
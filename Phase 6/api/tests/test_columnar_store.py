@@ -0,0 +1,88 @@
+import time
+import threading
+import numpy as np
+
+from app.price_predictors.columnar_store import ColumnarStore
+
+COLUMNS = ["year", "price"]
+DTYPES = {"year": "int32", "price": "float64"}
+
+
+def make_store(path, n_segments=4, rows_per_segment=10):
+    store = ColumnarStore(path, columns=COLUMNS, dtypes=DTYPES, compaction_min_segments=1000)
+    for i in range(n_segments):
+        rows = np.arange(i * rows_per_segment, (i + 1) * rows_per_segment)
+        store.append_columns({"year": rows, "price": rows * 1.5})
+    return store
+
+
+def test_compaction_keeps_rows_in_order(tmp_path):
+    store = make_store(tmp_path / "store")
+    assert store.compact() == 4
+    store.append_columns({"year": [40, 41], "price": [60.0, 61.5]})
+    columns = store.load_columns()
+    np.testing.assert_array_equal(columns["year"], np.arange(42))
+    np.testing.assert_array_equal(columns["price"], np.arange(42) * 1.5)
+    np.testing.assert_array_equal(store.load_columns(["year"], start=5, stop=35)["year"], np.arange(5, 35))
+
+
+def test_reader_survives_compaction(tmp_path):
+    store = make_store(tmp_path / "store")
+    store.compact()
+    store.append_columns({"year": [40, 41], "price": [60.0, 61.5]})
+    store.append_columns({"year": [42], "price": [63.0]})
+
+    parts = store.iter_parts()
+    years = [next(parts)["year"]]
+    # Merges the base and segments the reader has not read yet, and deletes their files
+    assert store.compact() == 2
+    assert len(list((tmp_path / "store" / "segments").iterdir())) == 0
+    years += [part["year"] for part in parts]
+    np.testing.assert_array_equal(np.concatenate(years), np.arange(43))
+
+
+def test_empty_store(tmp_path):
+    store = ColumnarStore(tmp_path / "store", columns=COLUMNS, dtypes=DTYPES)
+    assert list(store.iter_parts()) == []
+    assert len(store.load_columns()["price"]) == 0
+    assert not (tmp_path / "store").exists()
+
+
+
+def test_concurrent_compactions(tmp_path, monkeypatch):
+    # Two handles on the same store, like the API process and a retrain process
+    first = make_store(tmp_path / "store")
+    first.compact()
+    for i in range(4, 8):
+        first.append_columns({"year": np.arange(i * 10, (i + 1) * 10), "price": np.arange(i * 10, (i + 1) * 10) * 1.5})
+    second = ColumnarStore(tmp_path / "store", columns=COLUMNS, dtypes=DTYPES)
+
+    # The first compaction pauses once it has read the manifest, while the second one runs
+    started, open_memmap = threading.Event(), np.lib.format.open_memmap
+
+    def slow_open_memmap(*args, **kwargs):
+        if threading.current_thread().name == "first" and not started.is_set():
+            started.set()
+            time.sleep(0.5)
+        return open_memmap(*args, **kwargs)
+
+    monkeypatch.setattr(np.lib.format, "open_memmap", slow_open_memmap)
+    results, errors = {}, []
+
+    def compact(store, name):
+        try:
+            results[name] = store.compact()
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=compact, args=(first, "first"), name="first")]
+    threads[0].start()
+    started.wait()
+    threads.append(threading.Thread(target=compact, args=(second, "second")))
+    threads[1].start()
+    for thread in threads:
+        thread.join()
+
+    assert errors == []
+    assert results == {"first": 4, "second": 0}
+    np.testing.assert_array_equal(second.load_columns()["year"], np.arange(80))
@@ -0,0 +1,84 @@
+"""
+Parity of the MLP serving modes (see mlp_serving.py) with keras' own predict, on a small model
+saved and loaded back the way retrain stores the MLP.
+"""
+import numpy as np
+import pytest
+
+from app.price_predictors.mlp_serving import MLP_SERVING_MODES, NumpyMLP, build_mlp_predictor, _tf_function_predictor
+
+tf = pytest.importorskip("tensorflow")
+
+N_FEATURES = 15
+
+
+def build_model(activations=("relu", "relu")):
+    from tensorflow.keras.models import Sequential
+    from tensorflow.keras.layers import Dense, Dropout
+
+    layers = [tf.keras.Input(shape=(N_FEATURES,))]
+    for units, activation in zip((16, 8), activations):
+        layers += [Dense(units, activation=activation), Dropout(0.3)]
+    model = Sequential(layers + [Dense(1)])
+    model.compile(optimizer="adam", loss="mse")
+    rng = np.random.default_rng(31)
+    X = rng.standard_normal((256, N_FEATURES)).astype(np.float32)
+    model.fit(X, X[:, :3].sum(axis=1), epochs=2, batch_size=64, verbose=0)
+    return model
+
+
+@pytest.fixture(scope="module", params=[("relu", "relu"), ("tanh", "sigmoid")], ids=["relu", "tanh-sigmoid"])
+def exported_model(request, tmp_path_factory):
+    path = tmp_path_factory.mktemp("mlp") / "mlp_price_prediction.keras"
+    build_model(request.param).save(path)
+    return tf.keras.models.load_model(path)
+
+
+PREDICTORS = {
+    "numpy": lambda model: NumpyMLP.from_keras(model).predict,
+    "tf_function": _tf_function_predictor,
+}
+
+
+@pytest.mark.parametrize("mode", list(PREDICTORS))
+@pytest.mark.parametrize("n_rows", [1, 7, 1000])
+def test_matches_keras_predict(exported_model, mode, n_rows):
+    data = np.random.default_rng(n_rows).standard_normal((n_rows, N_FEATURES)).astype(np.float32)
+    expected = np.asarray(exported_model.predict(data, verbose=0)).reshape(-1)
+    predictions = PREDICTORS[mode](exported_model)(data)
+    assert predictions.shape == (n_rows,)
+    np.testing.assert_allclose(predictions, expected, rtol=1e-4, atol=1e-4)
+
+
+@pytest.mark.parametrize("mode", MLP_SERVING_MODES)
+def test_build_mlp_predictor_does_not_fall_back(exported_model, mode, caplog):
+    predictor = build_mlp_predictor(exported_model, mode)
+    assert "Falling back" not in caplog.text
+    data = np.random.default_rng(3).standard_normal((5, N_FEATURES)).astype(np.float32)
+    np.testing.assert_allclose(predictor(data), np.asarray(exported_model.predict(data, verbose=0)).reshape(-1), rtol=1e-4, atol=1e-4)
+
+
+def test_mixed_precision_model_within_serving_tolerance(tmp_path):
+    """retrain trains the MLP under the mixed_float16 policy, the numpy forward pass computes in float32"""
+    from tensorflow.keras.mixed_precision import set_global_policy
+    from app.price_predictors.settings import MLP_PARITY_ATOL
+
+    set_global_policy("mixed_float16")
+    try:
+        build_model().save(tmp_path / "mlp.keras")
+        model = tf.keras.models.load_model(tmp_path / "mlp.keras")
+    finally:
+        set_global_policy("float32")
+    data = np.random.default_rng(5).standard_normal((64, N_FEATURES)).astype(np.float32)
+    expected = np.asarray(model.predict(data, verbose=0), dtype=np.float32).reshape(-1)
+    for predictor in PREDICTORS.values():
+        np.testing.assert_allclose(predictor(model)(data), expected, atol=MLP_PARITY_ATOL)
+
+
+def test_unsupported_layer_is_rejected():
+    from tensorflow.keras.models import Sequential
+    from tensorflow.keras.layers import Dense, BatchNormalization
+
+    model = Sequential([tf.keras.Input(shape=(N_FEATURES,)), Dense(4), BatchNormalization(), Dense(1)])
+    with pytest.raises(ValueError):
+        NumpyMLP.from_keras(model)
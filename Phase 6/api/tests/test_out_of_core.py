@@ -0,0 +1,44 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from app.price_predictors.columnar_store import ColumnarStore
+from app.price_predictors.out_of_core import ChunkedTrainingData, mlp_dataset
+from app.price_predictors.settings import REQUIRED_COLUMNS, TARGET_COLUMNS
+
+N_ROWS = 2_000
+
+
+@pytest.fixture(params=["csv", "store"])
+def data(request, tmp_path):
+    rng = np.random.default_rng(0)
+    frame = pd.DataFrame({column: rng.integers(0, 100, N_ROWS) for column in REQUIRED_COLUMNS})
+    frame[TARGET_COLUMNS[0]] = np.arange(N_ROWS, dtype=float)
+    frame.to_csv(tmp_path / "data.csv", index=False)
+    if request.param == "csv":
+        return ChunkedTrainingData([tmp_path / "data.csv"], chunk_rows=100)
+    store = ColumnarStore(tmp_path / "store")
+    store.import_csv(tmp_path / "data.csv")
+    return ChunkedTrainingData(data_store=store, chunk_rows=100)
+
+
+def split_targets(data, rng=None):
+    return np.concatenate([y for _, y in data.iter_split("train", rng=rng)])
+
+
+def test_shuffled_chunks_keep_the_split(data):
+    in_order = split_targets(data)
+    shuffled = split_targets(data, np.random.default_rng(1))
+    assert not np.array_equal(in_order, shuffled)
+    np.testing.assert_array_equal(np.sort(shuffled), in_order)
+
+
+def test_mlp_epochs_are_shuffled_differently(data):
+    n_rows = len(split_targets(data))
+    dataset = mlp_dataset(data, "train", scaler=None, n_rows=n_rows, batch_size=64, shuffle=True)
+    epochs = [np.concatenate([y.numpy().reshape(-1) for _, y in dataset]) for _ in range(2)]
+    assert not np.array_equal(epochs[0], epochs[1])
+    # chunks are shuffled too, not only the rows within them
+    assert not (epochs[0][:64] < 100).all()
+    np.testing.assert_array_equal(np.sort(epochs[0]), np.sort(epochs[1]))
+    np.testing.assert_array_equal(np.sort(epochs[0]), split_targets(data))
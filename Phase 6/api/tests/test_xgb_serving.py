@@ -0,0 +1,114 @@
+"""
+Parity of the XGBoost serving paths (see xgb_serving.py) with Booster.predict on a DMatrix.
+"""
+import numpy as np
+import pytest
+
+xgb = pytest.importorskip("xgboost")
+
+from app.price_predictors.xgb_serving import (
+    FLAT_EVALUATOR_AVAILABLE, XGB_SERVING_MODES, FlatTreeEnsemble, _inplace_predictor, build_xgb_predictor,
+)
+
+N_FEATURES = 6
+ATOL = 1e-4
+
+requires_numba = pytest.mark.skipif(not FLAT_EVALUATOR_AVAILABLE, reason="the flat tree evaluator requires numba")
+
+
+def make_data(n_rows, seed, missing_fraction=0.1):
+    rng = np.random.default_rng(seed)
+    X = rng.standard_normal((n_rows, N_FEATURES)).astype(np.float32)
+    # a few discrete columns so that many rows sit exactly on a split threshold
+    X[:, :2] = rng.integers(0, 5, size=(n_rows, 2))
+    y = 3 * X[:, 0] - 2 * X[:, 1] + X[:, 2] * X[:, 3] + rng.normal(0, 0.1, n_rows)
+    X[rng.random(X.shape) < missing_fraction] = np.nan
+    return X, y
+
+
+@pytest.fixture(scope="module", params=[False, True], ids=["full", "early-stopped"])
+def model(request):
+    X, y = make_data(2000, seed=31)
+    params = dict(n_estimators=60, max_depth=5, learning_rate=0.3, tree_method="hist", n_jobs=1)
+    if not request.param:
+        return xgb.XGBRegressor(**params).fit(X, y)
+    X_val, y_val = make_data(500, seed=32)
+    model = xgb.XGBRegressor(**{**params, "n_estimators": 400}, early_stopping_rounds=5).fit(
+        X, y, eval_set=[(X_val, y_val)], verbose=False)
+    assert model.get_booster().attr("best_iteration") is not None
+    return model
+
+
+def dmatrix_predict(model, data):
+    booster = model.get_booster()
+    best_iteration = booster.attr("best_iteration")
+    iteration_range = (0, int(best_iteration) + 1) if best_iteration is not None else (0, 0)
+    return booster.predict(xgb.DMatrix(data, missing=np.nan), iteration_range=iteration_range)
+
+
+def flat_predict(model):
+    return FlatTreeEnsemble.from_booster(model.get_booster()).predict
+
+
+def inplace_predict(model):
+    return _inplace_predictor(model, threads=2, small_batch_rows=4)
+
+
+PATHS = [pytest.param(inplace_predict, id="inplace"), pytest.param(flat_predict, id="flat", marks=requires_numba)]
+
+
+def split_nodes(model):
+    """(feature, threshold) of every split of the ensemble"""
+    ensemble = FlatTreeEnsemble.from_booster(model.get_booster())
+    is_split = ensemble.left != np.arange(len(ensemble.left))
+    return ensemble.feature[is_split], ensemble.threshold[is_split]
+
+
+@pytest.mark.parametrize("path", PATHS)
+@pytest.mark.parametrize("n_rows", [1, 4, 5, 1000])
+def test_matches_dmatrix_predict(model, path, n_rows):
+    data, _ = make_data(n_rows, seed=n_rows)
+    predictions = path(model)(data)
+    assert predictions.shape == (n_rows,)
+    np.testing.assert_allclose(predictions, dmatrix_predict(model, data), atol=ATOL)
+
+
+@pytest.mark.parametrize("path", PATHS)
+def test_missing_values_follow_default_direction(model, path):
+    data, _ = make_data(300, seed=7, missing_fraction=0)
+    for feature in range(N_FEATURES):
+        data[feature::N_FEATURES, feature] = np.nan
+    data[0] = np.nan
+    np.testing.assert_allclose(path(model)(data), dmatrix_predict(model, data), atol=ATOL)
+    np.testing.assert_allclose(path(model)(data[:1]), dmatrix_predict(model, data[:1]), atol=ATOL)
+
+
+@pytest.mark.parametrize("path", PATHS)
+def test_values_on_a_split_threshold_go_right(model, path):
+    features, thresholds = split_nodes(model)
+    data, _ = make_data(len(features), seed=11, missing_fraction=0)
+    rows = np.arange(len(features))
+    data[rows, features] = thresholds
+    # the comparison is value < threshold, so the rows just below the threshold take the other branch
+    below = data.copy()
+    below[rows, features] = np.nextafter(thresholds, np.float32(-np.inf))
+    for batch in (data, below):
+        np.testing.assert_allclose(path(model)(batch), dmatrix_predict(model, batch), atol=ATOL)
+        for row in batch[:20]:
+            np.testing.assert_allclose(path(model)(row[None]), dmatrix_predict(model, row[None]), atol=ATOL)
+
+
+@pytest.mark.parametrize("mode", XGB_SERVING_MODES)
+def test_build_xgb_predictor_does_not_fall_back(model, mode, caplog):
+    predictor = build_xgb_predictor(model, mode, threads=2, small_batch_rows=4)
+    assert "Falling back" not in caplog.text
+    data, _ = make_data(50, seed=5)
+    for rows in (slice(0, 1), slice(None)):
+        np.testing.assert_allclose(predictor(data[rows]), dmatrix_predict(model, data[rows]), atol=ATOL)
+
+
+def test_unsupported_objective_is_rejected():
+    X, y = make_data(200, seed=1)
+    model = xgb.XGBRegressor(n_estimators=3, objective="reg:gamma").fit(X, np.abs(y) + 1)
+    with pytest.raises(ValueError):
+        FlatTreeEnsemble.from_booster(model.get_booster())